@@ -84,6 +84,26 @@
 import datetime    # for adding date stamps
 import platform    # for determining if a mac to use open
 import traceback   # for printing traceback
+import hashlib     # for content-addressed caches
+import shutil      # for copying files in and out of caches
+import tempfile    # for staging cache entries
+import subprocess  # for running converters from helper commands
+import time        # for timestamps of generated archive members
+import zipfile     # for writing zip archives
+import tarfile     # for writing tar.gz archives
+import StringIO    # for in-memory archive members
+import json        # for exporting the dependency graph
+import threading   # for running build steps concurrently
+import Queue       # for collecting the results of build steps
+import mmap        # for scanning large files without reading them
+import fnmatch     # for matching opaque file globs
+import pipes       # for quoting the arguments of regenerated Makefiles
+import socket      # for talking to the scan daemon
+import SocketServer # for running the scan daemon
+try:
+    from scandir import scandir # for walking directories without stat'ing
+except ImportError:
+    scandir = None # fall back on os.listdir and a stat per entry (walk_tree)
 
 
 # set the version number
@@ -91,6 +111,31 @@
 latexmake_version_minor = 0
 latexmake_version_revision = 3
 
+# the executables found by which
+latexmake_which_cache = {}
+
+# the socket of the scan daemon (latexmake serve), in the project directory
+latexmake_socket = os.path.join(".latexmake", "serve.sock")
+
+# the environment variables a scan depends on (the daemon only answers
+# clients that have the same, see serve_environment)
+latexmake_serve_environment = ["PATH", "HOME", "TEXMF", "TEXMFHOME", \
+    "TEXMFLOCAL", "TEXMFCNF", "TEXINPUTS", "BIBINPUTS", "BSTINPUTS"]
+
+# the variables shared by the Makefiles of several root documents (see
+# write_roots_makefile)
+latexmake_common_makefile = "Makefile.common"
+
+# braces and escaped characters (see closing_brace)
+latexmake_brace_regex = re.compile(r"\\.|[{}]")
+
+# comments, and the bibliography commands a preview keeps (see
+# command_preview)
+latexmake_comment_regex = re.compile(r"(?<!\\)%.*")
+latexmake_bibliography_regex = re.compile(r"\\(?:bibliographystyle|" + \
+    r"bibliography|printbibliography)(?![a-zA-Z])(?:\[[^\]]*\])?" + \
+    r"(?:\{[^}]*\})?")
+
 
 #================================================================================
 #
@@ -188,39 +233,34 @@ def is_exe(fpath):
 
 #-------------------------------------------------------------------------------
 def function_exists(program):
-
-    fpath, _ = os.path.split(program)
-    if fpath:
-        return is_exe(program)
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"') # TODO: see if I can use "\""
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return True
-
-        return False
+    return which(program) is not None
 # fed function_exists(program)
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
 def which(program):
-    # a unix-like which
+    # a unix-like which. The results are cached per PATH (for the life of
+    # the process, which is long for latexmake serve)
     # http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python
+    key = (program, os.environ.get("PATH", ""))
+    if key in latexmake_which_cache:
+        return latexmake_which_cache[key]
+    latexmake_which_cache[key] = None
 
     fpath, _ = os.path.split(program)
     if fpath:
         if is_exe(program):
-            return program
+            latexmake_which_cache[key] = program
     else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"')
+        for path in os.environ.get("PATH", "").split(os.pathsep):
+            path = path.strip('"') # TODO: see if I can use "\""
             exe_file = os.path.join(path, program)
             if is_exe(exe_file):
-                return exe_file
+                latexmake_which_cache[key] = exe_file
+                break
 
-    # program does not exist, return None
-    return None
+    # None if the program does not exist
+    return latexmake_which_cache[key]
 # fed which(program)
 #-------------------------------------------------------------------------------
 
@@ -234,9 +274,30 @@ def which(program):
 
 #-------------------------------------------------------------------------------
 def latexmake_usage():
-    output = "latexmake [options] basefilename\n"
+    output = "latexmake [options] basefilename [basefilename ...]\n"
     output += "\t--tex=/path/to/tex compiler\n"
     output += "\t--bib=/path/to/bib compiler\n"
+    output += "\t--build-cache\t\tReuse outputs of identical builds\n"
+    output += "\t--trim-bib\t\tOnly give bibtex the cited entries\n"
+    output += "\t--output-directory=/path/to/auxiliary and output files\n"
+    output += "\t--ninja\t\t\tWrite build.ninja instead of a Makefile\n"
+    output += "\t--emit-json[=/path/to/dependency graph.json]\n"
+    output += "\t--emit-dot[=/path/to/dependency graph.dot]\n"
+    output += "\t--opaque=glob of included data files not to parse\n"
+    output += "\t--opaque-size=size in MB above which included files are data\n"
+    output += "\t--prune=glob of directories not to search for files\n"
+    output += "\t--git-index\t\tList the project files with git\n"
+    output += "latexmake build [--jobs=N] [--force] [options] basefilename\n"
+    output += "latexmake archive [options] -- files\n"
+    output += "\t--output=/path/to/archive.zip or archive.tar.gz\n"
+    output += "latexmake convertfig [options] source target\n"
+    output += "\t--cache-dir=/path/to/figure cache\n"
+    output += "\t--cache-size=figure cache size in MB\n"
+    output += "latexmake report [--log=/path/to/timing.jsonl] [--top=N]\n"
+    output += "latexmake fingerprint --output=FILE [--checked=FILE] -- files\n"
+    output += "latexmake serve [--stop]\tKeep scan results warm for the\n"
+    output += "\t\t\t\tother latexmake commands in this directory\n"
+    output += "latexmake deps [options] basefilename [basefilename ...]\n"
     #output += "\t--nooverwrite\t\t\tWill not overwrite a Makefile\n"
     return output
 # fed latexmake_usage()
@@ -511,6 +572,861 @@ def parse_data_in_angle_braces(line):
 # fed parse_data_in_angle_braces(line)
 #-------------------------------------------------------------------------------
 
+#-------------------------------------------------------------------------------
+def closing_brace(text, idx):
+    # the index after the brace closing the one at text[idx] (len(text) if it
+    # is not closed). Escaped braces do not count
+    depth = 0
+    for match in latexmake_brace_regex.finditer(text, idx):
+        if match.group(0) == "{":
+            depth += 1
+        elif match.group(0) == "}":
+            depth -= 1
+            if depth <= 0:
+                return match.end()
+    return len(text)
+# fed closing_brace(text, idx)
+#-------------------------------------------------------------------------------
+
+
+
+#================================================================================
+#
+#        Content-addressed caches
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+def file_digest(filename, blocksize=1048576):
+    # returns the sha1 hex digest of the contents of filename
+    h = hashlib.sha1()
+    fid = open(filename, "rb")
+    try:
+        block = fid.read(blocksize)
+        while block:
+            h.update(block)
+            block = fid.read(blocksize)
+    finally:
+        fid.close()
+    return h.hexdigest()
+# fed file_digest(filename, blocksize)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def cache_entry_path(cache_dir, key):
+    # entries are fanned out on the first two characters of the key
+    return os.path.join(os.path.expanduser(cache_dir), key[:2], key)
+# fed cache_entry_path(cache_dir, key)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def cache_fetch(cache_dir, key, files):
+    # copies a cache entry into place
+    # files: list of (destination, name) pairs. names that were not stored
+    #   in the entry are skipped
+    # returns True if the entry exists
+    entry = cache_entry_path(cache_dir, key)
+    manifest = os.path.join(entry, "manifest")
+    if not os.path.isfile(manifest):
+        return False
+
+    fid = open(manifest, "r")
+    stored = fid.read().split("\n")
+    fid.close()
+
+    for (dst, name) in files:
+        if name not in stored:
+            continue
+        pth = os.path.dirname(dst)
+        if pth and not os.path.isdir(pth):
+            os.makedirs(pth)
+        # copy the contents only, so make sees a fresh target
+        shutil.copyfile(os.path.join(entry, name), dst)
+
+    # mark the entry as recently used
+    os.utime(entry, None)
+    return True
+# fed cache_fetch(cache_dir, key, files)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def cache_store(cache_dir, key, files, max_size=0):
+    # stores files (a list of (source, name) pairs) under key, then evicts
+    # the least recently used entries until the cache is below max_size bytes
+    entry = cache_entry_path(cache_dir, key)
+    fanout = os.path.dirname(entry)
+    if not os.path.isdir(fanout):
+        os.makedirs(fanout)
+
+    # stage the entry next to its final location so the rename is atomic
+    tmp = tempfile.mkdtemp(prefix=".tmp-", dir=fanout)
+    names = []
+    for (src, name) in files:
+        if os.path.isfile(src):
+            shutil.copyfile(src, os.path.join(tmp, name))
+            names.append(name)
+    fid = open(os.path.join(tmp, "manifest"), "w")
+    fid.write("\n".join(names))
+    fid.close()
+
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # another build stored the same entry first
+        shutil.rmtree(tmp, True)
+
+    if max_size > 0:
+        cache_evict(cache_dir, max_size)
+    return
+# fed cache_store(cache_dir, key, files, max_size)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def cache_evict(cache_dir, max_size):
+    # removes least recently used entries until the cache fits in max_size
+    root = os.path.expanduser(cache_dir)
+    entries = []
+    total = 0
+    for fanout in os.listdir(root):
+        fanpth = os.path.join(root, fanout)
+        if not os.path.isdir(fanpth):
+            continue
+        for key in os.listdir(fanpth):
+            entry = os.path.join(fanpth, key)
+            if key.startswith(".tmp-") or not os.path.isdir(entry):
+                continue
+            size = 0
+            for name in os.listdir(entry):
+                size += os.path.getsize(os.path.join(entry, name))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+
+    entries.sort()
+    while total > max_size and entries:
+        (_, size, entry) = entries.pop(0)
+        shutil.rmtree(entry, True)
+        total -= size
+    return
+# fed cache_evict(cache_dir, max_size)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def build_digest(files, engine, flags):
+    # digest of everything that determines the output of a build: the
+    # contents of the input files, the engine and its flags
+    h = hashlib.sha1()
+    h.update(latexmake_version() + "\0")
+    h.update(engine + "\0")
+    h.update(" ".join(flags.split()) + "\0")
+    for f in sorted(unique(files)):
+        h.update(os.path.relpath(f) + "\0")
+        if os.path.isfile(f):
+            h.update(file_digest(f) + "\0")
+        else:
+            h.update("missing\0")
+    return h.hexdigest()
+# fed build_digest(files, engine, flags)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Content stamps
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+def stamp_name(stamp_dir, filename):
+    # the stamp of filename. Paths outside of the project are kept inside
+    # stamp_dir
+    pth = os.path.normpath(filename).lstrip(os.sep)
+    pth = os.sep.join([part.replace("..", "__") for part in pth.split(os.sep)])
+    return os.path.join(stamp_dir, pth + ".stamp")
+# fed stamp_name(stamp_dir, filename)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def update_stamp(stamp, filename):
+    # writes the digest of filename to stamp if its contents changed (the
+    # stamp keeps its mtime otherwise). Returns True if the stamp was written.
+    # Files whose size and mtime match the stamp are not hashed again
+    info = os.stat(filename)
+    quick = str(info.st_size) + " " + repr(info.st_mtime)
+    old = ""
+    if os.path.isfile(stamp):
+        fid = open(stamp, "r")
+        old = fid.read().split("\n")
+        fid.close()
+        if len(old) > 1 and old[1] == quick:
+            return False
+        old = old[0]
+
+    digest = file_digest(filename)
+    pth = os.path.dirname(stamp)
+    if pth and not os.path.isdir(pth):
+        os.makedirs(pth)
+    if digest == old:
+        # only remember the new mtime, keeping the stamp's mtime
+        stamp_time = os.stat(stamp)
+        fid = open(stamp, "w")
+        fid.write(digest + "\n" + quick + "\n")
+        fid.close()
+        os.utime(stamp, (stamp_time.st_atime, stamp_time.st_mtime))
+        return False
+    fid = open(stamp, "w")
+    fid.write(digest + "\n" + quick + "\n")
+    fid.close()
+    return True
+# fed update_stamp(stamp, filename)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def update_digest_stamp(stamp, digest):
+    # writes digest to stamp if it changed. Returns True if the stamp was
+    # written
+    if os.path.isfile(stamp):
+        fid = open(stamp, "r")
+        old = fid.read().strip()
+        fid.close()
+        if old == digest:
+            return False
+    pth = os.path.dirname(stamp)
+    if pth and not os.path.isdir(pth):
+        os.makedirs(pth)
+    fid = open(stamp, "w")
+    fid.write(digest + "\n")
+    fid.close()
+    return True
+# fed update_digest_stamp(stamp, digest)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Figure conversion
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+def converter_version(command):
+    # the first line of "command --version", or "" if it cannot be run
+    try:
+        proc = subprocess.Popen([command, "--version"], \
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+    except OSError:
+        return ""
+    return output.strip().split("\n")[0]
+# fed converter_version(command)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def run_figure_converter(source, target, epstopdf, ps2eps):
+    # converts an eps or ps figure to pdf. Returns the exit status
+    ext = os.path.splitext(source)[1].lower()
+    if ext == ".eps":
+        return subprocess.call([epstopdf, "--outfile=" + target, source])
+    elif ext == ".ps":
+        # ps -> eps -> pdf without an intermediate file
+        src = open(source, "rb")
+        dst = open(target, "wb")
+        try:
+            p1 = subprocess.Popen([ps2eps], stdin=src, stdout=subprocess.PIPE)
+            p2 = subprocess.Popen([epstopdf, "--filter"], stdin=p1.stdout, \
+                stdout=dst)
+            p1.stdout.close()
+            status = p2.wait()
+            return p1.wait() or status
+        finally:
+            src.close()
+            dst.close()
+    warning("Do not know how to convert \"" + source + "\"")
+    return 1
+# fed run_figure_converter(source, target, epstopdf, ps2eps)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def convert_figure(source, target, epstopdf="epstopdf", ps2eps="ps2eps", \
+    cache_dir="", cache_size=0):
+    # converts a figure, going through the figure cache when cache_dir is set
+    # the cache key is the source content and the converter version(s)
+    if not cache_dir:
+        return run_figure_converter(source, target, epstopdf, ps2eps)
+
+    ext = os.path.splitext(source)[1].lower()
+    key = hashlib.sha1()
+    key.update(file_digest(source))
+    key.update(ext)
+    key.update(converter_version(epstopdf))
+    if ext == ".ps":
+        key.update(converter_version(ps2eps))
+    key = key.hexdigest()
+
+    if cache_fetch(cache_dir, key, [(target, "figure.pdf")]):
+        return 0
+
+    status = run_figure_converter(source, target, epstopdf, ps2eps)
+    if status == 0:
+        cache_store(cache_dir, key, [(target, "figure.pdf")], cache_size)
+    return status
+# fed convert_figure(source, target, epstopdf, ps2eps, cache_dir, cache_size)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def converted_figure_name(figure, params):
+    # the name the epstopdf package gives a converted figure (its default
+    # suffix is -\\SourceExt-converted-to): figs/logo.eps is converted to
+    # figs/logo-eps-converted-to.pdf
+    (base, ext) = os.path.splitext(figure)
+    return base + "-" + ext[1:] + "-converted-to.pdf"
+# fed converted_figure_name(figure, params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def figures_to_convert(params):
+    # the figures that need converting before a pdf can be made
+    if params["tex_engine"] not in ["PDFLATEX", "LUALATEX"]:
+        return []
+    return [f for f in unique(params["fig_files"]) \
+        if os.path.splitext(f)[1].lower() in params["fig_convert_extensions"]]
+# fed figures_to_convert(params)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Bibliography subsets
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+def index_bib_file(bibfile):
+    # streams through a .bib file and returns an index of its entries:
+    # {"entries": {key: [offset, length, crossref]}, "always": [[offset,
+    # length], ...]}. "always" holds the @string and @preamble blocks, which
+    # every subset needs. Keys are lower case (bibtex ignores their case)
+    entry_regex = re.compile(r"\s*@\s*(\w+)\s*([{(])\s*([^,\s]*)")
+    crossref_regex = re.compile(r"crossref\s*=\s*[{\"]([^}\"]*)[}\"]", \
+        re.IGNORECASE)
+    entries = {}
+    always = []
+    start = -1
+    depth = 0
+    opener = "{"
+    closer = "}"
+    key = ""
+    kind = ""
+    crossref = ""
+    offset = 0
+    fid = open(bibfile, "rb")
+    for line in fid:
+        pos = 0
+        if start < 0:
+            match = entry_regex.match(line)
+            if not match:
+                offset += len(line)
+                continue
+            kind = match.group(1).lower()
+            key = match.group(3).strip().lower()
+            opener = match.group(2)
+            closer = {"{": "}", "(": ")"}[opener]
+            start = offset + line.find("@")
+            crossref = ""
+            depth = 0
+            pos = line.find(opener, line.find("@"))
+        if kind not in ["string", "preamble", "comment"] and not crossref:
+            match = crossref_regex.search(line)
+            if match:
+                crossref = match.group(1).strip().lower()
+
+        # only look at single characters on the line where the entry ends
+        rest = line[pos:]
+        if depth + rest.count(opener) - rest.count(closer) > 0:
+            depth += rest.count(opener) - rest.count(closer)
+            offset += len(line)
+            continue
+        for i in range(pos, len(line)):
+            if line[i] == opener:
+                depth += 1
+            elif line[i] == closer:
+                depth -= 1
+                if depth == 0:
+                    length = offset + i + 1 - start
+                    if kind in ["string", "preamble"]:
+                        always.append([start, length])
+                    elif kind != "comment" and key not in entries:
+                        entries[key] = [start, length, crossref]
+                    start = -1
+                    break
+        offset += len(line)
+    fid.close()
+    return {"entries": entries, "always": always}
+# fed index_bib_file(bibfile)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def bib_index(bibfile, index_dir):
+    # the index of bibfile, stored in index_dir and rebuilt when the size or
+    # mtime of bibfile change
+    info = os.stat(bibfile)
+    name = hashlib.sha1(os.path.abspath(bibfile)).hexdigest() + ".json"
+    indexfile = os.path.join(os.path.expanduser(index_dir), name)
+    if os.path.isfile(indexfile):
+        try:
+            fid = open(indexfile, "r")
+            index = json.load(fid)
+            fid.close()
+            if index["size"] == info.st_size and index["mtime"] == info.st_mtime:
+                return index
+        except (IOError, ValueError, KeyError):
+            pass
+
+    index = index_bib_file(bibfile)
+    index["size"] = info.st_size
+    index["mtime"] = info.st_mtime
+    try:
+        if not os.path.isdir(os.path.dirname(indexfile)):
+            os.makedirs(os.path.dirname(indexfile))
+        # rename, so concurrent builds never read half an index
+        (handle, tmp) = tempfile.mkstemp(dir=os.path.dirname(indexfile))
+        os.write(handle, json.dumps(index))
+        os.close(handle)
+        os.rename(tmp, indexfile)
+    except (IOError, OSError), e:
+        warning("could not write " + indexfile + " (" + str(e) + ")")
+    return index
+# fed bib_index(bibfile, index_dir)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def read_aux_citations(auxfile, citations=None, bibdata=None):
+    # the cited keys (lower case) and \\bibdata names of an aux file and the
+    # aux files it \\@input's
+    if citations is None:
+        citations = set()
+    if bibdata is None:
+        bibdata = []
+    if not os.path.isfile(auxfile):
+        return (citations, bibdata)
+    fid = open(auxfile, "r")
+    for line in fid:
+        if line.startswith("\\citation{"):
+            citations.update([key.strip().lower() for key in \
+                parse_data_in_squigly_braces(line)[0].split(",")])
+        elif line.startswith("\\bibdata{"):
+            bibdata += [name.strip() for name in \
+                parse_data_in_squigly_braces(line)[0].split(",")]
+        elif line.startswith("\\@input{"):
+            read_aux_citations(os.path.join(os.path.dirname(auxfile), \
+                parse_data_in_squigly_braces(line)[0]), citations, bibdata)
+    fid.close()
+    return (citations, bibdata)
+# fed read_aux_citations(auxfile, citations, bibdata)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_bib_subsets(auxfile, output_dir, index_dir):
+    # writes the entries cited in auxfile (and their crossref parents) of
+    # each \\bibdata file to output_dir, under the same name. A subset is only
+    # rewritten when it changes. Returns the number of subsets written
+    (citations, bibdata) = read_aux_citations(auxfile)
+    written = 0
+    for name in bibdata:
+        bibfile = name
+        if not bibfile.endswith(".bib"):
+            bibfile += ".bib"
+        subset = os.path.join(output_dir, bibfile)
+        if "*" in citations or os.path.isabs(bibfile) or \
+            bibfile.startswith("..") or not os.path.isfile(bibfile):
+            # \\nocite{*} or a file we can not shadow: use the original
+            if os.path.isfile(subset):
+                os.remove(subset)
+            continue
+
+        index = bib_index(bibfile, index_dir)
+        keys = []
+        todo = [key for key in citations if key in index["entries"]]
+        while todo:
+            key = todo.pop(0)
+            if key in keys or key not in index["entries"]:
+                continue
+            keys.append(key)
+            if index["entries"][key][2]:
+                todo.append(index["entries"][key][2])
+
+        blocks = sorted(index["always"] + [index["entries"][key][:2] \
+            for key in keys])
+        fid = open(bibfile, "rb")
+        output = ""
+        for (offset, length) in blocks:
+            fid.seek(offset)
+            output += fid.read(length) + "\n\n"
+        fid.close()
+
+        if os.path.isfile(subset):
+            fid = open(subset, "rb")
+            unchanged = fid.read() == output
+            fid.close()
+            if unchanged:
+                continue
+        if not os.path.isdir(os.path.dirname(subset)):
+            os.makedirs(os.path.dirname(subset))
+        fid = open(subset, "wb")
+        fid.write(output)
+        fid.close()
+        written += 1
+    return written
+# fed write_bib_subsets(auxfile, output_dir, index_dir)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Archives
+#
+#================================================================================
+
+
+# already compressed files are stored in zip archives as is
+archive_stored_extensions = [".pdf", ".png", ".jpg", ".jpeg", ".gif", ".gz", \
+    ".tgz", ".zip", ".bz2"]
+
+
+#-------------------------------------------------------------------------------
+def archive_texmf_readme(texmf_paths):
+    # the readme that goes with the texmf files of an archive
+    output = "This project contains files in a texmf directory.\n"
+    output += "These files should be placed in a texmf directory on your "
+    output += "machine.\n"
+    output += "The texmf directories on this machine are:\n"
+    for pth in texmf_paths:
+        output += "  " + pth + "\n"
+    return output
+# fed archive_texmf_readme(texmf_paths)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def archive_members(files, texmf_pkgs, texmf_paths):
+    # the (filename, arcname) pairs of an archive. Project files keep their
+    # relative path; files outside of the project (../shared/refs.bib) go
+    # under external/ (like the content stamps, .. becomes __); texmf packages
+    # go under texmf/ relative to their tree
+    members = []
+    for f in files:
+        if os.path.isfile(f):
+            arcname = os.path.normpath(os.path.relpath(f))
+            if arcname.split(os.sep)[0] == os.pardir:
+                arcname = os.path.join("external", os.sep.join([ \
+                    part.replace(os.pardir, "__") for part in \
+                    arcname.split(os.sep)]))
+            members.append((f, arcname))
+        elif f:
+            warning("Not archiving \"" + f + "\": file not found")
+
+    roots = [os.path.abspath(os.path.expanduser(pth)) for pth in texmf_paths]
+    for pkg in texmf_pkgs:
+        pkg = os.path.abspath(os.path.expanduser(pkg))
+        base = os.path.dirname(pkg)
+        for root in roots:
+            if pkg.startswith(root + os.sep):
+                base = root
+        for root, dirs, names in walk_tree(pkg, [".git"], [".DS_Store"]):
+            for name in names:
+                f = os.path.join(root, name)
+                members.append((f, os.path.join("texmf", \
+                    os.path.relpath(f, base))))
+    return members
+# fed archive_members(files, texmf_pkgs, texmf_paths)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_archive(output, fmt, members, readme=""):
+    # streams members (a list of (filename, arcname) pairs) into a zip or
+    # tar.gz archive. Files are read straight from their location; identical
+    # files are only stored once in tar archives (as hard links). Zip has no
+    # links, so zip members are not hashed
+    seen_names = set()
+    sizes = {}     # size -> [(filename, arcname)] of stored files
+    digests = {}   # digest -> arcname of stored files
+    hashed = set() # arcnames already in digests
+
+    if fmt == "zip":
+        archive = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED, True)
+    else:
+        archive = tarfile.open(output, "w:gz")
+
+    try:
+        if readme:
+            if fmt == "zip":
+                archive.writestr("texmf/readme", readme)
+            else:
+                info = tarfile.TarInfo("texmf/readme")
+                info.size = len(readme)
+                info.mtime = time.time()
+                archive.addfile(info, StringIO.StringIO(readme))
+
+        for (f, arcname) in members:
+            if arcname in seen_names:
+                continue
+            seen_names.add(arcname)
+
+            if fmt == "zip":
+                if os.path.splitext(f)[1].lower() in archive_stored_extensions:
+                    archive.write(f, arcname, zipfile.ZIP_STORED)
+                else:
+                    archive.write(f, arcname)
+                continue
+
+            # only hash files whose size matches an earlier file
+            size = os.path.getsize(f)
+            duplicate = None
+            if size in sizes:
+                digest = file_digest(f)
+                for (other, othername) in sizes[size]:
+                    if othername not in hashed:
+                        digests.setdefault(file_digest(other), othername)
+                        hashed.add(othername)
+                duplicate = digests.get(digest)
+                if not duplicate:
+                    digests[digest] = arcname
+                hashed.add(arcname)
+            sizes.setdefault(size, []).append((f, arcname))
+
+            if duplicate:
+                info = archive.gettarinfo(f, arcname)
+                info.type = tarfile.LNKTYPE
+                info.linkname = duplicate
+                info.size = 0
+                archive.addfile(info)
+            else:
+                archive.add(f, arcname)
+    finally:
+        archive.close()
+    return
+# fed write_archive(output, fmt, members, readme)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Running TeX (used by the generated build files)
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+def snapshot_files(files):
+    # the (digest, mtime) of each existing file in files
+    output = {}
+    for f in files:
+        if os.path.isfile(f):
+            output[f] = (file_digest(f), os.path.getmtime(f))
+    return output
+# fed snapshot_files(files)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def restore_unchanged_mtimes(snapshot, files):
+    # puts back the mtime of every file whose content did not change since
+    # snapshot, so make/ninja do not see it as updated. Python cannot set
+    # sub-second mtimes exactly, so changed files get whole-second mtimes
+    # that can be restored exactly the next time
+    for f in files:
+        if not os.path.isfile(f):
+            continue
+        if f in snapshot and file_digest(f) == snapshot[f][0]:
+            os.utime(f, (time.time(), snapshot[f][1]))
+        else:
+            os.utime(f, (time.time(), int(os.path.getmtime(f))))
+    return
+# fed restore_unchanged_mtimes(snapshot, files)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def run_preserving_mtimes(command, outputs, cwd=None):
+    # runs command; outputs whose content did not change keep their mtime
+    snapshot = snapshot_files(outputs)
+    status = subprocess.call(command, cwd=cwd)
+    restore_unchanged_mtimes(snapshot, outputs)
+    return status
+# fed run_preserving_mtimes(command, outputs, cwd)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def recorded_inputs(flsname, ignore):
+    # the project files a TeX run read, according to its -recorder file.
+    # Files the run also wrote, and files in ignore, are skipped
+    inputs = []
+    outputs = set()
+    if not os.path.isfile(flsname):
+        return inputs
+    cwd = os.path.abspath(".")
+    fid = open(flsname, "r")
+    for line in fid:
+        line = line.rstrip("\r\n")
+        if line.startswith("INPUT "):
+            inputs.append(line[6:])
+        elif line.startswith("OUTPUT "):
+            outputs.add(os.path.abspath(line[7:]))
+    fid.close()
+
+    output = []
+    for f in inputs:
+        absf = os.path.abspath(f)
+        if absf in outputs or absf in ignore or \
+            not absf.startswith(cwd + os.sep) or not os.path.isfile(absf):
+            continue
+        f = os.path.relpath(absf)
+        if f not in output:
+            output.append(f)
+    return output
+# fed recorded_inputs(flsname, ignore)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def tex_output_names(source, outdir, exts):
+    # the names of source's auxiliary files with the extensions in exts
+    return [os.path.join(outdir, source + "." + ext) for ext in exts]
+# fed tex_output_names(source, outdir, exts)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def run_tex_passes(engine, flags, source, outdir="", passes=1, \
+    keep=["aux"], depfile="", target="", subdirs=[]):
+    # runs the TeX engine on source up to passes times, stopping early once
+    # the aux file stops changing. Auxiliary files (keep) whose content is
+    # unchanged keep their mtime. If depfile is set, the files the run read
+    # are written to it as make-style dependencies of target
+    command = [engine] + flags.split() + ["-recorder"]
+    if outdir:
+        command.append("-output-directory=" + outdir)
+        # \\include'd files write their aux files in sub-directories
+        for pth in [outdir] + [os.path.join(outdir, d) for d in subdirs]:
+            if not os.path.isdir(pth):
+                os.makedirs(pth)
+    command.append(source + ".tex")
+
+    aux = tex_output_names(source, outdir, ["aux"])[0]
+    kept = tex_output_names(source, outdir, keep)
+    snapshot = snapshot_files(kept)
+
+    status = 0
+    for idx in range(0, passes):
+        if os.path.isfile(aux):
+            before = file_digest(aux)
+        else:
+            before = ""
+        status = subprocess.call(command)
+        if status != 0:
+            break
+        if os.path.isfile(aux) and file_digest(aux) == before:
+            # nothing left to resolve
+            break
+
+    restore_unchanged_mtimes(snapshot, kept)
+
+    if depfile:
+        fls = tex_output_names(source, outdir, ["fls"])[0]
+        ignore = set([os.path.abspath(f) for f in \
+            glob_source_outputs(source, outdir)])
+        fid = open(depfile, "w")
+        fid.write(target.replace(" ", "\\ ") + ":")
+        for f in recorded_inputs(fls, ignore):
+            fid.write(" \\\n  " + f.replace(" ", "\\ "))
+        fid.write("\n")
+        fid.close()
+    return status
+# fed run_tex_passes(engine, flags, source, outdir, passes, keep, depfile, ...)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def glob_source_outputs(source, outdir):
+    # every file named source.* in the output directory except the source.
+    # These are written by the engines, even if a run only read them
+    pth = outdir or "."
+    output = []
+    for name in os.listdir(pth):
+        if name.startswith(source + ".") and name != source + ".tex":
+            output.append(os.path.join(pth, name))
+    return output
+# fed glob_source_outputs(source, outdir)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def walk_tree(top, prune_dirs, prune_files, skipped=None):
+    # walks the directory tree below top like os.walk (top-down; dirs may be
+    # changed in place). Directories whose name matches a glob of prune_dirs,
+    # or whose absolute path is in prune_dirs, and files whose name matches a
+    # glob of prune_files are left out and counted in skipped. With the
+    # scandir package the types come from the directory entries, so nothing
+    # is stat'ed. Without it every entry is stat'ed (twice, isdir and islink)
+    # as os.walk does: only the pruning saves work then
+    if skipped is None:
+        skipped = {"dirs": 0, "files": 0}
+    stack = [top]
+    while stack:
+        root = stack.pop()
+        try:
+            if scandir:
+                entries = [(entry.name, entry.is_dir(), entry.is_symlink()) \
+                    for entry in scandir(root)]
+            else:
+                entries = []
+                for name in os.listdir(root):
+                    pth = os.path.join(root, name)
+                    entries.append((name, os.path.isdir(pth), \
+                        os.path.islink(pth)))
+        except OSError:
+            continue
+
+        dirs = []
+        files = []
+        links = []
+        for (name, is_dir, is_link) in entries:
+            if is_dir:
+                pth = os.path.abspath(os.path.join(root, name))
+                if pth in prune_dirs or [pattern for pattern in prune_dirs \
+                    if fnmatch.fnmatch(name, pattern)]:
+                    skipped["dirs"] += 1
+                    continue
+                dirs.append(name)
+                if is_link:
+                    links.append(name)
+            elif [pattern for pattern in prune_files \
+                if fnmatch.fnmatch(name, pattern)]:
+                skipped["files"] += 1
+            else:
+                files.append(name)
+
+        yield (root, dirs, files)
+
+        # like os.walk, symbolic links to directories are not followed
+        stack += [os.path.join(root, name) for name in reversed(dirs) \
+            if name not in links]
+    return
+# fed walk_tree(top, prune_dirs, prune_files, skipped)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def project_prune_dirs(params):
+    # the pruning rules of params, and the output and build state directories
+    return params["prune_dirs"] + [os.path.abspath(pth) for pth in \
+        [params["output_directory"], params["latexmake_dir"]] if pth]
+# fed project_prune_dirs(params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def walk_project(top, params):
+    # walk_tree with the pruning rules of the project
+    return walk_tree(top, project_prune_dirs(params), params["prune_files"], \
+        params["walk_skipped"])
+# fed walk_project(top, params)
+#-------------------------------------------------------------------------------
 
 
 #================================================================================
@@ -520,6 +1436,19 @@ def parse_data_in_angle_braces(line):
 #================================================================================
 
 
+#-------------------------------------------------------------------------------
+def add_dependency(params, dependency, kind, included_by):
+    # records an edge of the dependency graph
+    # kind: tex, sty, cls, bib, figure or texmf_package
+    # included_by: the file that pulled in the dependency (None for the root)
+    if included_by:
+        included_by = os.path.abspath(included_by)
+    params["dependencies"].append((os.path.abspath(dependency), kind, \
+        included_by))
+    return params
+# fed add_dependency(params, dependency, kind, included_by)
+#-------------------------------------------------------------------------------
+
 #-------------------------------------------------------------------------------
 def parse_comma_separated_data(line):
     tmp = line.split(",")
@@ -573,126 +1502,123 @@ def prepare_tex_file(tex_file, params, filename):
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
-def findClasses(tex_file, params, filename):
-    locs = params["documentclass_regex"].findall(tex_file)
-    classes = []
-    for latexclass in locs:
-        line = latexclass[-1]
-        line = parse_data_in_squigly_braces(line)[0]
-        # check to see if its local
-        # we need to also look for sty to deal with legacy code!
-        params = findLocalStyFiles(line, params, filename)
-        params = findLocalClsFiles(line, params, filename)
+def findClasses(match, params, filename):
+    # scanner of \\documentclass and \\LoadClass
+    line = match.groups()[-1]
+    line = parse_data_in_squigly_braces(line)[0]
+    # classes of the TeX distribution are neither local nor in texmf
+    if is_standard_file(line, params, "cls"):
+        return params
+
+    # check to see if its local
+    # we need to also look for sty to deal with legacy code!
+    params = findLocalStyFiles(line, params, filename)
+    params = findLocalClsFiles(line, params, filename)
 
-        # check to see if it is in the texmf path(s)
-        params = find_texmf_sty_files(line, params, filename)
-        params = find_texmf_cls_files(line, params, filename)
+    # check to see if it is in the texmf path(s)
+    params = find_texmf_sty_files(line, params, filename)
+    params = find_texmf_cls_files(line, params, filename)
     return params
-# fed findClasses(tex_file, params, filename)
+# fed findClasses(match, params, filename)
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
-def find_packages(tex_file, params, filename):
-    # TODO: also have this work with \RequirePackage
-
-    locs = params["usepackage_regex"].findall(tex_file)
+def find_packages(match, params, filename):
+    # scanner of \\usepackage and \\RequirePackage
+    latexpackage = match.groups()
     packages = []
-    for latexpackage in locs:
-        line = latexpackage[-1]
-        for part in parse_data_in_squigly_braces(line):
-            p = parse_comma_separated_data(part)
-            packages += p
-            for package in p:
-                # check to see if it is local
+    line = latexpackage[-1]
+    for part in parse_data_in_squigly_braces(line):
+        p = parse_comma_separated_data(part)
+        packages += p
+        for package in p:
+            # check to see if it is local (packages of the TeX
+            # distribution are neither local nor in texmf)
+            if not is_standard_file(package, params, "sty"):
                 params = findLocalStyFiles(package, params, filename)
                 params = find_texmf_sty_files(package, params, filename)
-                if package == "biblatex":
-                    # grab all of the optional arguments for biblatex
-                    option_str = latexpackage[1]
+            if package == "biblatex":
+                # grab all of the optional arguments for biblatex
+                option_str = latexpackage[1]
 
-                    if len(option_str) > 2:
-                        option_str = option_str[1:-1]
-                    else:
-                        break
-                    # get each option
-                    options = parse_comma_separated_data(option_str)
-                    # get all key=value options
-                    opts = [parse_equals(option) for option in options]
-
-                    backend = "bibtex"
-                    for opt in opts:
-                        if opt[0] == "backend":
-                            backend = opt[1]
-                            if backend == "biber":
-                                # use biber style bibliography search
-                                params["bibliography_regex"] = \
-                                params["biber_regex"]
-                    # ensure that the backend exists
-                    if function_exists(backend):
-                        params["bib_engine"] = backend.upper()
-                    else:
-                        warning("The bibliography backend \"" + backend + \
-                            "\" cannot be found")
+                if len(option_str) > 2:
+                    option_str = option_str[1:-1]
+                else:
+                    break
+                # get each option
+                options = parse_comma_separated_data(option_str)
+                # get all key=value options
+                opts = [parse_equals(option) for option in options]
+
+                backend = "bibtex"
+                for opt in opts:
+                    if opt[0] == "backend":
+                        backend = opt[1]
+                # ensure that the backend exists
+                if function_exists(backend):
+                    params["bib_engine"] = backend.upper()
+                else:
+                    warning("The bibliography backend \"" + backend + \
+                        "\" cannot be found")
 
-                elif package == "epstopdf":
-                    if params["tex_engine"] == "PDFLATEX":
-                        params["fig_extensions"].append(".eps")
+            elif package == "epstopdf":
+                if params["tex_engine"] == "PDFLATEX":
+                    params["fig_extensions"].append(".eps")
 
-                elif package == "makeidx":
-                    params["make_index_in_default"] = True
+            elif package == "makeidx":
+                params["make_index_in_default"] = True
 
-                # elif package == "glossaries":
-                #     params["make_glossary_in_default"] = True
+            # elif package == "glossaries":
+            #     params["make_glossary_in_default"] = True
 
     # update the packages list in params
     params["packages"] += packages
     return params
-# fed find_packages(tex_file, params)
-#-------------------------------------------------------------------------------
-
-#-------------------------------------------------------------------------------
-def find_graphics_paths(tex_file, params, filename):
-    # find all strings matching regex
-    locs = params["graphicspath_regex"].findall(tex_file)
-    # for each match
-    for line in locs:
-        # separate by sub squigly braces
-        for part in purify_list_of_strings(parse_data_in_squigly_braces(line), \
-            r"[\{\}]"):
-            if os.path.isdir(part) and os.path.exists(part):
-                # we are a valid path
-                if os.path.relpath(part) not in params["graphics_paths"]:
-                    # append to list of graphics paths
-                    params["graphics_paths"].append(os.path.relpath(part))
-                if os.path.relpath(part) not in params["sub_paths"]:
-                    # append to list of sub paths
-                    params["sub_paths"].append(os.path.relpath(part))
-            else:
-                #TODO?: raise exception
-                warning("In \"" + filename + "\": \"" + part + \
-                    "\" is not a valid graphicspath")
+# fed find_packages(match, params, filename)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def find_graphics_paths(match, params, filename):
+    # scanner of \\graphicspath
+    line = match.group(1)
+    # separate by sub squigly braces
+    for part in purify_list_of_strings(parse_data_in_squigly_braces(line), \
+        r"[\{\}]"):
+        if os.path.isdir(part) and os.path.exists(part):
+            # we are a valid path
+            if os.path.relpath(part) not in params["graphics_paths"]:
+                # append to list of graphics paths
+                params["graphics_paths"].append(os.path.relpath(part))
+            if os.path.relpath(part) not in params["sub_paths"]:
+                # append to list of sub paths
+                params["sub_paths"].append(os.path.relpath(part))
+        else:
+            #TODO?: raise exception
+            warning("In \"" + filename + "\": \"" + part + \
+                "\" is not a valid graphicspath")
     return params
-# fed find_graphics_paths(tex_file, params)
+# fed find_graphics_paths(match, params, filename)
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
-def find_graphics_extensions(tex_file, params, filename):
-    locs = params["graphicsextensions_regex"].findall(tex_file)
-    if not locs:
-        return params
-    for item in locs:
-        if parse_data_in_squigly_braces(item):
-            # residual squiglies
-            item = parse_data_in_squigly_braces(item)
-            params["fig_extensions"] = parse_comma_separated_data(item)
-            #TODO: check to see if I can have a .jpg if the g.e. is just .eps
+def find_graphics_extensions(match, params, filename):
+    # scanner of \\DeclareGraphicsExtensions
+    item = match.group(1)
+    if parse_data_in_squigly_braces(item):
+        # residual squiglies
+        item = parse_data_in_squigly_braces(item)
+        params["fig_extensions"] = parse_comma_separated_data(item)
+        #TODO: check to see if I can have a .jpg if the g.e. is just .eps
     return params
-# fed find_graphics_extensions(tex_file, params)
+# fed find_graphics_extensions(match, params, filename)
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
-def find_figure_path(figurefilename, params, filename):
+def find_figure_path(figurefilename, params, filename, extensions=None):
     # this will grab ALL figures of the desired name.
+    # extensions: the extensions to try (default: params["fig_extensions"])
+    if extensions is None:
+        extensions = params["fig_extensions"]
 
     files = []
 
@@ -706,7 +1632,7 @@ def find_figure_path(figurefilename, params, filename):
     # we did not find a match without extensions
     # search for a match with a graphics extension
     for pth in params["graphics_paths"]:
-        for ext in params["fig_extensions"]:
+        for ext in extensions:
             if os.path.isfile(os.path.join(pth, figurefilename + ext)):
                 params["fig_files"].append(os.path.join(pth, \
                     figurefilename + ext))
@@ -716,11 +1642,15 @@ def find_figure_path(figurefilename, params, filename):
         # try to grab a converted version (one *MIGHT* exist if the original
         # does not)
         for pth in params["graphics_paths"]:
-            for ext in params["figure_aux_extensions"]:
-                if os.path.isfile(os.path.join(pth, figurefilename + ext)):
-                    params["fig_files"].append(os.path.join(pth, \
-                        figurefilename + ext))
-                    files.append(os.path.join(pth, figurefilename + ext))
+            for ext in params["fig_convert_extensions"]:
+                f = converted_figure_name(os.path.join(pth, \
+                    figurefilename + ext), params)
+                if os.path.isfile(f):
+                    params["fig_files"].append(f)
+                    files.append(f)
+
+    for f in files:
+        params = add_dependency(params, f, "figure", filename)
 
     if not files:
         print "Figure '" + figurefilename + "' not found in the graphics paths"
@@ -728,123 +1658,504 @@ def find_figure_path(figurefilename, params, filename):
         params["duplicate_fig_files"].extend(files)
 
     return params
-# fed find_figure_path(filename, params)
+# fed find_figure_path(figurefilename, params, filename, extensions)
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
-def find_figures(tex_file, params, filename):
-    # TODO: also get pgf/tikz figures
-    m = params["includegraphics_regex"].findall(tex_file)
-    if not m:
-        return params
-
-    # get the figure path
-    for figure in m:
-        params = find_figure_path(figure[1], params, filename)
-
-    return params
-# fed find_figures(tex_file, params)
+def find_figures(match, params, filename):
+    # scanner of \\includegraphics and \\includepdf
+    return find_figure_path(match.groups()[-1], params, filename)
+# fed find_figures(match, params, filename)
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
-def find_sub_tex_files(tex_file, params, filename):
-    regexfound = params["included_regex"].findall(tex_file)
+def find_svg_figures(match, params, filename):
+    # scanner of \\includesvg (the svg package converts the svg itself)
+    return find_figure_path(match.groups()[-1], params, filename, [".svg"])
+# fed find_svg_figures(match, params, filename)
+#-------------------------------------------------------------------------------
 
-    for item in regexfound:
-        # the file is the last part of item
-        newfilename = item[-1]
+#-------------------------------------------------------------------------------
+def find_listings(match, params, filename):
+    # scanner of \\lstinputlisting: the listing is tracked, but not parsed
+    f = match.groups()[-1]
+    if not os.path.isfile(f):
+        if params["verbose"]:
+            warning("In \"" + filename + "\" listing Not Found: \"" + f + "\"")
+        return params
+    f = os.path.relpath(f)
+    params["tex_files"].append(f)
+    params["opaque_files"].append(f)
+    return add_dependency(params, f, "listing", filename)
+# fed find_listings(match, params, filename)
+#-------------------------------------------------------------------------------
 
-        # check that the file exists
-        f = None
-        if os.path.isfile(newfilename):
-            f = os.path.relpath(newfilename)
-        elif os.path.isfile(newfilename + ".tex"):
-            f = os.path.relpath(newfilename + ".tex")
-        elif params["verbose"]:
-            warning("In \"" + filename + \
-            "\" tex file Not Found: \"" + newfilename + "\"")
+#-------------------------------------------------------------------------------
+def find_bibliography_style(match, params, filename):
+    # scanner of \\bibliographystyle: a local .bst is a bibtex input. bibtex
+    # runs in the working directory and only loads the style from there or
+    # from BSTINPUTS
+    name = match.group(1).strip()
+    if not name.endswith(".bst"):
+        name += ".bst"
+    dirs = [""] + [d.rstrip("/") for d in \
+        os.environ.get("BSTINPUTS", "").split(os.pathsep) if d]
+    for d in dirs:
+        f = os.path.join(d, name)
+        if os.path.isfile(f):
+            return add_dependency(params, os.path.relpath(f), "bst", filename)
+    return params
+# fed find_bibliography_style(match, params, filename)
+#-------------------------------------------------------------------------------
 
-         # add f to list of files
-        if f:
-            params["tex_files"].append(f)
+#-------------------------------------------------------------------------------
+def find_beamer_themes(match, params, filename):
+    # scanner of \\usetheme, \\usecolortheme, ...: themes are the packages
+    # beamer<kind>theme<name>
+    for theme in parse_comma_separated_data(match.group(3)):
+        package = "beamer" + match.group(1) + "theme" + theme
+        if not is_standard_file(package, params, "sty"):
+            params = findLocalStyFiles(package, params, filename)
+            params = find_texmf_sty_files(package, params, filename)
+    return params
+# fed find_beamer_themes(match, params, filename)
+#-------------------------------------------------------------------------------
 
-            # get the path
-            (pth, _) = os.path.split(f)
+#-------------------------------------------------------------------------------
+def is_opaque_file(filename, params):
+    # checks if an included file is data that can not load packages, figures,
+    # etc. The file has to match opaque_extensions or opaque_globs, or be
+    # larger than opaque_size, and its first opaque_sniff_size bytes may not
+    # contain any commands of interest
+    candidate = os.path.splitext(filename)[1].lower() in \
+        params["opaque_extensions"]
+    for pattern in params["opaque_globs"]:
+        if fnmatch.fnmatch(filename, pattern):
+            candidate = True
+    if not candidate:
+        candidate = os.path.getsize(filename) >= params["opaque_size"]
+    if not candidate:
+        return False
 
-            if pth:
-                if os.path.relpath(pth) not in params["sub_paths"]:
-                    params["sub_paths"].append(os.path.relpath(pth))
+    fid = open(filename, "r")
+    head = fid.read(params["opaque_sniff_size"])
+    fid.close()
+    if params["interesting_regex"].search(head):
+        if params["verbose"]:
+            warning("\"" + filename + "\" looks like data, but is parsed")
+        return False
+    return True
+# fed is_opaque_file(filename, params)
+#-------------------------------------------------------------------------------
 
-            # parse the subfiles
-            params = parse_tex_file(f, params)
+#-------------------------------------------------------------------------------
+def find_tikz_externalize(match, params, filename):
+    # scanner of \\tikzexternalize[prefix=...]
+    params["tikz_externalize"] = True
+    for option in parse_comma_separated_data(match.group(1) or ""):
+        if option.find("=") >= 0:
+            (key, value) = parse_equals(option)
+            if key.strip() == "prefix":
+                params["tikz_prefix"] = value.strip().strip("{}")
+    return params
+# fed find_tikz_externalize(match, params, filename)
+#-------------------------------------------------------------------------------
 
+#-------------------------------------------------------------------------------
+def find_tikz_prefix(match, params, filename):
+    # scanner of \\tikzsetexternalprefix
+    params["tikz_prefix"] = match.group(1)
     return params
-# fed find_sub_tex_files(tex_file, params)
-#-------------------------------------------------------------------------------
-
-#-------------------------------------------------------------------------------
-def findBibliographies(tex_file, params, filename):
-    locs = params["bibliography_regex"].findall(tex_file)
-    for loc in locs:
-        parsed_squigly = parse_data_in_squigly_braces(loc)
-        for data_in_squigly in parsed_squigly:
-            bibs = parse_comma_separated_data(data_in_squigly)
-            for bib in bibs:
-                if os.path.isfile(bib):
-                    params["bib_files"].append(os.path.abspath(bib))
-                elif os.path.isfile(bib + ".bib"):
-                    params["bib_files"].append(os.path.abspath(bib + \
-                        ".bib"))
-                elif params["verbose"]:
-                    #TODO?: raise exception
-                    warning("In \"" + filename + \
-                        "\" bib file Not Found: \"" + bib + "\"")
-
-    if locs:
-        params["make_bib_in_default"] = True
+# fed find_tikz_prefix(match, params, filename)
+#-------------------------------------------------------------------------------
 
+#-------------------------------------------------------------------------------
+def find_tikz_figures(match, params, filename):
+    # names the pictures the tikz external library makes: the name set with
+    # \\tikzsetnextfilename, or prefix + jobname + "-figure" + number. The
+    # pictures are seen in document order, so the numbers match the library's.
+    # Pictures in the preamble, packages and macro definitions are not drawn
+    # where they are written, so they are not counted
+    command = match.group(1)
+    if command == "tikzsetnextfilename":
+        params["tikz_next_name"] = match.group(2)
+    elif command == "tikzexternaldisable":
+        params["tikz_disabled"] = True
+    elif command == "tikzexternalenable":
+        params["tikz_disabled"] = False
+    elif not params["tikz_disabled"] and params["in_document"] and \
+        not in_definition(match, params):
+        name = params["tikz_next_name"]
+        if not name:
+            name = params["basename"] + "-figure" + str(params["tikz_count"])
+            params["tikz_count"] += 1
+        code = tikz_picture_code(match.string, match.start())
+        params["tikz_figures"].append((name, os.path.relpath(filename), \
+            hashlib.sha1(code).hexdigest()))
+        params["tikz_next_name"] = ""
     return params
-# fed findBibliographies(tex_file, params, filename)
+# fed find_tikz_figures(match, params, filename)
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
-def find_glossary(tex_file, params, filename):
-    if "glossaries" not in params["packages"] and \
+def tikz_picture_code(text, start):
+    # the code of the picture at text[start]: \\begin{tikzpicture} ...
+    # \\end{tikzpicture}, \\tikz[...]{...} or \\tikz[...] ... ; (text may be
+    # a memory map, which has no startswith)
+    if text[start:start + len("\\begin")] == "\\begin":
+        end = text.find("\\end{tikzpicture}", start)
+        if end < 0:
+            return text[start:]
+        return text[start:end + len("\\end{tikzpicture}")]
+    idx = start + len("\\tikz")
+    while idx < len(text) and text[idx].isspace():
+        idx += 1
+    if text[idx:idx + 1] == "[":
+        idx = text.find("]", idx) + 1 or len(text)
+    while idx < len(text) and text[idx].isspace():
+        idx += 1
+    if text[idx:idx + 1] == "{":
+        return text[start:closing_brace(text, idx)]
+    return text[start:text.find(";", idx) + 1 or len(text)]
+# fed tikz_picture_code(text, start)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def in_definition(match, params):
+    # True if match is in the body of a \\newcommand, \\def, ... of its
+    # file. The bodies of the last file are kept in params["definitions"]
+    text = match.string
+    if params["definitions"][0] is not text:
+        params["definitions"] = (text, [(definition.start(), \
+            closing_brace(text, definition.end() - 1)) for definition in \
+            params["definition_regex"].finditer(text)])
+    for (start, end) in params["definitions"][1]:
+        if start < match.start() < end:
+            return True
+    return False
+# fed in_definition(match, params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def find_begin_document(match, params, filename):
+    # scanner of \\begin{document}: what follows is the document body
+    params["in_document"] = True
+    return params
+# fed find_begin_document(match, params, filename)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def find_sub_tex_files(match, params, filename):
+    # scanner of \\include and \\input. Files \\input'd by an \\import'ed
+    # file are relative to its directory
+    import_dir = params["import_dirs"].get(os.path.relpath(filename), "")
+    return add_sub_tex_file(match.group(2), params, filename, import_dir, \
+        match.group(1))
+# fed find_sub_tex_files(match, params, filename)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def find_imported_files(match, params, filename):
+    # scanner of the import package. \\import{dir}{file} is relative to the
+    # project, \\subimport{dir}{file} to the including file
+    import_dir = params["import_dirs"].get(os.path.relpath(filename), "")
+    if match.group(1).startswith("sub"):
+        pth = os.path.join(import_dir or \
+            os.path.dirname(os.path.relpath(filename)), match.group(2))
+    else:
+        pth = match.group(2)
+    return add_sub_tex_file(os.path.join(pth, match.group(3)), params, \
+        filename, pth)
+# fed find_imported_files(match, params, filename)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def add_sub_tex_file(newfilename, params, filename, import_dir="", \
+    command="input"):
+    # adds and parses a file included by filename. import_dir is the directory
+    # \\import'ed files are relative to, command is include or input
+    candidates = [newfilename, newfilename + ".tex"]
+    if import_dir and not newfilename.startswith(import_dir):
+        candidates += [os.path.join(import_dir, newfilename), \
+            os.path.join(import_dir, newfilename + ".tex")]
+
+    # check that the file exists
+    f = None
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            f = os.path.relpath(candidate)
+            break
+    if not f:
+        if params["verbose"]:
+            warning("In \"" + filename + \
+            "\" tex file Not Found: \"" + newfilename + "\"")
+        return params
+
+    # add f to list of files
+    params["tex_files"].append(f)
+    params = add_dependency(params, f, "tex", filename)
+    if command == "include" and f not in params["include_files"]:
+        params["include_files"].append(f)
+    if not params["in_document"] and f not in params["preamble_files"]:
+        params["preamble_files"].append(f)
+    if import_dir:
+        params["import_dirs"][f] = os.path.relpath(import_dir)
+
+    # get the path
+    (pth, _) = os.path.split(f)
+
+    if pth:
+        if os.path.relpath(pth) not in params["sub_paths"]:
+            params["sub_paths"].append(os.path.relpath(pth))
+
+    # parse the subfiles (data is only tracked for rebuilds)
+    if is_opaque_file(f, params):
+        params["opaque_files"].append(f)
+    else:
+        params = parse_tex_file(f, params)
+
+    return params
+# fed add_sub_tex_file(newfilename, params, filename, import_dir, command)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def findBibliographies(match, params, filename):
+    # scanner of \\bibliography and \\addbibresource
+    parsed_squigly = parse_data_in_squigly_braces(match.group(1))
+    for data_in_squigly in parsed_squigly:
+        bibs = parse_comma_separated_data(data_in_squigly)
+        for bib in bibs:
+            f = None
+            if os.path.isfile(bib):
+                f = os.path.abspath(bib)
+            elif os.path.isfile(bib + ".bib"):
+                f = os.path.abspath(bib + ".bib")
+            elif params["verbose"]:
+                #TODO?: raise exception
+                warning("In \"" + filename + \
+                    "\" bib file Not Found: \"" + bib + "\"")
+            if f:
+                params["bib_files"].append(f)
+                params = add_dependency(params, f, "bib", filename)
+
+    params["make_bib_in_default"] = True
+
+    return params
+# fed findBibliographies(match, params, filename)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def find_glossary(match, params, filename):
+    # scanner of \\makeglossaries
+    if "glossaries" not in params["packages"] and \
         "glossary" not in params["packages"]:
         # if glossary package is not defined, we cannot have a glossary
         return params
-    else:
-        key = re.compile(r"\\makeglossaries")
-        if key.search(tex_file):
-            params["make_glossary_in_default"] = True
+    params["make_glossary_in_default"] = True
     return params
-# fed find_glossary(tex_file, params, filename)
+# fed find_glossary(match, params, filename)
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
-def find_local_files_engine(key, params, filename, ext):
-    # the engine to find local sty or cls files
-    for root, dirs, files in os.walk(params["basepath"]):
-        if ".git" in dirs:
-            dirs.remove(".git")
-            # TODO: include other subfolder excludes
+def project_index(params):
+    # the files of the project by name (built once per scan). With
+    # --git-index they come from git, otherwise from walking the directories
+    if params["project_index"] is None:
+        params["project_index"] = {}
+        files = None
+        if params["use_git_index"]:
+            files = git_project_files(params)
+        if files is None:
+            files = []
+            for root, dirs, names in walk_project(params["basepath"], params):
+                files += [os.path.join(root, name) for name in names]
+                params["project_dirs"][os.path.abspath(root)] = \
+                    os.path.getmtime(root)
+        for f in files:
+            params["project_index"].setdefault(os.path.basename(f), \
+                []).append(os.path.abspath(f))
+            pth = os.path.dirname(os.path.abspath(f))
+            if pth not in params["project_dirs"]:
+                params["project_dirs"][pth] = os.path.getmtime(pth)
+    return params["project_index"]
+# fed project_index(params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def git_project_files(params):
+    # the files below params["basepath"] that git tracks, or that are
+    # untracked but not ignored, listed with a single git ls-files. The list
+    # is cached (in params["git_index_cache"]) for the mtime of the index
+    # (commits and checkouts rewrite it) and the mtimes of the directories
+    # (new untracked files). Returns None outside of git (the tree is walked)
+    if not params["git"]:
+        return None
+    basepath = params["basepath"]
+    try:
+        process = subprocess.Popen([params["git"], "rev-parse", \
+            "--git-dir"], cwd=basepath, stdout=subprocess.PIPE, \
+            stderr=subprocess.PIPE)
+        output = process.communicate()[0].strip()
+    except OSError:
+        return None
+    if process.returncode or not output:
+        return None
+    index = os.path.join(basepath, output, "index")
+    key = os.path.abspath(basepath)
+    if os.path.isfile(index):
+        key += " " + repr(os.path.getmtime(index))
+
+    cache_file = os.path.join(params["latexmake_dir"], \
+        params["git_index_cache"])
+    try:
+        fid = open(cache_file, "r")
+        cache = json.load(fid)
+        fid.close()
+        changed = [pth for pth in cache["dirs"] if not os.path.isdir(pth) \
+            or repr(os.path.getmtime(pth)) != cache["dirs"][pth]]
+        if cache["key"] == key and not changed:
+            return [f.encode("utf-8") for f in cache["files"]]
+    except (IOError, ValueError, KeyError):
+        pass
+
+    try:
+        process = subprocess.Popen([params["git"], "ls-files", "-z", \
+            "--cached", "--others", "--exclude-standard"], cwd=basepath, \
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+    except OSError:
+        return None
+    if process.returncode:
+        return None
+
+    # apply the pruning rules; tracked files may have been deleted
+    prune_dirs = project_prune_dirs(params)
+    files = []
+    dirs = {basepath: repr(os.path.getmtime(basepath))}
+    for name in unique([name for name in output.split("\0") if name]):
+        f = os.path.join(basepath, name)
+        parts = os.path.normpath(name).split(os.sep)
+        pruned = [part for part in parts[:-1] for pattern in prune_dirs \
+            if fnmatch.fnmatch(part, pattern)]
+        if pruned or [pth for pth in prune_dirs if \
+            os.path.abspath(f).startswith(pth + os.sep)]:
+            params["walk_skipped"]["files"] += 1
+            continue
+        if [pattern for pattern in params["prune_files"] \
+            if fnmatch.fnmatch(parts[-1], pattern)] or not os.path.isfile(f):
+            params["walk_skipped"]["files"] += 1
+            continue
+        files.append(os.path.normpath(f))
+        pth = os.path.dirname(os.path.normpath(f)) or basepath
+        if pth not in dirs:
+            dirs[pth] = repr(os.path.getmtime(pth))
+
+    try:
+        if not os.path.isdir(params["latexmake_dir"]):
+            os.makedirs(params["latexmake_dir"])
+        fid = open(cache_file, "w")
+        json.dump({"key": key, "dirs": dirs, "files": files}, fid)
+        fid.close()
+    except (IOError, OSError), e:
+        warning("could not write " + cache_file + " (" + str(e) + ")")
+    return files
+# fed git_project_files(params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def distribution_packages(params):
+    # the names of the sty and cls files shipped with the TeX distribution,
+    # read from its ls-R databases and cached per distribution version.
+    # Without a distribution, params["standard_packages"] is used
+    if params["distribution_packages"] is not None:
+        return params["distribution_packages"]
+
+    cache_file = os.path.expanduser(params["distribution_cache"])
+    version = kpsewhich_version(params)
+    cache = {}
+    try:
+        fid = open(cache_file, "r")
+        cache = json.load(fid)
+        fid.close()
+    except (IOError, ValueError):
+        pass
+
+    if version in cache:
+        names = set([name.encode("utf-8") for name in cache[version]])
+    else:
+        names = set()
+        for root in distribution_roots(params):
+            lsr = os.path.join(root, "ls-R")
+            if not os.path.isfile(lsr):
+                continue
+            fid = open(lsr, "r")
+            for line in fid:
+                line = line.rstrip("\n")
+                if line.endswith(".sty") or line.endswith(".cls"):
+                    names.add(line)
+            fid.close()
+        if names:
+            try:
+                if not os.path.isdir(os.path.dirname(cache_file)):
+                    os.makedirs(os.path.dirname(cache_file))
+                fid = open(cache_file, "w")
+                json.dump({version: sorted(names)}, fid)
+                fid.close()
+            except (IOError, OSError), e:
+                warning("could not write " + cache_file + " (" + str(e) + ")")
+
+    if not names:
+        names = set([name + ".sty" for name in params["standard_packages"]])
+        names.update([name + ".cls" for name in params["standard_classes"]])
+    params["distribution_packages"] = names
+    return names
+# fed distribution_packages(params)
+#-------------------------------------------------------------------------------
 
-        # set a dummy filename to None
-        f = None
+#-------------------------------------------------------------------------------
+def distribution_roots(params):
+    # the texmf trees of the TeX distribution (not the user's)
+    roots = []
+    if not params["kpsewhich"]:
+        return roots
+    for variable in ["TEXMFDIST", "TEXMFMAIN"]:
+        try:
+            process = subprocess.Popen([params["kpsewhich"], \
+                "-var-value=" + variable], stdout=subprocess.PIPE, \
+                stderr=subprocess.PIPE)
+            root = process.communicate()[0].strip()
+        except OSError:
+            continue
+        if root and root not in roots:
+            roots.append(root)
+    return roots
+# fed distribution_roots(params)
+#-------------------------------------------------------------------------------
 
-        # try to find the file
-        if key in files:
-            f = os.path.abspath(key)
-        elif key + "." + ext in files:
-            f = os.path.abspath(key + "." + ext)
+#-------------------------------------------------------------------------------
+def is_standard_file(key, params, ext):
+    # checks if a package or class comes with the TeX distribution and the
+    # project does not override it
+    name = key + "." + ext
+    if name not in distribution_packages(params):
+        return False
+    return name not in project_index(params) and \
+        key not in project_index(params)
+# fed is_standard_file(key, params, ext)
+#-------------------------------------------------------------------------------
 
+#-------------------------------------------------------------------------------
+def find_local_files_engine(key, params, filename, ext):
+    # the engine to find local sty or cls files
+    index = project_index(params)
+    for f in index.get(key, []) + index.get(key + "." + ext, []):
         # we found a local copy of the file
-        if f:
-            # append the file to the approprate list
-            params[ext + "_files"].append(f)
+        # append the file to the approprate list
+        params[ext + "_files"].append(f)
+        params = add_dependency(params, f, ext, filename)
 
-            #parse the included local style file
-            params = parse_tex_file(f, params)
+        #parse the included local style file
+        params = parse_tex_file(f, params)
 
     return params
 # fed find_local_files_engine(key, params, filename, ext)
@@ -867,9 +2178,8 @@ def check_texmf_files(key, params, filename, rootstr):
     # todo: allow for wildcard seraches
     if key not in params["texmf_exclude"]:
         filestr = os.path.join(rootstr, key)
-        # todo: verify that I need the next if statement
         if filestr not in params["texmf_files"]:
-            params["texmf_files"].append(rootstr)
+            params["texmf_files"].append(filestr)
 
     return params
 # fed check_texmf_files(key, params, filename, root, rootstr)
@@ -877,62 +2187,176 @@ def check_texmf_files(key, params, filename, rootstr):
 
 #-------------------------------------------------------------------------------
 def check_texmf_dirs(rootdir, params, filename, rootstr):
-    for root, dirs, files in os.walk(rootdir):
+    # adds the files below rootdir (rootstr in the Makefile)
+    for root, dirs, files in walk_tree(rootdir, params["prune_dirs"], \
+        params["prune_files"], params["walk_skipped"]):
+        pthstr = os.path.normpath(os.path.join(rootstr, \
+            os.path.relpath(root, rootdir)))
         for f in files:
-            params = check_texmf_files(os.path.join(rootdir, f), params, \
-                filename, rootstr)
-        for d in dirs:
-            params = check_texmf_dirs(os.path.join(rootdir, d), params, \
-                filename, os.path.join(rootstr, d))
+            params = check_texmf_files(f, params, filename, pthstr)
     return params
-# fed check_texmf_dirs(rootdir, params, filename, root, rootstr)
+# fed check_texmf_dirs(rootdir, params, filename, rootstr)
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
 def findTexmfFilesEngine(key, params, filename, ext):
-    texmf_ct = 0
-    for basepath in params["texmf_path"]:
-        for root, dirs, files in os.walk(os.path.expanduser(basepath)):
-            if ".git" in dirs:
-                dirs.remove(".git")
-                # TODO: include other subfolder excludes
-
-            # set a dummy filename to None
-            f = None
-
-            # try to find the file
-            if key in files:
-                f = os.path.abspath(key)
-            elif key + "." + ext in files:
-                f = os.path.abspath(key + "." + ext)
-
-            # we found a local copy of the file
-            if f:
-                # parse the latex_file
-                # params = parse_tex_file(f, params)
-
-                # search for and add the texmf files
-                relpth = os.path.relpath(root, os.path.expanduser(basepath))
-                pthstr = os.path.join("${TEXMF_PATH" + str(texmf_ct) + "}", \
-                    relpth)
+    # queues the lookup of a package or class. All lookups are resolved at
+    # once by resolve_texmf_files after the scan
+    if (key, ext, filename) not in params["texmf_lookups"]:
+        params["texmf_lookups"].append((key, ext, filename))
+    return params
+# fed findTexmfFilesEngine(key, params, filename, ext)
+#-------------------------------------------------------------------------------
 
-                params["texmf_pkg_pth"].append(pthstr)
+#-------------------------------------------------------------------------------
+def add_texmf_package(path, params, filename):
+    # adds the directory of a package or class found in one of the texmf paths
+    # (and everything below it) to the files shipped with archives
+    root = os.path.dirname(os.path.abspath(path))
+    for texmf_ct in range(0, len(params["texmf_path"])):
+        basepath = os.path.abspath(os.path.expanduser( \
+            params["texmf_path"][texmf_ct]))
+        if root != basepath and not root.startswith(basepath + os.sep):
+            continue
+
+        relpth = os.path.relpath(root, basepath)
+        pthstr = os.path.join("${TEXMF_PATH" + str(texmf_ct) + "}", relpth)
+        if pthstr in params["texmf_pkg_pth"]:
+            return params
+        params["texmf_pkg_pth"].append(pthstr)
+        params = add_dependency(params, root, "texmf_package", filename)
+        return check_texmf_dirs(root, params, filename, pthstr)
+    return params
+# fed add_texmf_package(path, params, filename)
+#-------------------------------------------------------------------------------
 
-                # check any sub-directories
-                for pth in dirs:
-                    params = check_texmf_dirs(os.path.join(root, pth), \
-                        params, filename, pthstr)
+#-------------------------------------------------------------------------------
+def kpsewhich_version(params):
+    # identifies the TeX distribution the resolver cache is valid for
+    if params["kpsewhich"]:
+        try:
+            process = subprocess.Popen([params["kpsewhich"], "--version"], \
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            version = process.communicate()[0].split("\n")[0].strip()
+        except OSError:
+            version = ""
+    else:
+        version = "ls-R"
+    for basepath in params["texmf_path"]:
+        lsr = os.path.join(os.path.expanduser(basepath), "ls-R")
+        version += " " + basepath
+        if os.path.isfile(lsr):
+            version += ":" + str(int(os.path.getmtime(lsr)))
+    return version
+# fed kpsewhich_version(params)
+#-------------------------------------------------------------------------------
 
-                # check any sub-files
-                for tmp in files:
-                    params = check_texmf_files(os.path.join(root, tmp), \
-                        params, filename, pthstr)
+#-------------------------------------------------------------------------------
+def run_kpsewhich(names, params):
+    # resolves file names with a single kpsewhich call. kpsewhich only prints
+    # the files it finds
+    found = {}
+    if not params["kpsewhich"] or not names:
+        return found
+    try:
+        process = subprocess.Popen([params["kpsewhich"]] + names, \
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+    except OSError, e:
+        warning("kpsewhich failed (" + str(e) + ")")
+        return found
+    for line in output.split("\n"):
+        line = line.strip()
+        if line and os.path.basename(line) in names:
+            found[os.path.basename(line)] = line
+    return found
+# fed run_kpsewhich(names, params)
+#-------------------------------------------------------------------------------
 
-        texmf_ct += 1
+#-------------------------------------------------------------------------------
+def read_ls_r(names, params):
+    # finds file names in the ls-R databases of the texmf paths (walking trees
+    # without one)
+    found = {}
+    for basepath in params["texmf_path"]:
+        basepath = os.path.expanduser(basepath)
+        lsr = os.path.join(basepath, "ls-R")
+        if os.path.isfile(lsr):
+            # ls-R lists "./dir:" followed by the entries of dir
+            directory = basepath
+            fid = open(lsr, "r")
+            for line in fid:
+                line = line.rstrip("\n")
+                if line.endswith(":"):
+                    directory = os.path.join(basepath, line[:-1])
+                elif line in names and line not in found:
+                    found[line] = os.path.normpath(os.path.join(directory, \
+                        line))
+            fid.close()
+        else:
+            for root, dirs, files in walk_tree(basepath, \
+                params["prune_dirs"], params["prune_files"], \
+                params["walk_skipped"]):
+                for name in names:
+                    if name in files and name not in found:
+                        found[name] = os.path.join(root, name)
+    return found
+# fed read_ls_r(names, params)
+#-------------------------------------------------------------------------------
 
+#-------------------------------------------------------------------------------
+def resolve_texmf_files(params):
+    # resolves the queued package and class lookups: from the resolver cache,
+    # then with one kpsewhich call, then from the ls-R databases
+    names = unique([key + "." + ext for (key, ext, _) in \
+        params["texmf_lookups"]])
+    if not names:
+        return params
 
+    # names resolved earlier in this run (by another root document)
+    resolved = params["texmf_resolved"]
+    missing = [name for name in names if name not in resolved or \
+        not os.path.isfile(resolved[name])]
+    if missing:
+        cache_file = os.path.expanduser(params["kpsewhich_cache"])
+        version = kpsewhich_version(params)
+        cache = {}
+        try:
+            fid = open(cache_file, "r")
+            cache = json.load(fid)
+            fid.close()
+        except (IOError, ValueError):
+            pass
+        for (name, path) in cache.get(version, {}).items():
+            resolved[name.encode("utf-8")] = path.encode("utf-8")
+
+        # cached paths are trusted as long as they exist
+        missing = [name for name in names if name not in resolved or \
+            not os.path.isfile(resolved[name])]
+    if missing:
+        found = run_kpsewhich(missing, params)
+        missing = [name for name in missing if name not in found]
+        if missing:
+            found.update(read_ls_r(missing, params))
+        resolved.update(found)
+
+        # remember the result for the next run with this distribution
+        cache = {version: resolved}
+        try:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            fid = open(cache_file, "w")
+            json.dump(cache, fid)
+            fid.close()
+        except (IOError, OSError), e:
+            warning("could not write " + cache_file + " (" + str(e) + ")")
+
+    for (key, ext, filename) in params["texmf_lookups"]:
+        name = key + "." + ext
+        if name in resolved:
+            params = add_texmf_package(resolved[name], params, filename)
     return params
-# fed findTexmfFilesEngine(key, params, filename, ext)
+# fed resolve_texmf_files(params)
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
@@ -949,51 +2373,208 @@ def find_texmf_sty_files(styname, params, filename):
 
 
 #-------------------------------------------------------------------------------
-def parse_tex_file(filename, params):
-    fid = open(filename, "r")
-    if fid < 0:
+def expand_macros(tex_file, params):
+    # adds the argument-less macros defined in tex_file to params["macros"]
+    # and expands every known macro, so the extractors see literal paths
+    for (name, value) in params["newcommand_regex"].findall(tex_file):
+        params["macros"][name] = value.strip()
+    if not params["macros"]:
+        return tex_file
+
+    # macros may be defined with other macros
+    key = re.compile(r"\\(" + "|".join([re.escape(name) for name in \
+        sorted(params["macros"], key=len, reverse=True)]) + \
+        r")(?![a-zA-Z@])(\{\})?")
+    for _ in range(0, params["max_macro_depth"]):
+        expanded = key.sub(lambda match: params["macros"][match.group(1)], \
+            tex_file)
+        if expanded == tex_file:
+            break
+        tex_file = expanded
+    return tex_file
+# fed expand_macros(tex_file, params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def snippet_end(text, match, params):
+    # the end of the command at match: its [...] and {...} arguments (and,
+    # for definitions, the macro name and parameters), or the whole picture
+    # of \\begin{tikzpicture} and \\tikz. text may be a memory map
+    if match.group(1) in ["begin{tikzpicture}", "tikz"]:
+        return match.start() + len(tikz_picture_code(text, match.start()))
+    idx = match.end()
+    braced = False
+    while idx < len(text):
+        char = text[idx]
+        if char.isspace() or char == "*":
+            idx += 1
+        elif char == "[":
+            idx = text.find("]", idx) + 1 or len(text)
+        elif char == "{":
+            idx = closing_brace(text, idx)
+            braced = True
+        elif match.group(1) in params["macro_commands"] and not braced and \
+            char in "\\#":
+            idx += 1
+            while idx < len(text) and (text[idx].isalnum() or text[idx] == "@"):
+                idx += 1
+        else:
+            break
+    return idx
+# fed snippet_end(text, match, params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def interesting_snippets(text, params):
+    # the text around the commands the extractors look for. Each snippet
+    # starts at the beginning of its line (so comments are still removed) and
+    # runs to the end of the command's arguments (see snippet_end)
+    snippets = []
+    end = 0
+    for match in params["interesting_regex"].finditer(text):
+        if match.start() < end:
+            continue
+        start = max(text.rfind("\n", 0, match.start()) + 1, end)
+        end = snippet_end(text, match, params)
+        snippets.append(text[start:end])
+    return "\n".join(snippets)
+# fed interesting_snippets(text, params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def read_tex_file(filename, params):
+    # reads a TeX file to be parsed: only the snippets around commands of
+    # interest are kept, so prepare_tex_file and the scanners do not go over
+    # the text. Files larger than params["large_file_size"] are memory mapped
+    try:
+        fid = open(filename, "r")
+    except IOError:
         raise latexmake_nonexistantFile(filename)
 
-    tex_file = fid.read()
-    fid.close()
+    try:
+        size = os.fstat(fid.fileno()).st_size
+        if size < params["large_file_size"]:
+            return interesting_snippets(fid.read(), params)
+        try:
+            data = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError), e:
+            warning("could not map " + filename + " (" + str(e) + ")")
+            return interesting_snippets(fid.read(), params)
+        try:
+            return interesting_snippets(data, params)
+        finally:
+            data.close()
+    finally:
+        fid.close()
+# fed read_tex_file(filename, params)
+#-------------------------------------------------------------------------------
 
-    # TODO: look for latexmk directives here
+#-------------------------------------------------------------------------------
+def register_scanner(params, commands, regex, handler):
+    # adds a dependency scanner: handler(match, params, filename) is called
+    # with the match of regex at each of the commands (names without the
+    # backslash) and returns params. One command has one scanner
+    for command in commands:
+        params["scanners"][command] = (regex, handler)
+    params["scanner_regex"] = None
+    return params
+# fed register_scanner(params, commands, regex, handler)
+#-------------------------------------------------------------------------------
 
-    # prepare the TeX file. (remove comments)
-    tex_file = prepare_tex_file(tex_file, params, filename)
+#-------------------------------------------------------------------------------
+def compile_scanners(params):
+    # builds the regex matching every registered command, and the regex of
+    # the commands the scan cares about (the scanners and macro definitions)
+    commands = sorted(params["scanners"].keys(), key=len, reverse=True)
+    restr = r"\\(" + "|".join([re.escape(command) for command in commands]) + \
+        r")(?![a-zA-Z@])"
+    params["scanner_regex"] = re.compile(restr)
+    commands += params["macro_commands"]
+    params["interesting_regex"] = re.compile(r"\\(" + \
+        "|".join([re.escape(command) for command in commands]) + \
+        r")(?![a-zA-Z@])")
+    return params
+# fed compile_scanners(params)
+#-------------------------------------------------------------------------------
 
-    # attempt to use existing code to read multiline \usepackages
-    #tex_file = " ".join(tex_file.split("\n"))
+#-------------------------------------------------------------------------------
+def scanner_hits(tex_file, params):
+    # scans tex_file once, in document order, for the registered commands.
+    # Returns the (handler, match) of each
+    if params["scanner_regex"] is None:
+        params = compile_scanners(params)
+    hits = []
+    for match in params["scanner_regex"].finditer(tex_file):
+        (regex, handler) = params["scanners"][match.group(1)]
+        full = regex.match(tex_file, match.start())
+        if full:
+            hits.append((handler, full))
+    return hits
+# fed scanner_hits(tex_file, params)
+#-------------------------------------------------------------------------------
 
-    # search for classes
-    params = findClasses(tex_file, params, filename)
+#-------------------------------------------------------------------------------
+def run_scanners(tex_file, params, filename):
+    # hands each registered command in tex_file to its scanner
+    for (handler, match) in scanner_hits(tex_file, params):
+        params = handler(match, params, filename)
+    return params
+# fed run_scanners(tex_file, params, filename)
+#-------------------------------------------------------------------------------
 
-    # search for packages
-    params = find_packages(tex_file, params, filename)
+#-------------------------------------------------------------------------------
+def parse_tex_file(filename, params):
+    # files are read and scanned once per version and set of known macros
+    # (params["parse_cache"] is shared by the root documents, see
+    # latexmake_scan). The scanners still run for every root
+    info = os.stat(filename)
+    key = (os.path.abspath(filename), info.st_mtime, info.st_size, \
+        tuple(sorted(params["macros"].items())))
+    if key in params["parse_cache"]:
+        (hits, macros) = params["parse_cache"][key]
+        params["macros"].update(macros)
+        for (handler, match) in hits:
+            params = handler(match, params, filename)
+        return params
 
-    # find graphics paths
-    params = find_graphics_paths(tex_file, params, filename)
+    tex_file = read_tex_file(filename, params)
 
-    # search for Graphics Extensions
-    params = find_graphics_extensions(tex_file, params, filename)
+    # TODO: look for latexmk directives here
 
-    # search for figures
-    params = find_figures(tex_file, params, filename)
+    # prepare the TeX file. (remove comments)
+    tex_file = prepare_tex_file(tex_file, params, filename)
 
-    # search for bibliographies
-    params = findBibliographies(tex_file, params, filename)
+    # resolve \\newcommand'ed paths once for all of the extractors
+    tex_file = expand_macros(tex_file, params)
 
-    # search to see if we are makeing a glossary
-    params = find_glossary(tex_file, params, filename)
+    # attempt to use existing code to read multiline \usepackages
+    #tex_file = " ".join(tex_file.split("\n"))
 
-    # search for included tex files
-    params = find_sub_tex_files(tex_file, params, filename)
+    # find the classes, packages, figures, bibliographies, included files, ...
+    hits = scanner_hits(tex_file, params)
+    params["parse_cache"][key] = (hits, dict(params["macros"]))
+    for (handler, match) in hits:
+        params = handler(match, params, filename)
 
     return params
 
 # fed parse_tex_file(file)
 #-------------------------------------------------------------------------------
 
+#-------------------------------------------------------------------------------
+def structure_fingerprint(filename, params):
+    # the digest of the dependency-bearing commands of filename (what the
+    # scanners and expand_macros look at). Edits of the text leave it as is
+    tex_file = prepare_tex_file(read_tex_file(filename, params), params, \
+        filename)
+    commands = [match.group(0) for match in \
+        params["newcommand_regex"].finditer(tex_file)]
+    commands += [match.group(0) for (_, match) in \
+        scanner_hits(tex_file, params)]
+    return hashlib.sha1("\n".join(commands)).hexdigest()
+# fed structure_fingerprint(filename, params)
+#-------------------------------------------------------------------------------
+
 
 #================================================================================
 #
@@ -1040,9 +2621,46 @@ def latexmake_default_params():
     params["make_glossary_in_default"] = False
     params["basename"] = ""
     params["basepath"] = os.path.abspath(".")
+    params["output_directory"] = "" # build next to the sources
+    params["backend"] = "make" # or ninja
+    params["latexmake_dir"] = ".latexmake" # build state
+    params["max_passes"] = 3 # TeX passes after the bibliography etc.
+    params["emit_json"] = "" # where to write the dependency graph
+    params["emit_dot"] = ""
     params["tex_files"] = []
     params["fig_files"] = []
     params["duplicate_fig_files"] = []
+    params["dependencies"] = [] # (file, type, included by) edges
+    params["large_file_size"] = 16 * 1048576 # larger files are memory mapped
+    # \\input'd data files (tables, coordinates) are tracked but not parsed
+    params["opaque_extensions"] = [".dat", ".csv", ".tsv"]
+    params["opaque_globs"] = []
+    params["opaque_size"] = 4 * 1048576 # larger files are data, unless...
+    params["opaque_sniff_size"] = 65536 # ...their start has commands
+    params["opaque_files"] = []
+    params["macros"] = {} # argument-less macros, see expand_macros
+    params["max_macro_depth"] = 8 # nested macro expansions
+    params["import_dirs"] = {} # \\import'ed file: its directory
+    params["include_files"] = [] # \\include'd files (see make quick)
+    params["preamble_files"] = [] # files \\input before \\begin{document}
+    params["in_document"] = False # \\begin{document} was scanned
+    params["definitions"] = (None, []) # see in_definition
+    params["tikz_externalize"] = False # \\tikzexternalize was found
+    params["tikz_prefix"] = ""
+    params["tikz_figures"] = [] # (name, file with the picture, code digest)
+    params["tikz_count"] = 0 # pictures named by number
+    params["tikz_disabled"] = False # \\tikzexternaldisable
+    params["tikz_next_name"] = "" # set by \\tikzsetnextfilename
+    params["scanners"] = {} # command: (regex, handler), see register_scanner
+    params["scanner_regex"] = None
+    params["parse_cache"] = {} # file version: scanner hits, see parse_tex_file
+    params["texmf_resolved"] = {} # name: path, see resolve_texmf_files
+    # caches the root documents of one run share (see latexmake_scan)
+    params["shared_params"] = ["parse_cache", "project_index", \
+        "project_dirs", "distribution_packages", "texmf_resolved"]
+    # commands the scan cares about besides the scanners (see expand_macros)
+    params["macro_commands"] = ["newcommand", "renewcommand", \
+        "providecommand", "def"]
     params["bib_files"] = []
     params["sty_files"] = []
     params["cls_files"] = []
@@ -1059,6 +2677,45 @@ def latexmake_default_params():
     params["texmf_files"] = []
     params["texmf_pkg_pth"] = []
     params["texmf_exclude"] = [".DS_Store"]
+    params["texmf_lookups"] = [] # (name, extension, included by)
+    params["kpsewhich_cache"] = "~/.latexmake/kpsewhich.json"
+    params["project_index"] = None # file name: paths, see project_index
+    params["project_dirs"] = {} # directory: mtime when it was indexed
+    # directories (names or globs) the file system walks leave out
+    params["prune_dirs"] = [".git", ".svn", ".hg", "CVS", "node_modules", \
+        "_minted-*", "__pycache__"]
+    params["walk_skipped"] = {"dirs": 0, "files": 0} # see walk_tree
+    params["argv"] = [] # the arguments the Makefile is regenerated with
+    params["use_git_index"] = False # list the project files with git
+    params["git_index_cache"] = "gitindex.json" # in latexmake_dir
+    params["distribution_packages"] = None # see distribution_packages
+    params["distribution_cache"] = "~/.latexmake/distribution.json"
+    # packages and classes assumed to be part of any TeX distribution
+    params["standard_packages"] = ["amsmath", "amssymb", "amsthm", \
+        "amsfonts", "graphicx", "graphics", "color", "xcolor", "hyperref", \
+        "geometry", "fontenc", "inputenc", "babel", "booktabs", "array", \
+        "tabularx", "longtable", "multirow", "caption", "subcaption", \
+        "float", "url", "natbib", "biblatex", "makeidx", "glossaries", \
+        "listings", "verbatim", "fancyhdr", "setspace", "enumitem", \
+        "tikz", "pgfplots", "siunitx", "microtype", "lmodern", "times", \
+        "epstopdf", "ifthen", "calc", "xspace", "latexsym", "textcomp"]
+    params["standard_classes"] = ["article", "report", "book", "letter", \
+        "beamer", "memoir", "amsart", "scrartcl", "scrreprt", "scrbook"]
+
+    # converted figures are shared between projects through this cache
+    params["fig_cache_dir"] = "~/.latexmake/figcache"
+    params["fig_cache_size"] = 512 # in MB
+
+    # whole documents are shared between identical builds through this cache
+    params["use_build_cache"] = False
+
+    # bibtex only reads the cited entries of the .bib files
+    params["trim_bibliography"] = False
+    params["bib_index_dir"] = "~/.latexmake/bibindex"
+    params["build_cache_dir"] = "~/.latexmake/buildcache"
+    params["build_cache_size"] = 2048 # in MB
+    params["build_cache_extensions"] = ["aux", "bbl", "toc", "lof", "lot", \
+        "out", "ind", "gls", "acr", "nav", "snm", "synctex.gz"]
 
     params["has_latexpand"] = function_exists("latexpand")
     if params["has_latexpand"]:
@@ -1080,6 +2737,12 @@ def latexmake_default_params():
     else:
         params["bibsort"] = ""
 
+    # kpsewhich resolves packages and classes (ls-R files otherwise)
+    if function_exists("kpsewhich"):
+        params["kpsewhich"] = "kpsewhich"
+    else:
+        params["kpsewhich"] = ""
+
     params["has_latexdiff"] = function_exists("latexdiff")
     if params["has_latexdiff"]:
         params["latexdiff"] = "latexdiff"
@@ -1182,6 +2845,7 @@ def latexmake_default_params():
     params["bib_aux_extensions"] = [".bbl", ".blg", ".bcf", ".run.xml", \
         "-blx.bib"]
     params["figure_aux_extensions"] = ["-converted-to.pdf"]
+    params["fig_convert_extensions"] = [".eps", ".ps"]
     params["idx_aux_extensions"] = [".ilg", ".ind"]
     params["latexmk_aux_extensions"] = [".fdb_latexmk", ".fls"]
     params["glossary_aux_extensions"] = [".acn", ".acr", ".alg", ".glg", \
@@ -1200,6 +2864,10 @@ def latexmake_default_params():
     params["idx_aux_extensions"] + params["pkg_aux_extensions"] + \
     params["glossary_aux_extensions"]
 
+    # files (globs) the file system walks leave out
+    params["prune_files"] = ["*" + ext for ext in \
+        params["clean_aux_extensions"]]
+
 
     # regex stuff
 
@@ -1236,6 +2904,35 @@ def latexmake_default_params():
     restr_include = r"\\(include|input)\{(" + restr_pth + r")\}"
     restr_bibtex = r"\\bibliography(\{" + restr_commadirs + r"\})"
     restr_biber = r"\\addbibresource(\{" + restr_commadirs + r"\})"
+    restr_glossary = r"\\makeglossaries"
+    restr_includepdf = r"\\includepdf(\[" + restr_option + \
+        r"\])?\s*\{(" + restr_pth + r")\}"
+    restr_includesvg = r"\\includesvg(\[" + restr_option + \
+        r"\])?\s*\{(" + restr_pth + r")\}"
+    restr_lstinputlisting = r"\\lstinputlisting(\[[^\]]*\])?\s*\{(" + \
+        restr_pth + r")\}"
+    restr_bibliographystyle = r"\\bibliographystyle\{(" + restr_pth + r")\}"
+    restr_beamertheme = r"\\use(color|font|inner|outer|)theme(\[" + \
+        restr_option + r"\])?\{(" + restr_comma + r")\}"
+    # the tikz external library
+    restr_tikzexternalize = r"\\tikzexternalize(?:\[([^\]]*)\])?"
+    restr_tikzprefix = r"\\tikzsetexternalprefix\{([^}]*)\}"
+    restr_tikzpicture = r"\\(tikzsetnextfilename|tikzexternaldisable|" + \
+        r"tikzexternalenable|begin\{tikzpicture\}|tikz)(?![a-zA-Z])" + \
+        r"(?:\{([^}]*)\})?"
+    # the import package
+    restr_import = r"\\(import|subimport|inputfrom|subinputfrom|" + \
+        r"includefrom|subincludefrom)\*?\{(" + restr_pth + r")\}\{(" + \
+        restr_pth + r")\}"
+    # the start of the document body
+    restr_begindocument = r"\\begin\{document\}"
+    # the bodies of macro definitions (up to the opening brace)
+    restr_definition = r"\\(?:(?:re|provide|new)command\*?\s*\{?\\" + \
+        r"[a-zA-Z@]+\}?\s*(?:\[[^\]]*\]\s*)*|[egx]?def\s*\\[a-zA-Z@]+" + \
+        r"[^{]*)\{"
+    # macros without arguments (possibly used in paths)
+    restr_newcommand = r"\\(?:(?:re|provide|new)command\*?\{?|def)\\" + \
+        r"([a-zA-Z@]+)\}?\{([^{}#]*)\}"
 
     # compile regex's
     params["documentclass_regex"] = re.compile(restr_documentclass)
@@ -1245,8 +2942,20 @@ def latexmake_default_params():
     params["includegraphics_regex"] = re.compile(restr_includegraphics)
     params["biber_regex"] = re.compile(restr_biber)
     params["bibtex_regex"] = re.compile(restr_bibtex)
-    params["bibliography_regex"] = params["bibtex_regex"]
     params["included_regex"] = re.compile(restr_include)
+    params["import_regex"] = re.compile(restr_import)
+    params["newcommand_regex"] = re.compile(restr_newcommand)
+    params["definition_regex"] = re.compile(restr_definition)
+    params["begindocument_regex"] = re.compile(restr_begindocument)
+    params["tikzexternalize_regex"] = re.compile(restr_tikzexternalize)
+    params["tikzprefix_regex"] = re.compile(restr_tikzprefix)
+    params["tikzpicture_regex"] = re.compile(restr_tikzpicture)
+    params["glossary_regex"] = re.compile(restr_glossary)
+    params["includepdf_regex"] = re.compile(restr_includepdf)
+    params["includesvg_regex"] = re.compile(restr_includesvg)
+    params["lstinputlisting_regex"] = re.compile(restr_lstinputlisting)
+    params["bibliographystyle_regex"] = re.compile(restr_bibliographystyle)
+    params["beamertheme_regex"] = re.compile(restr_beamertheme)
     params['removenewline_regex'] = re.compile(restr_removenewline)
     params['removecomment_regex'] = re.compile(restr_removecomment)
     params['replacecommaendedline_regex'] = re.compile(restr_commaendedline)
@@ -1261,10 +2970,237 @@ def latexmake_default_params():
     params['squaresquare_regex'] = re.compile(restr_squaresquare)
     params['squigglysquare_regex'] = re.compile(restr_squigglysquare)
 
+    # the dependency scanners (one pass over each file)
+    params = register_scanner(params, ["documentclass", "LoadClass"], \
+        params["documentclass_regex"], findClasses)
+    params = register_scanner(params, ["usepackage", "RequirePackage"], \
+        params["usepackage_regex"], find_packages)
+    params = register_scanner(params, ["graphicspath"], \
+        params["graphicspath_regex"], find_graphics_paths)
+    params = register_scanner(params, ["DeclareGraphicsExtensions"], \
+        params["graphicsextensions_regex"], find_graphics_extensions)
+    params = register_scanner(params, ["includegraphics"], \
+        params["includegraphics_regex"], find_figures)
+    params = register_scanner(params, ["includepdf"], \
+        params["includepdf_regex"], find_figures)
+    params = register_scanner(params, ["includesvg"], \
+        params["includesvg_regex"], find_svg_figures)
+    params = register_scanner(params, ["lstinputlisting"], \
+        params["lstinputlisting_regex"], find_listings)
+    params = register_scanner(params, ["bibliography"], \
+        params["bibtex_regex"], findBibliographies)
+    params = register_scanner(params, ["addbibresource"], \
+        params["biber_regex"], findBibliographies)
+    params = register_scanner(params, ["bibliographystyle"], \
+        params["bibliographystyle_regex"], find_bibliography_style)
+    params = register_scanner(params, ["makeglossaries"], \
+        params["glossary_regex"], find_glossary)
+    params = register_scanner(params, ["include", "input"], \
+        params["included_regex"], find_sub_tex_files)
+    params = register_scanner(params, ["import", "subimport", "inputfrom", \
+        "subinputfrom", "includefrom", "subincludefrom"], \
+        params["import_regex"], find_imported_files)
+    params = register_scanner(params, ["usetheme", "usecolortheme", \
+        "usefonttheme", "useinnertheme", "useoutertheme"], \
+        params["beamertheme_regex"], find_beamer_themes)
+    params = register_scanner(params, ["tikzexternalize"], \
+        params["tikzexternalize_regex"], find_tikz_externalize)
+    params = register_scanner(params, ["tikzsetexternalprefix"], \
+        params["tikzprefix_regex"], find_tikz_prefix)
+    params = register_scanner(params, ["begin{document}"], \
+        params["begindocument_regex"], find_begin_document)
+    params = register_scanner(params, ["tikzsetnextfilename", \
+        "tikzexternaldisable", "tikzexternalenable", "begin{tikzpicture}", \
+        "tikz"], params["tikzpicture_regex"], find_tikz_figures)
+    params = compile_scanners(params)
+
     return params
 # fed latexmake_default_params()
 #-------------------------------------------------------------------------------
 
+#-------------------------------------------------------------------------------
+def latexmake_parse_args(args, params):
+    # parses the command-line options (everything but the file name)
+    for arg in args:
+        if arg == "--build-cache":
+            params["use_build_cache"] = True
+        elif arg.find("--output-directory=") == 0:
+            params["output_directory"] = parse_equals(arg)[1]
+        elif arg == "--ninja":
+            params["backend"] = "ninja"
+        elif arg == "--emit-json":
+            params["emit_json"] = params["basename"] + ".deps.json"
+        elif arg.find("--emit-json=") == 0:
+            params["emit_json"] = parse_equals(arg)[1]
+        elif arg == "--emit-dot":
+            params["emit_dot"] = params["basename"] + ".deps.dot"
+        elif arg.find("--emit-dot=") == 0:
+            params["emit_dot"] = parse_equals(arg)[1]
+        elif arg == "--trim-bib":
+            params["trim_bibliography"] = True
+        elif arg.find("--opaque=") == 0:
+            params["opaque_globs"].append(parse_equals(arg)[1])
+        elif arg == "--git-index":
+            params["use_git_index"] = True
+        elif arg.find("--prune=") == 0:
+            params["prune_dirs"].append(parse_equals(arg)[1])
+        elif arg.find("--opaque-size=") == 0:
+            params["opaque_size"] = int(parse_equals(arg)[1]) * 1048576
+        # elif arg.find("--tex=") == 0:
+        #     pass
+        # elif arg.find("--bib=") == 0:
+        #     pass
+        else:
+            warning("Unknown option \"" + arg + "\"")
+    return params
+# fed latexmake_parse_args(args, params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def latexmake_scan(args, shared=None):
+    # scans the project. args are the command-line options followed by the
+    # name of the main TeX file. shared holds the caches of the
+    # params["shared_params"] between the scans of several root documents
+
+    # set the default parameters
+    params = latexmake_default_params()
+    if shared is None:
+        shared = {}
+    for key in params["shared_params"]:
+        if key in shared:
+            params[key] = shared[key]
+
+    # get the file name (always last argument)
+    tmp = args[-1]
+
+    # make sure the file exists
+    if not os.path.isfile(tmp):
+        # we may have left the extension off
+        tmp += ".tex"
+        if not os.path.isfile(tmp):
+            sys.exit("The file " + args[-1] + " does not exist.")
+
+
+    # get the absolute path to the source file
+    (pth, tmp) = os.path.split(os.path.abspath(tmp))
+    params["path"] = pth
+
+    idx = tmp.find(".tex")
+
+    params["tex_files"].append(os.path.abspath(tmp))
+    params = add_dependency(params, tmp, "tex", None)
+
+    if idx < 0:
+        sys.exit("The file " + args[-1] + " does not have a .tex extension.")
+    else:
+        tmp = tmp[:idx]
+    params["basename"] = tmp
+
+    # parse the command-line options
+    params = latexmake_parse_args(args[:-1], params)
+
+    # parse the latex file
+    params = parse_tex_file(params["basename"] + ".tex", params)
+
+    # find the packages and classes in the texmf paths
+    params = resolve_texmf_files(params)
+    if params["verbose"]:
+        print "skipped " + str(params["walk_skipped"]["dirs"]) + \
+            " directories and " + str(params["walk_skipped"]["files"]) + \
+            " files while searching" + \
+            ("" if scandir else " (install scandir to walk without stat'ing)")
+
+    for key in params["shared_params"]:
+        shared[key] = params[key]
+
+    return params
+# fed latexmake_scan(args, shared)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def latexmake_generate(args, shared=None):
+    # scans the root documents in args (after the options) and writes the
+    # Makefile(s) or build.ninja. Several root documents (slides, paper, ...)
+    # share the parse results of their common files. Returns the params of
+    # each root
+    options = [arg for arg in args if arg.find("--") == 0]
+    roots = [arg for arg in args if arg.find("--") != 0]
+    if not roots:
+        raise latexmake_noInput("no TeX file given")
+    if shared is None:
+        shared = {}
+    projects = [latexmake_scan(options + [root], shared) for root in roots]
+    params = projects[0]
+    for project in projects:
+        # the arguments to regenerate the Makefile(s) with
+        project["argv"] = args
+
+    if params["backend"] == "ninja":
+        if len(projects) > 1:
+            raise latexmake_invalidArgument( \
+                "the ninja backend takes a single root document")
+        # write build.ninja instead
+        fid = open("build.ninja", "w")
+        write_ninja(fid, params)
+        fid.close()
+    elif len(projects) > 1:
+        # a Makefile per root, the variables they share, and a Makefile to
+        # run them. The fingerprints are written first, so the Makefiles are
+        # newer
+        for project in projects:
+            write_fingerprint(project)
+        for project in projects:
+            fid = open(project["basename"] + ".mk", "w")
+            write_makefile(fid, project, latexmake_common_makefile)
+            fid.close()
+        fid = open(latexmake_common_makefile, "w")
+        fid.write("# " + latexmake_common_makefile + "\n")
+        fid.write(latexmake_header())
+        fid.write("\n\n")
+        write_common_variables(fid, params)
+        fid.close()
+        fid = open("Makefile", "w")
+        write_roots_makefile(fid, projects)
+        fid.close()
+    else:
+        # the fingerprint is written first, so the Makefile is newer
+        write_fingerprint(params)
+
+        # open the Makefile
+        fid = open("Makefile", "w")
+
+        # write the Makefile
+        write_makefile(fid, params)
+
+        # close the makefile
+        fid.close()
+
+    # export the dependency graph
+    for project in projects:
+        if project["emit_json"]:
+            fid = open(emit_name(project, projects, "emit_json"), "w")
+            write_dependency_json(fid, project)
+            fid.close()
+        if project["emit_dot"]:
+            fid = open(emit_name(project, projects, "emit_dot"), "w")
+            write_dependency_dot(fid, project)
+            fid.close()
+    return projects
+# fed latexmake_generate(args, shared)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def emit_name(project, projects, key):
+    # file of an exported graph. A path given for several roots
+    # (--emit-json=graph.json) gets the basename: graph.doc.json
+    path = project[key]
+    if [p[key] for p in projects].count(path) > 1:
+        (base, ext) = os.path.splitext(path)
+        path = base + "." + project["basename"] + ext
+    return path
+# fed emit_name(project, projects, key)
+#-------------------------------------------------------------------------------
+
 #-------------------------------------------------------------------------------
 def latexmake_finalize_params(params):
     # set file paths to absolute or relative
@@ -1322,6 +3258,9 @@ def latexmake_finalize_params(params):
                 print "Warning!"
                 print command + " is not found in your PATH"
 
+    # figures converted by the Makefile rather than during the compile
+    params["fig_conv_files"] = figures_to_convert(params)
+
     # TODO: remove duplicate aux_extensions
 
     return params
@@ -1329,86 +3268,434 @@ def latexmake_finalize_params(params):
 #-------------------------------------------------------------------------------
 
 #-------------------------------------------------------------------------------
-def write_makefile(fid, options):
+def output_subdirs(options):
+    # the sub-directories of an output directory that \\include'd files
+    # write their aux files to
+    output = []
+    for pth in options["sub_paths"]:
+        pth = os.path.relpath(pth)
+        if pth != "." and not pth.startswith("..") and pth not in output:
+            output.append(pth)
+    return output
+# fed output_subdirs(options)
+#-------------------------------------------------------------------------------
 
-    # finalize the options
-    options = latexmake_finalize_params(options)
+#-------------------------------------------------------------------------------
+def compile_commands(options, directory="", engine="${TEX_ENGINE}", \
+    flags="${TEX_OPTIONS}"):
+    # the (tex, bib, index, glossary) commands, writing into directory. flags
+    # are the options of engine
+    trim = options["trim_bibliography"] and options["bib_engine"] != "BIBER"
+    if not directory:
+        bib_cmd = "${BIB_ENGINE} ${SOURCE}"
+        if trim:
+            # bibtex reads the cited entries (shadowing the .bib files)
+            bib_cmd = "${LATEXMAKE} bibsubset --aux=${SOURCE}.aux " + \
+                "--output-dir=${BIB_SUBSET_DIR} --index-dir=${BIB_INDEX_DIR} " + \
+                "&& BIBINPUTS=${BIB_SUBSET_DIR}: " + bib_cmd
+        return (engine + " " + flags + " ${SOURCE}.tex", bib_cmd, \
+            "${IDX_ENGINE} ${SOURCE}", "${GLS_ENGINE} ${SOURCE}")
+
+    tex_cmd = engine + " " + flags + " -output-directory=" + directory + \
+        " ${SOURCE}.tex"
+    if options["bib_engine"] == "BIBER":
+        bib_cmd = "${BIB_ENGINE} --input-directory=" + directory + \
+            " --output-directory=" + directory + " ${SOURCE}"
+    else:
+        # bibtex has to run in directory to find the \\include'd aux files
+        bib_cmd = "${CD} " + directory + " && BIBINPUTS=${CURDIR}: " + \
+            "BSTINPUTS=${CURDIR}: ${BIB_ENGINE} ${SOURCE}"
+        if trim:
+            # every directory has its own subsets (formats are made in
+            # parallel)
+            bib_cmd = "${LATEXMAKE} bibsubset --aux=" + directory + \
+                "/${SOURCE}.aux --output-dir=" + directory + "/bibsubset " + \
+                "--index-dir=${BIB_INDEX_DIR} && " + bib_cmd.replace( \
+                "BIBINPUTS=${CURDIR}:", "BIBINPUTS=${CURDIR}/" + directory + \
+                "/bibsubset:${CURDIR}:")
+    idx_cmd = "${IDX_ENGINE} " + directory + "/${SOURCE}"
+    gls_cmd = "${GLS_ENGINE} -d " + directory + " ${SOURCE}"
+    return (tex_cmd, bib_cmd, idx_cmd, gls_cmd)
+# fed compile_commands(options, directory, engine, flags)
+#-------------------------------------------------------------------------------
 
-    fid.write("# Makefile\n")
+#-------------------------------------------------------------------------------
+def write_format_rule(fid, options, ext, deps):
+    # writes the rule for one output format. Each format is compiled in its
+    # own directory, so the formats can be made in parallel (make -j)
+    workdir = "${FORMAT_DIR}/" + ext
+    if ext == "pdf":
+        (engine, flags) = ("${TEX_ENGINE}", "${TEX_OPTIONS}")
+    else:
+        # dvi, ps and rtf (latex2rtf reads the aux and bbl files of latex)
+        (engine, flags) = ("${TIMED} ${LATEX}", "${LATEX_OPTIONS}")
+    (tex_cmd, bib_cmd, idx_cmd, gls_cmd) = compile_commands(options, \
+        workdir, engine, flags)
+
+    fid.write("${SOURCE}." + ext + ": " + deps + "\n")
+    tmp = "${MKDIR} -p " + workdir
+    for pth in output_subdirs(options):
+        tmp += " " + os.path.join(workdir, pth)
+    write_long_lines(fid, tmp + "\n", n_tabs=1)
+    fid.write("\t" + tex_cmd + "\n")
+    if options["make_bib_in_default"]:
+        fid.write("\t" + bib_cmd + "\n")
+    if options["make_index_in_default"]:
+        fid.write("\t" + idx_cmd + "\n")
+    if options["make_glossary_in_default"]:
+        fid.write("\t" + gls_cmd + "\n")
+    fid.write("\t" + tex_cmd + "\n")
+    fid.write("\t" + tex_cmd + "\n")
+    if ext == "ps":
+        fid.write("\t${TIMED} ${DVIPS} -o $@ " + workdir + "/${SOURCE}.dvi\n")
+    elif ext == "rtf":
+        fid.write("\t${TIMED} ${LATEX2RTF} ${LATEX2RTF_OPTIONS} -a " + workdir + \
+            "/${SOURCE}.aux -b " + workdir + "/${SOURCE}.bbl -o $@ " + \
+            "${SOURCE}.tex\n")
+    else:
+        fid.write("\t${CP} " + workdir + "/${SOURCE}." + ext + " $@\n")
+    return
+# fed write_format_rule(fid, options, ext, deps)
+#-------------------------------------------------------------------------------
 
-    # write some documentation about how created
-    fid.write(latexmake_header())
-    fid.write("\n\n")
+#-------------------------------------------------------------------------------
+def write_includeonly_rules(fid, options, deps, order):
+    # make quick compiles only the \\include'd files changed since the last
+    # make full (the aux files of the others are reused). A wrapper file sets
+    # \\includeonly, so the sources are not modified
+    tmp = "${TEX_ENGINE} ${TEX_OPTIONS} -jobname=${SOURCE} "
+    if options["output_directory"]:
+        tmp += "-output-directory=${OUT_DIR} "
+    tex_cmd = tmp + "${INCLUDE_WRAPPER}"
+    check = "${LATEXMAKE} includeonly --state=${INCLUDE_STATE} " + \
+        "--wrapper=${INCLUDE_WRAPPER} --source=${SOURCE} " + \
+        "--chapters=\"${INCLUDE_FILES}\" -- ${TEX_FILES}"
 
-    # latexmake
-    fid.write("# latexmake\n")
-    fid.write("# \tThis may not be in the same location on other systems\n")
-    fid.write("LATEXMAKE=" + options["latexmake"] + "\n")
     fid.write("\n\n")
+    fid.write("# compile the \\include'd files changed since make full\n")
+    fid.write(".PHONY: quick\n")
+    fid.write("quick: " + deps + order + "\n")
+    write_long_lines(fid, "@" + check + "; \\\n", n_tabs=1)
+    fid.write("\tcase $$? in \\\n")
+    tmp = "0) " + tex_cmd
+    if options["output_directory"]:
+        tmp += " && ${CP} ${OUT_DIR}/${SOURCE}." + \
+            options["output_extension"][0] + " ."
+    # the partial output is out of date for make all (the stamp is written
+    # again by the next make)
+    tmp += " && ${RM} -f " + stamp_name("${STAMP_DIR}", "${SOURCE}.tex")
+    write_long_lines(fid, "\t" + tmp + " ;; \\\n", n_tabs=1)
+    fid.write("\t2) ${MAKE} -f ${THIS_MAKEFILE} -e full ;; \\\n")
+    fid.write("\tesac\n")
 
-    # TeX commands
-    fid.write("# TeX commands (MODIFY AT YOUR OWN RISK)\n")
-    fid.write("TEX=" + options["tex"] + "\n")
-    fid.write("LATEX=" + options["latex"] + "\n")
-    fid.write("PDFLATEX=" + options["pdflatex"] + "\n")
-    fid.write("LUATEX=" + options["luatex"] + "\n")
-    fid.write("LUALATEX=" + options["lualatex"] + "\n")
-    fid.write("XELATEX=" + options["xelatex"] + "\n")
-    fid.write("XETEX=" + options["xetex"] + "\n")
-    fid.write("BIBTEX=" + options["bibtex"] + "\n")
-    fid.write("BIBER=" + options["biber"] + "\n")
-    fid.write("DVIPS=" + options["dvips"] + "\n")
-    fid.write("PS2EPS=" + options["ps2eps"] + "\n")
-    fid.write("PSTOPDF=" + options["pstopdf"] + "\n")
-    fid.write("EPSTOPDF=" + options["epstopdf"] + "\n")
-    fid.write("MAKEGLOSSARIES=" + options["makeglossaries"] + "\n")
-    fid.write("MAKEINDEX=" + options["makeindex"] + "\n")
-    fid.write("LATEXDIFF=" + options["latexdiff"] + "\n")
-    fid.write("LATEXPAND=" + options["latexpand"] + "\n")
-    fid.write("LATEX2RTF=" + options["latex2rtf"] + "\n")
-    fid.write("BIBSORT=" + options["bibsort"] + "\n")
-    fid.write("# end TeX commands\n")
     fid.write("\n\n")
+    fid.write("# compile everything and remember the \\include'd files\n")
+    fid.write(".PHONY: full\n")
+    fid.write("full: " + deps + order + "\n")
+    fid.write("\t${MAKE} -f ${THIS_MAKEFILE} -e all\n")
+    write_long_lines(fid, "${LATEXMAKE} includeonly --record " + \
+        "--state=${INCLUDE_STATE} -- ${TEX_FILES}\n", n_tabs=1)
+    return
+# fed write_includeonly_rules(fid, options, deps, order)
+#-------------------------------------------------------------------------------
 
-    # write the tex engines
-    fid.write("# TeX commands (these are what are called)\n")
-    fid.write("TEX_ENGINE?=${" + options["tex_engine"] + "}\n")
-    fid.write("BIB_ENGINE?=${" + options["bib_engine"] + "}\n")
-    fid.write("IDX_ENGINE?=${" + options["idx_engine"] + "}\n")
-    fid.write("GLS_ENGINE?=${" + options["gls_engine"] + "}\n")
-    fid.write("\n")
+#-------------------------------------------------------------------------------
+def preview_chapters(options):
+    # the (name, file, dependencies) of the files included by the main file
+    # in its body (files \\input in the preamble cannot be compiled alone).
+    # The dependencies are the file and everything it includes
+    root = os.path.abspath(options["basename"] + ".tex")
+    children = {}
+    for (dependency, kind, included_by) in options["dependencies"]:
+        if included_by:
+            children.setdefault(included_by, []).append(dependency)
 
-    # write the tex command flags
-    fid.write("# TeX flags\n")
-    fid.write("TEXFLAGS?=" + options["tex_flags"] + "\n")
-    fid.write("LATEX2RTFFLAGS?=" + options["latex2rtf_flags"] + "\n")
-    fid.write("\n")
+    output = []
+    for (dependency, kind, included_by) in options["dependencies"]:
+        if kind != "tex" or included_by != root:
+            continue
+        f = os.path.relpath(dependency)
+        if f in options["opaque_files"] or f in options["preamble_files"] or \
+            f in [item[1] for item in output]:
+            continue
+        name = os.path.splitext(f)[0].replace(os.sep, "-")
+        files = []
+        todo = [dependency]
+        while todo:
+            item = todo.pop(0)
+            if os.path.relpath(item) not in files:
+                files.append(os.path.relpath(item))
+                todo += children.get(item, [])
+                # figures converted by epstopdf
+                if os.path.relpath(item) in options["fig_conv_files"]:
+                    files.append(converted_figure_name( \
+                        os.path.relpath(item), options))
+        output.append((name, f, files))
+    return output
+# fed preview_chapters(options)
+#-------------------------------------------------------------------------------
 
-    # write the other enigines of other uitilies
-    fid.write("# UNIX commands\n")
-    fid.write("MAKE=" + options["make"] + "\n")
-    fid.write("RM=" + options["rm"] + "\n")
-    fid.write("ECHO=" + options["echo"] + "\n")
-    fid.write("FIND=" + options["find"] + "\n")
-    fid.write("CD=" + options["cd"] + "\n")
-    fid.write("CP=" + options["cp"] + "\n")
-    fid.write("PWD=" + options["pwd"] + "\n")
-    fid.write("TAR=" + options["tar"] + "\n")
-    fid.write("ZIP=" + options["zip"] + "\n")
-    if options["has_git"]:
-        fid.write("GIT=" + options["git"] + "\n")
-    if options["use_open"]:
-        fid.write("OPEN=" + options["open"] + "\n")
-    if options["has_mktemp"]:
-        fid.write("MKTEMP=" + options["mktemp"] + "\n")
-    fid.write("MKDIR=" + options["mkdir"] + "\n")
-    fid.write("\n")
+#-------------------------------------------------------------------------------
+def write_preview_rules(fid, options):
+    # make preview-NAME compiles one file included by the main file with its
+    # preamble (and bibliography). Each preview has its own directory, so
+    # previews can be made in parallel (make -j previews)
+    ext = options["output_extension"][0]
+    targets = []
+    stamped = stamped_files(options)
+    bib_files = []
+    if options["make_bib_in_default"]:
+        bib_files = options["bib_files"]
+    for (name, f, files) in preview_chapters(options):
+        workdir = "${PREVIEW_DIR}/" + name
+        target = "${PREVIEW_DIR}/" + name + "." + ext
+        targets.append("preview-" + name)
+        tex_cmd = "${TEX_ENGINE} ${TEX_OPTIONS} -output-directory=" + \
+            workdir + " " + workdir + "/preview.tex\n"
 
-    # unix command flags
-    fid.write("# UNIX flags\n")
-    fid.write("RMFLAGS?=" + options["rm_flags"] + "\n")
+        fid.write("\n\n")
+        fid.write("# preview of " + f + "\n")
+        fid.write(".PHONY: preview-" + name + "\n")
+        fid.write("preview-" + name + ": " + target + "\n")
+        tmp = target + ": " + stamp_name("${STAMP_DIR}", \
+            options["basename"] + ".tex")
+        for dep in options["preamble_files"] + options["sty_files"] + \
+            options["cls_files"] + files + bib_files:
+            if dep in stamped:
+                tmp += " " + stamp_name("${STAMP_DIR}", dep)
+            else:
+                tmp += " " + dep
+        write_long_lines(fid, tmp + "\n")
+        tmp = "${MKDIR} -p " + workdir
+        for pth in output_subdirs(options):
+            tmp += " " + os.path.join(workdir, pth)
+        write_long_lines(fid, tmp + "\n", n_tabs=1)
+        write_long_lines(fid, "${LATEXMAKE} preview --source=${SOURCE}.tex " + \
+            "--output=" + workdir + "/preview.tex -- " + f + "\n", n_tabs=1)
+        write_long_lines(fid, tex_cmd, n_tabs=1)
+        if bib_files:
+            # the citations of the file (the bib commands of the job preview)
+            bib_cmd = compile_commands(options, workdir)[1]
+            write_long_lines(fid, bib_cmd.replace("${SOURCE}", "preview") + \
+                "\n", n_tabs=1)
+            write_long_lines(fid, tex_cmd, n_tabs=1)
+            write_long_lines(fid, tex_cmd, n_tabs=1)
+        fid.write("\t${CP} " + workdir + "/preview." + ext + " $@\n")
+
+    if targets:
+        fid.write("\n\n")
+        fid.write("# every preview (use make -j to make them in parallel)\n")
+        fid.write(".PHONY: previews\n")
+        write_long_lines(fid, "previews: " + " ".join(targets) + "\n")
+    return
+# fed write_preview_rules(fid, options)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_tikz_rules(fid, options):
+    # one target per externalized tikz picture (what the tikz external
+    # library's "list and make" mode does), so make -j draws them in parallel.
+    # A picture is drawn again when its code (see latexmake tikzstamps), the
+    # preamble or a local package changes, not for edits of the text
+    preamble = options["preamble_files"] + options["sty_files"] + \
+        options["cls_files"]
+    stamped = stamped_files(options)
+    for (name, filename, _) in options["tikz_figures"]:
+        target = options["tikz_prefix"] + name
+        tmp = target + ".pdf: ${TIKZ_STAMP_DIR}/" + name + ".stamp " + \
+            "${TIKZ_STAMP_DIR}/${SOURCE}.preamble.stamp"
+        for f in unique(preamble):
+            if f in stamped:
+                tmp += " " + stamp_name("${STAMP_DIR}", f)
+            else:
+                tmp += " " + f
+        fid.write("\n\n")
+        write_long_lines(fid, tmp + "\n")
+        if os.path.dirname(target):
+            fid.write("\t${MKDIR} -p " + os.path.dirname(target) + "\n")
+        write_long_lines(fid, "${TEX_ENGINE} ${TEX_OPTIONS} -halt-on-error " + \
+            "-interaction=batchmode -jobname \"" + target + "\" " + \
+            "\"\\def\\tikzexternalrealjob{${SOURCE}}\\input{${SOURCE}}\"\n", \
+            n_tabs=1)
+
+    fid.write("\n\n")
+    fid.write("# every externalized tikz picture\n")
+    fid.write(".PHONY: tikz\n")
+    fid.write("tikz: ${TIKZ_FIGURES}\n")
+    return
+# fed write_tikz_rules(fid, options)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def stamped_files(options):
+    # the inputs the Makefile tracks through content stamps
+    return unique(options["tex_files"] + options["bib_files"] + \
+        options["fig_files"] + options["sty_files"] + options["cls_files"])
+# fed stamped_files(options)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def structure_files(options):
+    # the parsed inputs whose commands decide what the Makefile looks like
+    opaque = [os.path.relpath(f) for f in options["opaque_files"]]
+    return [f for f in unique([os.path.relpath(f) for f in \
+        options["tex_files"] + options["sty_files"] + options["cls_files"]]) \
+        if f not in opaque]
+# fed structure_files(options)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def fingerprint_name(options):
+    # the file with the structural fingerprint of the sources
+    return os.path.join(options["latexmake_dir"], \
+        options["basename"] + ".fingerprint")
+# fed fingerprint_name(options)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def update_fingerprint(output, checked, files, params):
+    # writes the structural fingerprint of files to output if it changed.
+    # The fingerprints of the single files are kept in checked (if given), so
+    # only files with a new size or mtime are read. Returns True if output
+    # was written
+    cache = {}
+    if checked and os.path.isfile(checked):
+        try:
+            fid = open(checked, "r")
+            cache = json.load(fid)
+            fid.close()
+        except ValueError:
+            pass
+
+    prints = {}
+    for f in files:
+        if not os.path.isfile(f):
+            prints[f] = ["", "missing"]
+            continue
+        info = os.stat(f)
+        quick = str(info.st_size) + " " + repr(info.st_mtime)
+        if f in cache and cache[f][0] == quick:
+            prints[f] = cache[f]
+        else:
+            prints[f] = [quick, structure_fingerprint(f, params)]
+    fingerprint = hashlib.sha1("\n".join([f + " " + prints[f][1] \
+        for f in files])).hexdigest() + "\n"
+
+    for f in [output, checked]:
+        if f and os.path.dirname(f) and not os.path.isdir(os.path.dirname(f)):
+            os.makedirs(os.path.dirname(f))
+    if checked:
+        fid = open(checked, "w")
+        json.dump(prints, fid)
+        fid.close()
+
+    # only write changes, so the Makefile is not regenerated needlessly
+    if os.path.isfile(output):
+        fid = open(output, "r")
+        unchanged = fid.read() == fingerprint
+        fid.close()
+        if unchanged:
+            return False
+    fid = open(output, "w")
+    fid.write(fingerprint)
+    fid.close()
+    return True
+# fed update_fingerprint(output, checked, files, params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_fingerprint(options):
+    # records the structural fingerprint the Makefile is generated for
+    name = fingerprint_name(options)
+    update_fingerprint(name, name + ".checked", structure_files(options), \
+        options)
+    return
+# fed write_fingerprint(options)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_regenerate_rules(fid, options):
+    # the Makefile remakes itself (and make restarts) when the structural
+    # fingerprint of the sources changes. The fingerprint is only checked
+    # after the contents of a source changed (see the content stamps), and
+    # only rewritten when it changed
+    fid.write("\n\n")
+    fid.write("# regenerate this Makefile when \\input's, figures, packages, ")
+    fid.write("... change\n")
+    fid.write("ifndef CLEAN_ONLY\n")
+    fid.write("${THIS_MAKEFILE}: ${FINGERPRINT}\n")
+    fid.write("\t${LATEXMAKE} ${LATEXMAKE_ARGS}\n")
+    fid.write("${FINGERPRINT}: ${FINGERPRINT}.checked ;\n")
+    fid.write("${FINGERPRINT}.checked: ${STRUCTURE_STAMPS}\n")
+    write_long_lines(fid, "@${LATEXMAKE} fingerprint " + \
+        "--output=${FINGERPRINT} --checked=$@ -- ${STRUCTURE_FILES}\n", \
+        n_tabs=1)
+    fid.write("endif\n")
+    return
+# fed write_regenerate_rules(fid, options)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def aux_glob(variable, options):
+    # the auxiliary files of this root document in the patterns of variable
+    # (*.aux is ${SOURCE}.aux, so the files of the other roots are kept),
+    # inside the output directory
+    variable = "$(subst *,${SOURCE}," + variable + ")"
+    if options["output_directory"]:
+        return "$(addprefix ${OUT_DIR}/," + variable + ")"
+    return variable
+# fed aux_glob(variable, options)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_makefile(fid, options, common=""):
+    # common is the file with the variables the root documents share (see
+    # write_roots_makefile); they are written to fid otherwise
+
+    # finalize the options
+    options = latexmake_finalize_params(options)
+
+    fid.write("# Makefile\n")
+
+    # write some documentation about how created
+    fid.write(latexmake_header())
+    fid.write("\n\n")
+
+    # this file
+    fid.write("# this file (make calls itself)\n")
+    fid.write("THIS_MAKEFILE:=$(lastword ${MAKEFILE_LIST})\n")
+    fid.write("\n\n")
+
+    if common:
+        fid.write("# the variables of every root document\n")
+        fid.write("include " + common + "\n")
+        fid.write("\n\n")
+    else:
+        write_common_variables(fid, options)
+
+    # write the tex engines
+    fid.write("# TeX commands (these are what are called)\n")
+    fid.write("TEX_ENGINE?=${TIMED} ${" + options["tex_engine"] + "}\n")
+    fid.write("BIB_ENGINE?=${TIMED} ${" + options["bib_engine"] + "}\n")
+    fid.write("IDX_ENGINE?=${TIMED} ${" + options["idx_engine"] + "}\n")
+    fid.write("GLS_ENGINE?=${TIMED} ${" + options["gls_engine"] + "}\n")
     fid.write("\n")
 
+    # build cache
+    if options["use_build_cache"]:
+        fid.write("# Build cache\n")
+        tmp = "BUILD_CACHE_ARGS=--cache-dir=${BUILD_CACHE_DIR} " + \
+            "--cache-size=${BUILD_CACHE_SIZE} --source=${SOURCE} " + \
+            "--engine=${" + options["tex_engine"] + "} " + \
+            "--flags=\"${TEXFLAGS} ${TEX_OPTIONS}\" " + \
+            "--outputs=" + ",".join(unique(options["output_extension"] + \
+            options["build_cache_extensions"])) + " -- ${TEX_FILES} " + \
+            "${BIB_FILES} ${FIG_FILES} ${STY_FILES} ${CLS_FILES}\n"
+        if options["output_directory"]:
+            tmp = tmp.replace(" -- ", " --output-directory=${OUT_DIR} -- ")
+        write_long_lines(fid, tmp)
+        fid.write("\n")
+
     fid.write("# Paths\n")
     tmp = "GRAPHICS_PATHS="
     tmp += " ".join(options["graphics_paths"])
@@ -1431,6 +3718,41 @@ def write_makefile(fid, options):
     fid.write("SOURCE=" + options["basename"] + "\n")
     fid.write("\n")
 
+    if options["output_directory"]:
+        fid.write("# Output directory (\\include'd files need their own")
+        fid.write(" sub-directory)\n")
+        fid.write("OUT_DIR?=" + options["output_directory"] + "\n")
+        tmp = "OUT_DIRS=${OUT_DIR}"
+        for pth in output_subdirs(options):
+            tmp += " " + os.path.join("${OUT_DIR}", pth)
+        tmp += "\n"
+        write_long_lines(fid, tmp)
+        fid.write("\n")
+
+    fid.write("# Output formats and previews are compiled in their own")
+    fid.write(" directories (one per root\n# document)\n")
+    if options["output_directory"]:
+        fid.write("FORMAT_DIR?=${OUT_DIR}/formats/${SOURCE}\n")
+        fid.write("PREVIEW_DIR?=${OUT_DIR}/preview/${SOURCE}\n")
+    else:
+        fid.write("FORMAT_DIR?=" + os.path.join(options["latexmake_dir"], \
+            "formats", "${SOURCE}") + "\n")
+        fid.write("PREVIEW_DIR?=" + os.path.join(options["latexmake_dir"], \
+            "preview", "${SOURCE}") + "\n")
+    fid.write("\n")
+
+    if options["include_files"]:
+        fid.write("# \\include'd files; make quick recompiles the changed ones\n")
+        write_long_lines(fid, "INCLUDE_FILES= " + \
+            " ".join(options["include_files"]) + "\n")
+        if options["output_directory"]:
+            tmp = "${OUT_DIR}"
+        else:
+            tmp = options["latexmake_dir"]
+        fid.write("INCLUDE_STATE?=" + tmp + "/${SOURCE}.include.json\n")
+        fid.write("INCLUDE_WRAPPER?=" + tmp + "/${SOURCE}.includeonly.tex\n")
+        fid.write("\n")
+
     tmp = "TEX_FILES="
     for tmpoption in options["tex_files"]:
         tmp += (" " + tmpoption)
@@ -1452,6 +3774,13 @@ def write_makefile(fid, options):
     write_long_lines(fid, tmp)
     fid.write("\n")
 
+    tmp = "FIG_CONV_FILES="
+    for tmpoption in options["fig_conv_files"]:
+        tmp += (" " + converted_figure_name(tmpoption, options))
+    tmp += ("\n")
+    write_long_lines(fid, tmp)
+    fid.write("\n")
+
     tmp = "DUP_FIG_FILES="
     for tmpoption in options["duplicate_fig_files"]:
         tmp += (" " + tmpoption)
@@ -1482,24 +3811,24 @@ def write_makefile(fid, options):
         fid.write("\n")
     fid.write("\n")
 
-    # extensions
-
-    fid.write("\n")
-    fid.write("# Sets of extensions\n")
-    tmp = "TEX_AUX_EXT="
-    for ext in options["tex_aux_extensions"]:
-        tmp += (" *" + ext)
-    tmp += "\n"
-    write_long_lines(fid, tmp)
-    fid.write("\n")
+    if options["trim_bibliography"] and options["bib_engine"] != "BIBER":
+        fid.write("# Cited subsets of the bibliographies (and indexes of the")
+        fid.write(" .bib files)\n")
+        fid.write("BIB_SUBSET_DIR?=" + os.path.join(options["latexmake_dir"], \
+            "bibsubset", "${SOURCE}") + "\n")
+        fid.write("BIB_INDEX_DIR?=" + options["bib_index_dir"] + "\n")
+        fid.write("\n")
 
-    tmp = "BIB_AUX_EXT="
-    for ext in options["bib_aux_extensions"]:
-        tmp += (" *" + ext)
-    tmp += "\n"
-    write_long_lines(fid, tmp)
-    fid.write("\n")
+    if options["tikz_externalize"] and options["tikz_figures"]:
+        fid.write("# Externalized tikz pictures\n")
+        tmp = "TIKZ_FIGURES="
+        for (name, _, _) in options["tikz_figures"]:
+            tmp += " " + options["tikz_prefix"] + name + ".pdf"
+        write_long_lines(fid, tmp + "\n")
+        fid.write("\n")
 
+    # converted figures (in the graphics paths)
+    fid.write("# Converted figures\n")
     tmp = "FIG_AUX_EXT="
     for pth in options["graphics_paths"]:
         for ext in options["figure_aux_extensions"]:
@@ -1508,44 +3837,46 @@ def write_makefile(fid, options):
     write_long_lines(fid, tmp)
     fid.write("\n")
 
-    tmp = "IDX_AUX_EXT="
-    for ext in options["idx_aux_extensions"]:
-        tmp += (" *" + ext)
-    tmp += "\n"
-    write_long_lines(fid, tmp)
-    fid.write("\n")
-
-    tmp = "BEAMER_AUX_EXT="
-    for ext in options["beamer_aux_extensions"]:
-        tmp += (" *" + ext)
-    tmp += "\n"
-    write_long_lines(fid, tmp)
-    fid.write("\n")
-
-    tmp = "GLS_AUX_EXT="
-    for ext in options["glossary_aux_extensions"]:
-        tmp += (" *" + ext)
-    tmp += "\n"
-    write_long_lines(fid, tmp)
-    fid.write("\n")
-
-    tmp = "PKG_AUX_EXT="
-    for ext in options["pkg_aux_extensions"]:
-        tmp += (" *" + ext)
-    tmp += "\n"
-    write_long_lines(fid, tmp)
-    fid.write("\n")
-
-    tmp = "FIG_EXT="
-    for ext in options["fig_extensions"]:
-        tmp += (" *" + ext)
-    tmp += "\n"
-    write_long_lines(fid, tmp)
+    # content stamps (updated once per make, before any rule is considered)
+    fid.write("# Content stamps: the rules depend on these, so files that are")
+    fid.write(" touched but not\n# changed (git checkout) do not cause a")
+    fid.write(" rebuild\n")
+    stamp_dir = os.path.join(options["latexmake_dir"], "stamps")
+    fid.write("STAMP_DIR=" + stamp_dir + "\n")
+    if options["tikz_externalize"] and options["tikz_figures"]:
+        fid.write("TIKZ_STAMP_DIR=${STAMP_DIR}/tikz\n")
+    tmp = "STAMPS="
+    for f in stamped_files(options):
+        tmp += " " + stamp_name("${STAMP_DIR}", f)
+    write_long_lines(fid, tmp + "\n")
+    fid.write("# (the clean targets neither stamp nor regenerate the Makefile)\n")
+    fid.write("CLEAN_ONLY:=$(if $(filter-out clean% rmlog," + \
+        "$(or $(MAKECMDGOALS),all)),,1)\n")
+    fid.write("ifndef LATEXMAKE_STAMPED\n")
+    fid.write("ifndef CLEAN_ONLY\n")
+    write_long_lines(fid, "LATEXMAKE_STAMPED:=$(shell ${LATEXMAKE} stamps " + \
+        "--dir=${STAMP_DIR} -- ${TEX_FILES} ${BIB_FILES} ${FIG_FILES} " + \
+        "${STY_FILES} ${CLS_FILES})\n")
+    if options["tikz_externalize"] and options["tikz_figures"]:
+        # the digests of the code of each picture
+        write_long_lines(fid, "LATEXMAKE_STAMPED+=$(shell ${LATEXMAKE} " + \
+            "tikzstamps --dir=${TIKZ_STAMP_DIR} -- " + " ".join([ \
+            pipes.quote(arg) for arg in options["argv"] \
+            if arg.find("--") == 0]) + " ${SOURCE}.tex)\n")
+    fid.write("endif\n")
+    fid.write("endif\n")
+    fid.write("export LATEXMAKE_STAMPED\n")
     fid.write("\n")
 
-    tmp = "ALL_AUX_EXT=${TEX_AUX_EXT} ${BIB_AUX_EXT} ${IDX_AUX_EXT} " + \
-        "${BEAMER_AUX_EXT} ${GLS_AUX_EXT} ${PKG_AUX_EXT} ${FIG_AUX_EXT}\n"
-    write_long_lines(fid, tmp)
+    # structural fingerprint (see write_regenerate_rules)
+    fid.write("# Regenerating the Makefile\n")
+    write_long_lines(fid, "LATEXMAKE_ARGS=" + " ".join([pipes.quote(arg) \
+        for arg in options["argv"]]) + "\n")
+    fid.write("FINGERPRINT=" + fingerprint_name(options) + "\n")
+    write_long_lines(fid, "STRUCTURE_FILES= " + \
+        " ".join(structure_files(options)) + "\n")
+    write_long_lines(fid, "STRUCTURE_STAMPS= " + " ".join([stamp_name( \
+        "${STAMP_DIR}", f) for f in structure_files(options)]) + "\n")
     fid.write("\n\n")
 
     fid.write("#" * 80 + "\n")
@@ -1557,84 +3888,140 @@ def write_makefile(fid, options):
     fid.write("#" * 80 + "\n")
 
 
+    # prerequisites of every compile
+    deps = "${STAMPS}"
+    if options["fig_conv_files"]:
+        deps += " ${FIG_CONV_FILES}"
+    if options["tikz_externalize"] and options["tikz_figures"]:
+        deps += " ${TIKZ_FIGURES}"
+
+    # the output formats (latex2rtf makes an rtf file)
+    formats = list(options["output_extension"])
+    if options["has_latex2rtf"] and "rtf" not in formats:
+        formats.append("rtf")
+
+    # the compile commands
+    aux = "${SOURCE}.aux"
+    order = ""
+    if options["output_directory"]:
+        # everything the engines write goes to ${OUT_DIR}
+        aux = "${OUT_DIR}/${SOURCE}.aux"
+        order = " | ${OUT_DIRS}"
+        (tex_cmd, bib_cmd, idx_cmd, gls_cmd) = compile_commands(options, \
+            "${OUT_DIR}")
+    else:
+        (tex_cmd, bib_cmd, idx_cmd, gls_cmd) = compile_commands(options)
+
     fid.write("\n")
     fid.write("# all extensions\n")
     fid.write(".PHONY: all\n")
-    fid.write("all: ${TEX_FILES} ${BIB_FILES} ${FIG_FILES}")
     exts = options["output_extension"]
-    for ext in exts[1:]:
-        fid.write(" ${SOURCE}." + ext)
-    fid.write("\n")
+    fid.write("all: " + " ".join(["${SOURCE}." + ext for ext in exts]) + "\n")
+    if options["use_open"]:
+        fid.write("\t${MAKE} -f ${THIS_MAKEFILE} -e view\n")
+
+    # the main output is compiled in place (the content stamps are newer
+    # than it when a source changed)
+    fid.write("\n\n")
+    fid.write("# the " + exts[0] + " file\n")
+    fid.write("${SOURCE}." + exts[0] + ": " + deps + order + "\n")
+    if options["use_build_cache"]:
+        # reuse the output of an identical build if there is one
+        tmp = "${LATEXMAKE} buildcache fetch ${BUILD_CACHE_ARGS} "
+        if options["output_directory"]:
+            tmp += "&& ${CP} ${OUT_DIR}/${SOURCE}." + \
+                options["output_extension"][0] + " . "
+        tmp += "|| ( ${MAKE} -f ${THIS_MAKEFILE} -e compile && " + \
+            "${LATEXMAKE} buildcache store ${BUILD_CACHE_ARGS} )\n"
+        write_long_lines(fid, tmp, n_tabs=1)
+
+        fid.write("\n\n")
+        fid.write("# compile without the build cache\n")
+        fid.write(".PHONY: compile\n")
+        fid.write("compile: " + deps + order + "\n")
     if options["make_bib_in_default"] or \
         options["make_index_in_default"] or \
         options["make_glossary_in_default"]:
-        fid.write("\t${TEX_ENGINE} ${TEX_OPTIONS} ${SOURCE}.tex\n")
+        fid.write("\t" + tex_cmd + "\n")
         if options["make_bib_in_default"]:
-            fid.write("\t${BIB_ENGINE} ${SOURCE}\n")
+            fid.write("\t" + bib_cmd + "\n")
         if options["make_index_in_default"]:
-            fid.write("\t${IDX_ENGINE} ${SOURCE}\n")
+            fid.write("\t" + idx_cmd + "\n")
         if options["make_glossary_in_default"]:
-            fid.write("\t${GLS_ENGINE} ${SOURCE}\n")
-    fid.write("\t${MAKE} -e final\n")
-    if options["use_open"]:
-        fid.write("\t${MAKE} -e view\n")
-
-    # write the code to make the main part of the makefile
-    for ext in options["output_extension"]:
+            fid.write("\t" + gls_cmd + "\n")
+    fid.write("\t${MAKE} -f ${THIS_MAKEFILE} -e final\n")
+
+    # write the code to make the main part of the makefile (the other formats
+    # are compiled in FORMAT_DIR)
+    for ext in formats:
+        if ext == exts[0]:
+            continue
         fid.write("\n\n")
         fid.write("# the " + ext + " file\n")
-        fid.write("${SOURCE}." + ext + ": ${TEX_FILES} ${BIB_FILES} ${FIG_FILES}\n")
-        if options["make_bib_in_default"] or options["make_index_in_default"]:
-            fid.write("\t${TEX_ENGINE} ${TEX_OPTIONS} ${SOURCE}.tex\n")
-            if options["make_bib_in_default"]:
-                fid.write("\t${BIB_ENGINE} ${SOURCE}\n")
-            if options["make_index_in_default"]:
-                fid.write("\t${GLS_ENGINE} ${SOURCE}\n")
-        fid.write("\t${MAKE} -e final\n")
+        write_format_rule(fid, options, ext, deps)
+
+    fid.write("\n\n")
+    fid.write("# every output format (use make -j to make them in parallel)\n")
+    fid.write(".PHONY: formats\n")
+    fid.write("formats: " + " ".join(["${SOURCE}." + ext for ext in formats]) + \
+        "\n")
 
     # final is the last 2 latex compiles
     fid.write("\n\n")
     fid.write("# final is the last 2 latex compiles\n")
     fid.write(".PHONY: final\n")
-    fid.write("final: ${TEX_FILES} ${BIB_FILES} ${FIG_FILES}\n")
-    fid.write("\t${TEX_ENGINE} ${TEX_OPTIONS} ${SOURCE}.tex\n")
-    fid.write("\t${TEX_ENGINE} ${TEX_OPTIONS} ${SOURCE}.tex\n")
+    fid.write("final: " + deps + order + "\n")
+    fid.write("\t" + tex_cmd + "\n")
+    fid.write("\t" + tex_cmd + "\n")
+    if options["output_directory"]:
+        fid.write("\t${CP} ${OUT_DIR}/${SOURCE}." + \
+            options["output_extension"][0] + " .\n")
+
+    if options["include_files"]:
+        write_includeonly_rules(fid, options, deps, order)
+
+    # previews of the included files
+    write_preview_rules(fid, options)
+
+    # externalized tikz pictures
+    if options["tikz_externalize"] and options["tikz_figures"]:
+        write_tikz_rules(fid, options)
 
     # update does not run the first latex
     fid.write("\n\n")
     fid.write("# update is the last 2 latex compiles\n")
     fid.write(".PHONY: update\n")
-    fid.write("update: ${TEX_FILES} ${BIB_FILES} ${FIG_FILES}\n")
+    fid.write("update: " + deps + order + "\n")
     if options["make_bib_in_default"] or options["make_index_in_default"]:
         if options["make_bib_in_default"]:
-            fid.write("\t${BIB_ENGINE} ${SOURCE}\n")
+            fid.write("\t" + bib_cmd + "\n")
         if options["make_index_in_default"]:
-            fid.write("\t${GLS_ENGINE} ${SOURCE}\n")
-    fid.write("\t${MAKE} -e final\n")
+            fid.write("\t" + gls_cmd + "\n")
+    fid.write("\t${MAKE} -f ${THIS_MAKEFILE} -e final\n")
 
     # bibliography
     fid.write("\n\n")
     fid.write("# make a bibliography\n")
     fid.write(".PHONY: bibliography\n")
-    fid.write("bibliography: ${SOURCE}.aux ${TEX_FILES} ${BIB_FILES}\n")
-    fid.write("\t${BIB_ENGINE} ${SOURCE}\n")
-    fid.write("\t${MAKE} -e final\n")
+    fid.write("bibliography: " + aux + " ${TEX_FILES} ${BIB_FILES}\n")
+    fid.write("\t" + bib_cmd + "\n")
+    fid.write("\t${MAKE} -f ${THIS_MAKEFILE} -e final\n")
 
     # glossary
     fid.write("\n\n")
     fid.write("# make a glossary\n")
     fid.write(".PHONY: glossary\n")
-    fid.write("glossary: ${SOURCE}.aux ${TEX_FILES}\n")
-    fid.write("\t${GLS_ENGINE} ${SOURCE}\n")
-    fid.write("\t${MAKE} -e final\n")
+    fid.write("glossary: " + aux + " ${TEX_FILES}\n")
+    fid.write("\t" + gls_cmd + "\n")
+    fid.write("\t${MAKE} -f ${THIS_MAKEFILE} -e final\n")
 
     # index
     fid.write("\n\n")
     fid.write("# make a bibliography\n")
     fid.write(".PHONY: index\n")
-    fid.write("index: ${SOURCE}.aux ${TEX_FILES}\n")
-    fid.write("\t${IDX_ENGINE} ${SOURCE}\n")
-    fid.write("\t{MAKE} -e final\n")
+    fid.write("index: " + aux + " ${TEX_FILES}\n")
+    fid.write("\t" + idx_cmd + "\n")
+    fid.write("\t${MAKE} -f ${THIS_MAKEFILE} -e final\n")
 
     # some other builds that might be needed
 
@@ -1650,22 +4037,42 @@ def write_makefile(fid, options):
     fid.write("\n\n")
     fid.write(".PHONY: init\n")
     fid.write("# the aux file, or an init\n")
-    fid.write("${SOURCE}.aux init: ${TEX_FILES} ${BIB_FILES} ${FIG_FILES}\n")
-    fid.write("\t${TEX_ENGINE} ${TEX_OPTIONS} ${SOURCE}.tex\n")
+    fid.write(aux + " init: " + deps + order + "\n")
+    fid.write("\t" + tex_cmd + "\n")
+
+    # output directories
+    if options["output_directory"]:
+        fid.write("\n\n")
+        fid.write("# the output directories\n")
+        fid.write("${OUT_DIRS}:\n")
+        fid.write("\t${MKDIR} -p $@\n")
 
     # clean
     fid.write("\n\n")
     fid.write("# clean auxiliary files\n")
     fid.write(".PHONY: clean\n")
     fid.write("clean:\n")
-    fid.write("\t${RM} ${RMFLAGS} ${ALL_AUX_EXT}\n")
+    # only the files of this root document (\\include'd files have their own
+    # aux files)
+    if options["output_directory"]:
+        clean = "${RM} ${RMFLAGS} ${OUT_DIR}/${SOURCE}.*"
+        if options["include_files"]:
+            clean += " $(addprefix ${OUT_DIR}/,${INCLUDE_FILES:.tex=.aux})"
+    else:
+        clean = "${RM} ${RMFLAGS} " + aux_glob("${JOB_AUX_EXT}", options)
+        if options["include_files"]:
+            clean += " ${INCLUDE_FILES:.tex=.aux}"
+        if options["fig_conv_files"]:
+            clean += " ${FIG_CONV_FILES}"
+    clean += " ${FORMAT_DIR} ${PREVIEW_DIR}"
+    write_long_lines(fid, clean + "\n", n_tabs=1)
 
     # cleanall
     fid.write("\n\n")
     fid.write("# clean all output files\n")
     fid.write(".PHONY: cleanall\n")
     fid.write("cleanall:\n")
-    tmp = "${RM} ${RMFLAGS} ${ALL_AUX_EXT}"
+    tmp = clean
     for ext in ["dvi", "ps", "eps", "pdf"]:
         tmp += (" ${SOURCE}." + ext)
     tmp += "\n"
@@ -1676,21 +4083,36 @@ def write_makefile(fid, options):
     fid.write("# clean general auxiliary files\n")
     fid.write(".PHONY: cleangeneral\n")
     fid.write("cleangeneral:\n")
-    fid.write("\t${RM} ${RMFLAGS} ${TEX_AUX_EXT}\n")
+    fid.write("\t${RM} ${RMFLAGS} " + aux_glob("${TEX_AUX_EXT}", options) + "\n")
 
     # clean beamer
     fid.write("\n\n")
     fid.write("# clean beamer auxiliary files\n")
     fid.write(".PHONY: cleanbeamer\n")
     fid.write("cleanbeamer:\n")
-    fid.write("\t${RM} ${RMFLAGS} ${BEAMER_AUX_EXT}\n")
+    fid.write("\t${RM} ${RMFLAGS} " + aux_glob("${BEAMER_AUX_EXT}", options) + "\n")
 
     # clean bib
     fid.write("\n\n")
     fid.write("# clean bibliography auxiliary files\n")
     fid.write(".PHONY: cleanbib\n")
     fid.write("cleanbib:\n")
-    fid.write("\t${RM} ${RMFLAGS} ${BIB_AUX_EXT}\n")
+    fid.write("\t${RM} ${RMFLAGS} " + aux_glob("${BIB_AUX_EXT}", options) + "\n")
+    if options["trim_bibliography"] and options["bib_engine"] != "BIBER":
+        fid.write("\t${RM} ${RMFLAGS} ${BIB_SUBSET_DIR}\n")
+
+    # figure conversions
+    if options["fig_conv_files"]:
+        fid.write("\n\n")
+        fid.write("# convert figures (identical figures are only converted once")
+        fid.write(" per machine)\n")
+        for figure in options["fig_conv_files"]:
+            fid.write(converted_figure_name(figure, options) + ": " + \
+                stamp_name("${STAMP_DIR}", figure) + "\n")
+            write_long_lines(fid, "${TIMED} ${LATEXMAKE} convertfig " + \
+                "--cache-dir=${FIG_CACHE_DIR} --cache-size=${FIG_CACHE_SIZE} " + \
+                "--epstopdf=${EPSTOPDF} --ps2eps=${PS2EPS} " + figure + \
+                " $@\n", n_tabs=1)
 
     # clean figs
     fid.write("\n\n")
@@ -1700,17 +4122,15 @@ def write_makefile(fid, options):
     tmp = "${RM} ${RMFLAGS}"
     for path in options["graphics_paths"]:
         tmp += (" " + os.path.join(path, "*-converted-to.pdf"))
+    if options["tikz_externalize"] and options["tikz_figures"]:
+        # the pictures and their .md5, .log and .dpth files
+        tmp += " ${TIKZ_FIGURES} ${TIKZ_FIGURES:.pdf=.md5} " + \
+            "${TIKZ_FIGURES:.pdf=.log} ${TIKZ_FIGURES:.pdf=.dpth}"
     tmp += "\n"
     write_long_lines(fid, tmp, 80, 8, 1, False)
     fid.write("\n\n")
 
 
-    if options["has_latex2rtf"]:
-        fid.write("\n\n")
-        fid.write("# make rtf file\n")
-        fid.write("${SOURCE}.rtf: ${TEX_FILES} ${BIB_FILES} ${FIG_FILES}\n")
-        fid.write("\t${LATEX2RTF} ${LATEX2RTF_OPTIONS} ${SOURCE}.tex\n")
-
 
     if options["has_git"]:
         # git backup with message "bkup"
@@ -1742,6 +4162,11 @@ def write_makefile(fid, options):
         for ext in ['pdf', 'eps', 'ps', 'dvi']:
             fid.write("\t${ECHO} ${SOURCE}." + ext + " >> .gitignore\n")
 
+        if options["output_directory"]:
+            fid.write("\t${ECHO} '' >> .gitignore\n")
+            fid.write("\t${ECHO} '# output directory' >> .gitignore\n")
+            fid.write("\t${ECHO} '/${OUT_DIR}/' >> .gitignore\n")
+
         fid.write("\t${ECHO} '' >> .gitignore\n")
         fid.write("\t${ECHO} '# TeX auxiliary files' >> .gitignore\n")
         for ext in options['tex_aux_extensions']:
@@ -1834,109 +4259,41 @@ def write_makefile(fid, options):
 
 
     # zipped files (include pdf)
+    archive_files = "${TEX_FILES} ${BIB_FILES} ${FIG_FILES} ${STY_FILES} " + \
+        "${CLS_FILES} Makefile"
+    archive_cmd = "${LATEXMAKE} archive"
+    if options["texmf_pkg_pth"]:
+        archive_cmd += " --texmf-paths=\"${TEXMF_PATHS}\"" + \
+            " --texmf=\"${TEXMF_PKG_PTH}\""
+
     fid.write("\n\n")
     fid.write("# make zip (include output document)\n")
     fid.write(".PHONY: zip\n")
-    tmp = "${TEX_FILES} ${BIB_FILES} ${FIG_FILES} ${STY_FILES} ${CLS_FILES} "
-    tmp += "Makefile" # {SOURCE}.pdf # TODO: figure out pdf/ps/eps/dvi output extension
-    write_long_lines(fid, "zip: " + tmp + "\n")
-    if options["texmf_pkg_pth"]:
-        fid.write("\t$(eval TMP := $(shell ${MKTEMP} -d -t latexmake))\n")
-        fid.write("\t$(info Temporary Directory: ${TMP})\n")
-        fid.write("\t${MKDIR} -p ${TMP}/texmf\n")
-        fid.write("\t${ECHO} 'This project contains files in a texmf directory.'")
-        fid.write(" >> ${TMP}/texmf/readme\n")
-        fid.write("\t${ECHO} 'These files should be placed in a texmf directory")
-        fid.write(" on your machine.' >> ${TMP}/texmf/readme\n")
-        fid.write("\t${ECHO} 'The texmf directories on this machine are:' >>")
-        fid.write(" ${TMP}/texmf/readme\n")
-        for tmp2 in options["texmf_path"]:
-            fid.write("\t${ECHO} '  " + tmp2 + "' >> ${TMP}/texmf/readme\n")
-        fid.write("\tfor f in ${TEXMF_PKG_PTH} do \\\n")
-        fid.write("\t\t${CP} -r $$f ${TMP}/texmf \\\n")
-        fid.write("\tdone\n")
-        tmp += " ${TMP}/texmf"
-    write_long_lines(fid, "${ZIP} -rq ${SOURCE}.zip " + tmp + "\n", n_tabs=1)
-    if options["texmf_pkg_pth"]:
-        fid.write("\t${RM} ${RMFLAGS} ${TMP}\n")
+    write_long_lines(fid, "zip: " + archive_files + "\n")
+    write_long_lines(fid, archive_cmd + " --output=${SOURCE}.zip -- " + \
+        archive_files + " ${SOURCE}." + options["output_extension"][0] + "\n", \
+        n_tabs=1)
 
     fid.write("\n\n")
     fid.write("# make zip (source only)\n")
     fid.write(".PHONY: zipsource\n")
-    tmp = "${TEX_FILES} ${BIB_FILES} ${FIG_FILES} ${STY_FILES} ${CLS_FILES} "
-    tmp += "Makefile"
-    write_long_lines(fid, "zipsource: " + tmp + "\n")
-    if options["texmf_pkg_pth"]:
-        fid.write("\t$(eval TMP := $(shell ${MKTEMP} -d -t latexmake))\n")
-        fid.write("\t$(info Temporary Directory: ${TMP})\n")
-        fid.write("\t${MKDIR} -p ${TMP}/texmf\n")
-        fid.write("\t${ECHO} 'This project contains files in a texmf directory.'")
-        fid.write(" >> ${TMP}/texmf/readme\n")
-        fid.write("\t${ECHO} 'These files should be placed in a texmf directory ")
-        fid.write("on your machine.' >> ${TMP}/texmf/readme\n")
-        fid.write("\t${ECHO} 'The texmf directories on this machine are:' >> ")
-        fid.write("${TMP}/texmf/readme\n")
-        for tmp2 in options["texmf_path"]:
-            fid.write("\t${ECHO} '  " + tmp2 + "' >> ${TMP}/texmf/readme\n")
-        fid.write("\tfor f in ${TEXMF_PKG_PTH} do \\\n")
-        fid.write("\t\t${CP} -r $$f ${TMP}/texmf \\\n")
-        fid.write("\tdone\n")
-        tmp += " ${TMP}/texmf"
-    write_long_lines(fid, "${ZIP} -rq ${SOURCE}.zip " + tmp + "\n", n_tabs=1)
-    if options["texmf_pkg_pth"]:
-        fid.write("\t${RM} ${RMFLAGS} ${TMP}\n")
+    write_long_lines(fid, "zipsource: " + archive_files + "\n")
+    write_long_lines(fid, archive_cmd + " --output=${SOURCE}.zip -- " + \
+        archive_files + "\n", n_tabs=1)
 
     fid.write("\n\n")
     fid.write("# make gzip (source only)\n")
     fid.write(".PHONY: gzip\n")
-    tmp = "${TEX_FILES} ${BIB_FILES} ${FIG_FILES} ${STY_FILES} ${CLS_FILES} "
-    tmp += "Makefile"
-    write_long_lines(fid, "gzip: " + tmp + "\n")
-    if options["texmf_pkg_pth"]:
-        fid.write("\t$(eval TMP := $(shell ${MKTEMP} -d -t latexmake))\n")
-        fid.write("\t$(info Temporary Directory: ${TMP})\n")
-        fid.write("\t${MKDIR} -p ${TMP}/texmf\n")
-        fid.write("\t${ECHO} 'This project contains files in a texmf directory.'")
-        fid.write(" >> ${TMP}/texmf/readme\n")
-        fid.write("\t${ECHO} 'These files should be placed in a texmf directory ")
-        fid.write("on your machine.' >> ${TMP}/texmf/readme\n")
-        fid.write("\t${ECHO} 'The texmf directories on this machine are:' >> ")
-        fid.write("${TMP}/texmf/readme\n")
-        for tmp2 in options["texmf_path"]:
-            fid.write("\t${ECHO} '  " + tmp2 + "' >> ${TMP}/texmf/readme\n")
-        fid.write("\tfor f in ${TEXMF_PKG_PTH} do \\\n")
-        fid.write("\t\t${CP} -r $$f ${TMP}/texmf \\\n")
-        fid.write("\tdone\n")
-        tmp += " ${TMP}/texmf"
-    write_long_lines(fid, "${TAR} -cvzf ${SOURCE}.tar.gz " + tmp + "\n", n_tabs=1)
-    if options["texmf_pkg_pth"]:
-        fid.write("\t${RM} ${RMFLAGS} ${TMP}\n")
+    write_long_lines(fid, "gzip: " + archive_files + "\n")
+    write_long_lines(fid, archive_cmd + " --output=${SOURCE}.tar.gz -- " + \
+        archive_files + "\n", n_tabs=1)
 
     fid.write("\n\n")
     fid.write("# make gzip (source only)\n")
     fid.write(".PHONY: gzipsource\n")
-    tmp = "${TEX_FILES} ${BIB_FILES} ${FIG_FILES} ${STY_FILES} ${CLS_FILES} "
-    tmp += "Makefile"
-    write_long_lines(fid, "gzipsource: " + tmp + "\n")
-    if options["texmf_pkg_pth"]:
-        fid.write("\t$(eval TMP := $(shell ${MKTEMP} -d -t latexmake))\n")
-        fid.write("\t$(info Temporary Directory: ${TMP})\n")
-        fid.write("\t${MKDIR} -p ${TMP}/texmf\n")
-        fid.write("\t${ECHO} 'This project contains files in a texmf directory.'")
-        fid.write(" >> ${TMP}/texmf/readme\n")
-        fid.write("\t${ECHO} 'These files should be placed in a texmf directory on")
-        fid.write(" your machine.' >> ${TMP}/texmf/readme\n")
-        fid.write("\t${ECHO} 'The texmf directories on this machine are:' >> ")
-        fid.write("${TMP}/texmf/readme\n")
-        for tmp2 in options["texmf_path"]:
-            fid.write("\t${ECHO} '  " + tmp2 + "' >> ${TMP}/texmf/readme\n")
-        fid.write("\tfor f in ${TEXMF_PKG_PTH} do \\\n")
-        fid.write("\t\t${CP} -r $$f ${TMP}/texmf \\\n")
-        fid.write("\tdone\n")
-        tmp += " ${TMP}/texmf"
-    write_long_lines(fid, "${TAR} -cvzf ${SOURCE}.tar.gz " + tmp + "\n", n_tabs=1)
-    if options["texmf_pkg_pth"]:
-        fid.write("\t${RM} ${RMFLAGS} ${TMP}\n")
+    write_long_lines(fid, "gzipsource: " + archive_files + "\n")
+    write_long_lines(fid, archive_cmd + " --output=${SOURCE}.tar.gz -- " + \
+        archive_files + "\n", n_tabs=1)
 
 
     # tools
@@ -1945,64 +4302,1554 @@ def write_makefile(fid, options):
     fid.write(".PHONY: rmlog\n")
     fid.write("rmlog:\n")
     fid.write("\t${FIND} . -name '*.log' -exec ${RM} ${RMFLAGS} {} \\n")
+
+    write_regenerate_rules(fid, options)
     return
-# fed write_makefile(fid)
+# fed write_makefile(fid, options, common)
 #-------------------------------------------------------------------------------
 
-
 #-------------------------------------------------------------------------------
-if __name__ == "__main__":
-    try:
-        args = sys.argv
-        if not args:
-            sys.exit("Usage:\nlatexmake.py [options] filename.tex")
-        
-        # set the default parameters
-        params = latexmake_default_params()
-
-        # get the file name (always last argument)
-        tmp = args[-1]
+def write_common_variables(fid, options):
+    # the variables that do not depend on the root document: the commands,
+    # flags, caches and the sets of auxiliary extensions
+    fid.write("# latexmake\n")
+    fid.write("# \tThis may not be in the same location on other systems\n")
+    fid.write("LATEXMAKE=" + options["latexmake"] + "\n")
+    fid.write("\n\n")
 
-        # make sure the file exists
-        if not os.path.isfile(tmp):
-            # we may have left the extension off
-            tmp += ".tex"
-            if not os.path.isfile(tmp):
-                sys.exit("The file " + args[-1] + " does not exist.")
+    # TeX commands
+    fid.write("# TeX commands (MODIFY AT YOUR OWN RISK)\n")
+    fid.write("TEX=" + options["tex"] + "\n")
+    fid.write("LATEX=" + options["latex"] + "\n")
+    fid.write("PDFLATEX=" + options["pdflatex"] + "\n")
+    fid.write("LUATEX=" + options["luatex"] + "\n")
+    fid.write("LUALATEX=" + options["lualatex"] + "\n")
+    fid.write("XELATEX=" + options["xelatex"] + "\n")
+    fid.write("XETEX=" + options["xetex"] + "\n")
+    fid.write("BIBTEX=" + options["bibtex"] + "\n")
+    fid.write("BIBER=" + options["biber"] + "\n")
+    fid.write("DVIPS=" + options["dvips"] + "\n")
+    fid.write("PS2EPS=" + options["ps2eps"] + "\n")
+    fid.write("PSTOPDF=" + options["pstopdf"] + "\n")
+    fid.write("EPSTOPDF=" + options["epstopdf"] + "\n")
+    fid.write("MAKEGLOSSARIES=" + options["makeglossaries"] + "\n")
+    fid.write("MAKEINDEX=" + options["makeindex"] + "\n")
+    fid.write("LATEXDIFF=" + options["latexdiff"] + "\n")
+    fid.write("LATEXPAND=" + options["latexpand"] + "\n")
+    fid.write("LATEX2RTF=" + options["latex2rtf"] + "\n")
+    fid.write("BIBSORT=" + options["bibsort"] + "\n")
+    fid.write("# end TeX commands\n")
+    fid.write("\n\n")
 
+    # time the steps of the build (make TIMED= to turn it off)
+    fid.write("# Timing (see latexmake report)\n")
+    fid.write("TIMING_LOG?=${CURDIR}/" + os.path.join(options["latexmake_dir"], \
+        "timing.jsonl") + "\n")
+    fid.write("TIMED?=${LATEXMAKE} timing --log=${TIMING_LOG} --\n")
+    fid.write("ifndef LATEXMAKE_BUILD_ID\n")
+    fid.write("LATEXMAKE_BUILD_ID:=$(shell date +%Y-%m-%dT%H:%M:%S)\n")
+    fid.write("endif\n")
+    fid.write("export LATEXMAKE_BUILD_ID\n")
+    fid.write("\n")
 
-        # get the absolute path to the source file
-        (pth, tmp) = os.path.split(os.path.abspath(tmp))
-        params["path"] = pth
+    # write the tex command flags
+    fid.write("# TeX flags\n")
+    fid.write("TEXFLAGS?=" + options["tex_flags"] + "\n")
+    fid.write("LATEX2RTFFLAGS?=" + options["latex2rtf_flags"] + "\n")
+    fid.write("# options of each engine (TEX_ENGINE makes the main output, ")
+    fid.write("LATEX the dvi and ps files)\n")
+    fid.write("TEX_OPTIONS?=\n")
+    fid.write("LATEX_OPTIONS?=\n")
+    fid.write("LATEX2RTF_OPTIONS?=\n")
+    fid.write("\n")
 
-        idx = tmp.find(".tex")
+    # write the other enigines of other uitilies
+    fid.write("# UNIX commands\n")
+    fid.write("MAKE=" + options["make"] + "\n")
+    fid.write("RM=" + options["rm"] + "\n")
+    fid.write("ECHO=" + options["echo"] + "\n")
+    fid.write("FIND=" + options["find"] + "\n")
+    fid.write("CD=" + options["cd"] + "\n")
+    fid.write("CP=" + options["cp"] + "\n")
+    fid.write("PWD=" + options["pwd"] + "\n")
+    fid.write("TAR=" + options["tar"] + "\n")
+    fid.write("ZIP=" + options["zip"] + "\n")
+    if options["has_git"]:
+        fid.write("GIT=" + options["git"] + "\n")
+    if options["use_open"]:
+        fid.write("OPEN=" + options["open"] + "\n")
+    if options["has_mktemp"]:
+        fid.write("MKTEMP=" + options["mktemp"] + "\n")
+    fid.write("MKDIR=" + options["mkdir"] + "\n")
+    fid.write("\n")
 
-        params["tex_files"].append(os.path.abspath(tmp))
+    # unix command flags
+    fid.write("# UNIX flags\n")
+    fid.write("RMFLAGS?=" + options["rm_flags"] + "\n")
+    fid.write("\n")
 
-        if idx < 0:
-            sys.exit("The file " + args[-1] + " does not have a .tex extension.")
-        else:
-            tmp = tmp[:idx]
-        params["basename"] = tmp
+    # figure cache
+    fid.write("# Converted figure cache (leave FIG_CACHE_DIR empty to disable)\n")
+    fid.write("FIG_CACHE_DIR?=" + options["fig_cache_dir"] + "\n")
+    fid.write("FIG_CACHE_SIZE?=" + str(options["fig_cache_size"]) + "\n")
+    fid.write("\n")
 
-        ## FUTURE: Parse command-line inputs
-        # for arg in args[1:-1]:
-        #     if arg.find("--tex=") == 0:
-        #         pass
-        #     elif arg.find("--bib=") == 0:
-        #         pass
+    # build cache
+    if options["use_build_cache"]:
+        fid.write("# Build cache\n")
+        fid.write("BUILD_CACHE_DIR?=" + options["build_cache_dir"] + "\n")
+        fid.write("BUILD_CACHE_SIZE?=" + str(options["build_cache_size"]) + \
+            "\n")
+        fid.write("\n")
 
-        # parse the latex file
-        params = parse_tex_file(params["basename"] + ".tex", params)
+    fid.write("# Sets of extensions\n")
+    tmp = "TEX_AUX_EXT="
+    for ext in options["tex_aux_extensions"]:
+        tmp += (" *" + ext)
+    tmp += "\n"
+    write_long_lines(fid, tmp)
+    fid.write("\n")
 
-        # open the Makefile
-        fid = open("Makefile", "w")
+    tmp = "BIB_AUX_EXT="
+    for ext in options["bib_aux_extensions"]:
+        tmp += (" *" + ext)
+    tmp += "\n"
+    write_long_lines(fid, tmp)
+    fid.write("\n")
 
-        # write the Makefile
-        write_makefile(fid, params)
+    tmp = "IDX_AUX_EXT="
+    for ext in options["idx_aux_extensions"]:
+        tmp += (" *" + ext)
+    tmp += "\n"
+    write_long_lines(fid, tmp)
+    fid.write("\n")
 
-        # close the makefile
+    tmp = "BEAMER_AUX_EXT="
+    for ext in options["beamer_aux_extensions"]:
+        tmp += (" *" + ext)
+    tmp += "\n"
+    write_long_lines(fid, tmp)
+    fid.write("\n")
+
+    tmp = "GLS_AUX_EXT="
+    for ext in options["glossary_aux_extensions"]:
+        tmp += (" *" + ext)
+    tmp += "\n"
+    write_long_lines(fid, tmp)
+    fid.write("\n")
+
+    tmp = "PKG_AUX_EXT="
+    for ext in options["pkg_aux_extensions"]:
+        tmp += (" *" + ext)
+    tmp += "\n"
+    write_long_lines(fid, tmp)
+    fid.write("\n")
+
+    tmp = "FIG_EXT="
+    for ext in options["fig_extensions"]:
+        tmp += (" *" + ext)
+    tmp += "\n"
+    write_long_lines(fid, tmp)
+    fid.write("\n")
+
+    # the files of one job (see aux_glob) and all of them
+    tmp = "JOB_AUX_EXT=${TEX_AUX_EXT} ${BIB_AUX_EXT} ${IDX_AUX_EXT} " + \
+        "${BEAMER_AUX_EXT} ${GLS_AUX_EXT} ${PKG_AUX_EXT}\n"
+    write_long_lines(fid, tmp)
+    fid.write("ALL_AUX_EXT=${JOB_AUX_EXT} ${FIG_AUX_EXT}\n")
+    fid.write("\n")
+    fid.write("\n")
+    return
+# fed write_common_variables(fid, options)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_roots_makefile(fid, projects):
+    # the Makefile of several root documents. Each root has its own Makefile
+    # (basename.mk, which includes the shared variables of
+    # latexmake_common_makefile), run by make ROOT, make ROOT-TARGET or, for
+    # every root, make TARGET. Variables set on the command line reach every
+    # root
+    roots = [project["basename"] for project in projects]
+
+    fid.write("# Makefile\n")
+    fid.write(latexmake_header())
+    fid.write("\n\n")
+
+    fid.write("# root documents\n")
+    write_long_lines(fid, "ROOTS= " + " ".join(roots) + "\n")
+    fid.write("\n")
+
+    # one build in the timing log for all roots
+    fid.write("ifndef LATEXMAKE_BUILD_ID\n")
+    fid.write("LATEXMAKE_BUILD_ID:=$(shell date +%Y-%m-%dT%H:%M:%S)\n")
+    fid.write("endif\n")
+    fid.write("export LATEXMAKE_BUILD_ID\n")
+    fid.write("\n")
+
+    # the roots share figure conversions and content stamps
+    fid.write(".NOTPARALLEL:\n")
+    fid.write("\n\n")
+
+    fid.write("# make all the root documents\n")
+    fid.write(".PHONY: all ${ROOTS}\n")
+    fid.write("all: ${ROOTS}\n")
+    for root in roots:
+        fid.write("\n\n")
+        fid.write("# " + root + "\n")
+        fid.write(root + ":\n")
+        fid.write("\t${MAKE} -f " + root + ".mk\n")
+        fid.write(root + "-%:\n")
+        fid.write("\t${MAKE} -f " + root + ".mk $*\n")
+
+    fid.write("\n\n")
+    fid.write("# any other target is made for every root document\n")
+    fid.write("Makefile " + latexmake_common_makefile + " ${ROOTS:=.mk}: ;\n")
+    fid.write(".DEFAULT:\n")
+    fid.write("\tfor root in ${ROOTS}; do \\\n")
+    fid.write("\t\t${MAKE} -f $$root.mk $@ || exit 1; \\\n")
+    fid.write("\tdone\n")
+    return
+# fed write_roots_makefile(fid, projects)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Ninja backend
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+def ninja_escape(path):
+    # escapes a path for use in a build statement
+    return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+# fed ninja_escape(path)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def ninja_paths(paths):
+    return " ".join([ninja_escape(pth) for pth in paths])
+# fed ninja_paths(paths)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_ninja(fid, options):
+    # writes a build.ninja from the same data as write_makefile. TeX and the
+    # bib/index/glossary tools run through latexmake helpers that leave
+    # unchanged outputs alone (restat) and record what TeX read (depfile),
+    # so a no-op build does not run anything
+
+    # finalize the options
+    options = latexmake_finalize_params(options)
+
+    source = options["basename"]
+    outdir = options["output_directory"]
+    out_ext = options["output_extension"][0]
+    (aux, idx, glo, bcf, bbl, ind, gls, output) = tex_output_names(source, \
+        outdir, ["aux", "idx", "glo", "bcf", "bbl", "ind", "gls", out_ext])
+
+    subdirs = output_subdirs(options)
+
+    fid.write("# build.ninja\n")
+    fid.write(latexmake_header())
+    fid.write("\n")
+    fid.write("ninja_required_version = 1.3\n")
+    fid.write("\n")
+
+    # commands
+    fid.write("# commands\n")
+    fid.write("latexmake = " + options["latexmake"] + "\n")
+    fid.write("tex_engine = " + options[options["tex_engine"].lower()] + "\n")
+    fid.write("tex_flags = " + options["tex_flags"] + "\n")
+    fid.write("bib_engine = " + options[options["bib_engine"].lower()] + "\n")
+    fid.write("idx_engine = " + options[options["idx_engine"].lower()] + "\n")
+    fid.write("gls_engine = " + options[options["gls_engine"].lower()] + "\n")
+    fid.write("epstopdf = " + options["epstopdf"] + "\n")
+    fid.write("ps2eps = " + options["ps2eps"] + "\n")
+    if options["has_latex2rtf"]:
+        fid.write("latex2rtf = " + options["latex2rtf"] + "\n")
+        fid.write("latex2rtf_flags = " + options["latex2rtf_flags"] + "\n")
+    fid.write("fig_cache_dir = " + options["fig_cache_dir"] + "\n")
+    fid.write("fig_cache_size = " + str(options["fig_cache_size"]) + "\n")
+    fid.write("source = " + source + "\n")
+    fid.write("outdir = " + outdir + "\n")
+    fid.write("\n")
+
+    # rules
+    fid.write("rule tex\n")
+    tmp = "  command = $latexmake texpass --engine=$tex_engine " + \
+        "--flags=\"$tex_flags\" --source=$source --passes=$passes " + \
+        "--keep=$keep --depfile=$out.d --target=$out"
+    if outdir:
+        tmp += " --output-directory=$outdir --subdirs=" + ",".join(subdirs)
+    fid.write(tmp + "\n")
+    fid.write("  description = TEX $out\n")
+    fid.write("  depfile = $out.d\n")
+    fid.write("  deps = gcc\n")
+    fid.write("  restat = 1\n")
+    fid.write("\n")
+
+    fid.write("rule bib\n")
+    if outdir and options["bib_engine"] == "BIBER":
+        fid.write("  command = $latexmake unchanged --outputs=$out -- " + \
+            "$bib_engine --input-directory=$outdir --output-directory=$outdir " + \
+            "$source\n")
+    elif outdir:
+        # bibtex has to run in the output directory (see write_makefile)
+        cwd = os.path.abspath(".")
+        fid.write("  command = BIBINPUTS=" + ninja_escape(cwd) + "$: " + \
+            "BSTINPUTS=" + ninja_escape(cwd) + "$: $latexmake unchanged " + \
+            "--outputs=$out --directory=$outdir -- $bib_engine $source\n")
+    else:
+        fid.write("  command = $latexmake unchanged --outputs=$out -- " + \
+            "$bib_engine $source\n")
+    fid.write("  description = BIB $out\n")
+    fid.write("  restat = 1\n")
+    fid.write("\n")
+
+    fid.write("rule idx\n")
+    fid.write("  command = $latexmake unchanged --outputs=$out -- " + \
+        "$idx_engine $in\n")
+    fid.write("  description = IDX $out\n")
+    fid.write("  restat = 1\n")
+    fid.write("\n")
+
+    fid.write("rule gls\n")
+    if outdir:
+        fid.write("  command = $latexmake unchanged --outputs=$out -- " + \
+            "$gls_engine -d $outdir $source\n")
+    else:
+        fid.write("  command = $latexmake unchanged --outputs=$out -- " + \
+            "$gls_engine $source\n")
+    fid.write("  description = GLS $out\n")
+    fid.write("  restat = 1\n")
+    fid.write("\n")
+
+    fid.write("rule convertfig\n")
+    fid.write("  command = $latexmake convertfig --cache-dir=$fig_cache_dir " + \
+        "--cache-size=$fig_cache_size --epstopdf=$epstopdf --ps2eps=$ps2eps " + \
+        "$in $out\n")
+    fid.write("  description = CONVERT $in\n")
+    fid.write("\n")
+
+    fid.write("rule copy\n")
+    fid.write("  command = " + options["cp"] + " $in $out\n")
+    fid.write("\n")
+
+    if options["has_latex2rtf"]:
+        fid.write("rule rtf\n")
+        fid.write("  command = $latex2rtf $latex2rtf_flags $in\n")
+        fid.write("  description = RTF $out\n")
+        fid.write("\n")
+
+    fid.write("rule clean\n")
+    fid.write("  command = " + options["rm"] + " " + options["rm_flags"] + \
+        " $files\n")
+    fid.write("  description = CLEAN\n")
+    fid.write("\n")
+
+    # build statements
+    deps = options["tex_files"] + options["sty_files"] + \
+        options["cls_files"] + options["fig_files"] + \
+        [converted_figure_name(f, options) for f in options["fig_conv_files"]]
+    deps = [f for f in unique(deps) if f != source + ".tex"]
+
+    fid.write("\n")
+    fid.write("# converted figures\n")
+    for figure in options["fig_conv_files"]:
+        fid.write("build " + ninja_escape(converted_figure_name(figure, \
+            options)) + ": convertfig " + ninja_escape(figure) + "\n")
+    fid.write("\n")
+
+    # the first pass writes everything the tools need
+    first = []
+    keep = ["aux"]
+    if options["make_index_in_default"]:
+        first.append(idx)
+        keep.append("idx")
+    if options["make_glossary_in_default"]:
+        first.append(glo)
+        keep.append("glo")
+    if options["make_bib_in_default"] and options["bib_engine"] == "BIBER":
+        first.append(bcf)
+        keep.append("bcf")
+    fid.write("# first pass\n")
+    tmp = "build " + ninja_escape(aux)
+    if first:
+        tmp += " | " + ninja_paths(first)
+    tmp += ": tex " + ninja_escape(source + ".tex")
+    if deps:
+        tmp += " | " + ninja_paths(deps)
+    fid.write(tmp + "\n")
+    fid.write("  passes = 1\n")
+    fid.write("  keep = " + ",".join(keep) + "\n")
+    fid.write("\n")
+
+    tools = []
+    if options["make_bib_in_default"]:
+        fid.write("# bibliography\n")
+        tmp = "build " + ninja_escape(bbl) + ": bib " + ninja_escape(aux)
+        bibdeps = options["bib_files"]
+        if options["bib_engine"] == "BIBER":
+            bibdeps = [bcf] + bibdeps
+        if bibdeps:
+            tmp += " | " + ninja_paths(bibdeps)
+        fid.write(tmp + "\n\n")
+        tools.append(bbl)
+    if options["make_index_in_default"]:
+        fid.write("# index\n")
+        fid.write("build " + ninja_escape(ind) + ": idx " + ninja_escape(idx) + \
+            "\n\n")
+        tools.append(ind)
+    if options["make_glossary_in_default"]:
+        fid.write("# glossary\n")
+        fid.write("build " + ninja_escape(gls) + ": gls " + ninja_escape(glo) + \
+            "\n\n")
+        tools.append(gls)
+
+    # the final passes run until the aux file settles
+    fid.write("# final passes\n")
+    fid.write("build " + ninja_escape(output) + ": tex " + \
+        ninja_escape(source + ".tex") + " | " + ninja_paths([aux] + tools + \
+        deps) + "\n")
+    fid.write("  passes = " + str(options["max_passes"]) + "\n")
+    fid.write("  keep = " + ",".join(keep) + "\n")
+    fid.write("\n")
+
+    targets = [source + "." + out_ext]
+    if outdir:
+        fid.write("build " + ninja_escape(source + "." + out_ext) + \
+            ": copy " + ninja_escape(output) + "\n\n")
+
+    if options["has_latex2rtf"]:
+        fid.write("# rtf\n")
+        fid.write("build " + ninja_escape(source + ".rtf") + ": rtf " + \
+            ninja_escape(source + ".tex") + " | " + ninja_paths([aux] + \
+            tools + deps) + "\n\n")
+
+    # clean
+    if outdir:
+        files = [outdir]
+    else:
+        files = ["*" + ext for ext in options["clean_aux_extensions"]]
+    fid.write("# clean\n")
+    fid.write("build clean: clean\n")
+    fid.write("  files = " + " ".join(files) + " .ninja_deps .ninja_log\n")
+    fid.write("build cleanfigs: clean\n")
+    fid.write("  files = " + ninja_paths([converted_figure_name(f, options) \
+        for f in options["fig_conv_files"]]) + "\n")
+    fid.write("\n")
+
+    fid.write("build all: phony " + ninja_paths(targets) + "\n")
+    fid.write("default all\n")
+    return
+# fed write_ninja(fid, options)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Build executor
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+class latexmake_buildStep(object):
+    # a step of the compile graph
+    # name: unique name of the step
+    # action: function called (without arguments) to run the step; returns
+    #   the exit status
+    # requires: names of the steps that must finish first
+    # inputs: files whose contents decide if the step has to run
+    # outputs: files the step makes (the step runs if one is missing)
+    def __init__(self, name, action, requires=[], inputs=[], outputs=[]):
+        self.name = name
+        self.action = action
+        self.requires = list(requires)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+# class latexmake_buildStep(object)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def build_step_key(step):
+    # the digest of a step's inputs
+    h = hashlib.sha1()
+    h.update(step.name + "\0")
+    for f in step.inputs:
+        h.update(f + "\0")
+        if os.path.isfile(f):
+            h.update(file_digest(f) + "\0")
+        else:
+            h.update("missing\0")
+    return h.hexdigest()
+# fed build_step_key(step)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def read_build_state(filename):
+    # the input digests of the steps of the last build
+    if not os.path.isfile(filename):
+        return {}
+    fid = open(filename, "r")
+    try:
+        try:
+            return json.load(fid)
+        except ValueError:
+            return {}
+    finally:
+        fid.close()
+# fed read_build_state(filename)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_build_state(filename, state):
+    pth = os.path.dirname(filename)
+    if pth and not os.path.isdir(pth):
+        os.makedirs(pth)
+    fid = open(filename, "w")
+    json.dump(state, fid, indent=2, sort_keys=True)
+    fid.close()
+    return
+# fed write_build_state(filename, state)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def run_build_step(step, state, force, results):
+    # runs step unless its inputs are unchanged since the last build.
+    # Puts (step, status) on the results queue
+    status = 1
+    try:
+        key = build_step_key(step)
+        missing = [f for f in step.outputs if not os.path.exists(f)]
+        if not force and not missing and state.get(step.name) == key:
+            status = 0
+        else:
+            print "[latexmake] " + step.name
+            status = step.action()
+            if status == 0:
+                state[step.name] = key
+    except Exception:
+        print traceback.format_exc()
+    results.put((step, status))
+    return
+# fed run_build_step(step, state, force, results)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def run_build_steps(steps, state, jobs=1, force=False):
+    # runs the steps in dependency order, with up to jobs steps at a time.
+    # Returns the exit status of the first failing step (0 on success)
+    pending = list(steps)
+    names = set([step.name for step in steps])
+    done = set()
+    running = 0
+    status = 0
+    results = Queue.Queue()
+
+    while pending or running:
+        # start everything that is ready
+        if status == 0:
+            for step in list(pending):
+                if running >= jobs:
+                    break
+                if [r for r in step.requires if r in names and r not in done]:
+                    continue
+                pending.remove(step)
+                thread = threading.Thread(target=run_build_step, \
+                    args=(step, state, force, results))
+                thread.daemon = True
+                thread.start()
+                running += 1
+        elif not running:
+            break
+
+        if not running:
+            # nothing can be started: a dependency cycle
+            raise latexmake_invalidArgument("Cannot order the build steps: " + \
+                ", ".join([step.name for step in pending]))
+
+        (step, step_status) = results.get()
+        running -= 1
+        if step_status == 0:
+            done.add(step.name)
+        elif status == 0:
+            warning("latexmake: " + step.name + " failed")
+            status = step_status
+    return status
+# fed run_build_steps(steps, state, jobs, force)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def build_steps(params):
+    # the compile graph of a scanned project
+    params = latexmake_finalize_params(params)
+
+    source = params["basename"]
+    outdir = params["output_directory"]
+    out_ext = params["output_extension"][0]
+    engine = params[params["tex_engine"].lower()]
+    flags = params["tex_flags"]
+    (aux, idx, glo, bbl, ind, gls, output) = tex_output_names(source, \
+        outdir, ["aux", "idx", "glo", "bbl", "ind", "gls", out_ext])
+    subdirs = output_subdirs(params)
+
+    sources = unique(params["tex_files"] + params["sty_files"] + \
+        params["cls_files"] + params["fig_files"])
+    steps = []
+
+    # figure conversions are independent of each other
+    converted = []
+    for figure in params["fig_conv_files"]:
+        target = converted_figure_name(figure, params)
+        converted.append(target)
+        steps.append(latexmake_buildStep("convert " + figure, \
+            lambda figure=figure, target=target: convert_figure(figure, \
+            target, params["epstopdf"], params["ps2eps"], \
+            params["fig_cache_dir"], params["fig_cache_size"] * 1024 * 1024), \
+            inputs=[figure], outputs=[target]))
+    conversions = ["convert " + figure for figure in params["fig_conv_files"]]
+
+    # the first pass
+    steps.append(latexmake_buildStep("tex", \
+        lambda: run_tex_passes(engine, flags, source, outdir, 1, \
+        ["aux", "idx", "glo"], subdirs=subdirs), \
+        requires=conversions, inputs=sources + converted, outputs=[aux]))
+
+    # the bibliography, index and glossary only depend on the first pass
+    tools = []
+    generated = []
+    if params["make_bib_in_default"]:
+        bib_engine = params[params["bib_engine"].lower()]
+        if params["bib_engine"] == "BIBER":
+            command = [bib_engine, source]
+            if outdir:
+                command = [bib_engine, "--input-directory=" + outdir, \
+                    "--output-directory=" + outdir, source]
+            inputs = tex_output_names(source, outdir, ["bcf"])
+            steps.append(latexmake_buildStep("bib", \
+                lambda command=command: subprocess.call(command), \
+                requires=["tex"], inputs=inputs + params["bib_files"], \
+                outputs=[bbl]))
+        else:
+            steps.append(latexmake_buildStep("bib", \
+                lambda: run_bibtex(bib_engine, source, outdir), \
+                requires=["tex"], inputs=[aux] + params["bib_files"], \
+                outputs=[bbl]))
+        tools.append("bib")
+        generated.append(bbl)
+    if params["make_index_in_default"]:
+        idx_engine = params[params["idx_engine"].lower()]
+        steps.append(latexmake_buildStep("index", \
+            lambda: subprocess.call([idx_engine, idx]), requires=["tex"], \
+            inputs=[idx], outputs=[ind]))
+        tools.append("index")
+        generated.append(ind)
+    if params["make_glossary_in_default"]:
+        gls_engine = params[params["gls_engine"].lower()]
+        command = [gls_engine, source]
+        if outdir:
+            command = [gls_engine, "-d", outdir, source]
+        steps.append(latexmake_buildStep("glossary", \
+            lambda command=command: subprocess.call(command), \
+            requires=["tex"], inputs=[glo], outputs=[gls]))
+        tools.append("glossary")
+        generated.append(gls)
+
+    # the final passes, until the aux file settles
+    steps.append(latexmake_buildStep("final", \
+        lambda: run_tex_passes(engine, flags, source, outdir, \
+        params["max_passes"], ["aux"], subdirs=subdirs), \
+        requires=["tex"] + tools, inputs=sources + converted + generated, \
+        outputs=[output]))
+    if outdir:
+        steps.append(latexmake_buildStep("copy " + output, \
+            lambda: shutil.copyfile(output, source + "." + out_ext) or 0, \
+            requires=["final"], inputs=[output], \
+            outputs=[source + "." + out_ext]))
+
+    # other output formats
+    if params["has_latex2rtf"]:
+        command = [params["latex2rtf"]] + params["latex2rtf_flags"].split()
+        if outdir:
+            command += ["-a", aux, "-b", bbl]
+        command.append(source + ".tex")
+        steps.append(latexmake_buildStep("rtf", \
+            lambda command=command: subprocess.call(command), \
+            requires=["final"], inputs=sources + generated, \
+            outputs=[source + ".rtf"]))
+    return steps
+# fed build_steps(params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def run_bibtex(bib_engine, source, outdir):
+    # bibtex has to run in the output directory (see write_makefile)
+    if not outdir:
+        return subprocess.call([bib_engine, source])
+    env = dict(os.environ)
+    cwd = os.path.abspath(".")
+    env["BIBINPUTS"] = cwd + os.pathsep + env.get("BIBINPUTS", "")
+    env["BSTINPUTS"] = cwd + os.pathsep + env.get("BSTINPUTS", "")
+    return subprocess.call([bib_engine, source], cwd=outdir, env=env)
+# fed run_bibtex(bib_engine, source, outdir)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Dependency graph export
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+def dependency_graph(params):
+    # the scanner's findings as a dictionary (for --emit-json/--emit-dot)
+    files = []
+    seen = set()
+    for (f, kind, included_by) in params["dependencies"]:
+        if (f, kind, included_by) in seen:
+            continue
+        seen.add((f, kind, included_by))
+
+        item = {"path": os.path.relpath(f), "type": kind}
+        if included_by:
+            item["included_by"] = os.path.relpath(included_by)
+        else:
+            item["included_by"] = None
+        if kind == "figure":
+            item["extension"] = os.path.splitext(f)[1]
+        files.append(item)
+
+    # the texmf package paths with ${TEXMF_PATH#} expanded
+    texmf_packages = []
+    for pth in params["texmf_pkg_pth"]:
+        for i in range(0, len(params["texmf_path"])):
+            pth = pth.replace("${TEXMF_PATH" + str(i) + "}", \
+                os.path.expanduser(params["texmf_path"][i]))
+        texmf_packages.append(pth)
+
+    graph = {}
+    graph["latexmake_version"] = latexmake_version()
+    graph["source"] = params["basename"]
+    graph["engines"] = {
+        "tex": params["tex_engine"],
+        "bib": params["bib_engine"],
+        "index": params["idx_engine"],
+        "glossary": params["gls_engine"],
+        "tex_flags": params["tex_flags"],
+        "make_bib": params["make_bib_in_default"],
+        "make_index": params["make_index_in_default"],
+        "make_glossary": params["make_glossary_in_default"],
+    }
+    graph["output_extensions"] = params["output_extension"]
+    graph["packages"] = unique(params["packages"])
+    graph["graphics_paths"] = params["graphics_paths"]
+    graph["files"] = files
+    graph["duplicate_fig_files"] = [os.path.relpath(f) \
+        for f in unique(params["duplicate_fig_files"])]
+    graph["texmf_paths"] = params["texmf_path"]
+    graph["texmf_packages"] = unique(texmf_packages)
+    graph["walk_skipped"] = params["walk_skipped"]
+    return graph
+# fed dependency_graph(params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_dependency_json(fid, params):
+    json.dump(dependency_graph(params), fid, indent=2, sort_keys=True)
+    fid.write("\n")
+    return
+# fed write_dependency_json(fid, params)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def write_dependency_dot(fid, params):
+    graph = dependency_graph(params)
+    fid.write("// Generated by latexmake v" + latexmake_version() + "\n")
+    fid.write("digraph \"" + graph["source"] + "\" {\n")
+    fid.write("\trankdir=LR;\n")
+    nodes = []
+    for item in graph["files"]:
+        if item["path"] not in nodes:
+            nodes.append(item["path"])
+            fid.write("\t\"" + item["path"] + "\" [label=\"" + item["path"] + \
+                "\\n(" + item["type"] + ")\"];\n")
+    for item in graph["files"]:
+        if item["included_by"]:
+            fid.write("\t\"" + item["included_by"] + "\" -> \"" + \
+                item["path"] + "\";\n")
+    fid.write("}\n")
+    return
+# fed write_dependency_dot(fid, params)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Build telemetry
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+def timing_output(command):
+    # guesses the file a command writes, to record its size
+    name = os.path.basename(command[0])
+    outdir = ""
+    jobname = ""
+    source = ""
+    args = command[1:]
+    while args:
+        arg = args.pop(0)
+        if arg.lstrip("-") in ["output-directory", "jobname"] and args:
+            # -jobname NAME
+            arg = arg + "=" + args.pop(0)
+        if arg.find("-output-directory=") >= 0:
+            outdir = parse_equals(arg)[1]
+        elif arg.find("-jobname=") >= 0:
+            jobname = parse_equals(arg)[1]
+        elif not arg.startswith("-"):
+            # TeX code (\def...\input{...}) is a source with a jobname
+            source = arg
+    if not source:
+        return ""
+    stem = jobname or os.path.splitext(os.path.basename(source))[0]
+
+    # the tools are tested before the engines (bibtex contains "tex")
+    if name.startswith("latexmake"):
+        return ""
+    elif name in ["bibtex", "bibtex8", "biber"]:
+        return source + ".bbl"
+    elif name == "makeindex":
+        return source + ".ind"
+    elif name == "makeglossaries":
+        return source + ".gls"
+    elif name in ["latex", "tex"]:
+        return os.path.join(outdir, stem + ".dvi")
+    elif name.find("tex") >= 0:
+        return os.path.join(outdir, stem + ".pdf")
+    return ""
+# fed timing_output(command)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def run_timed(command, log, step="", output=""):
+    # runs command and appends its wall time, exit status and output size to
+    # the JSON lines file log
+    if not step:
+        step = os.path.basename(command[0])
+        for i in range(0, min(len(command) - 1, 2)):
+            if os.path.basename(command[i]).startswith("latexmake"):
+                # a helper command (convertfig, ...)
+                step = command[i + 1]
+                break
+    output = output or timing_output(command)
+    start = time.time()
+    try:
+        status = subprocess.call(command)
+    except OSError, e:
+        warning("could not run " + command[0] + " (" + str(e) + ")")
+        status = 127
+    seconds = time.time() - start
+
+    record = {"build": os.environ.get("LATEXMAKE_BUILD_ID", ""), \
+        "step": step, "command": " ".join(command), "start": start, \
+        "seconds": round(seconds, 3), "status": status, "output": output, \
+        "size": None}
+    if output and os.path.isfile(output):
+        record["size"] = os.path.getsize(output)
+    try:
+        pth = os.path.dirname(log)
+        if pth and not os.path.isdir(pth):
+            os.makedirs(pth)
+        fid = open(log, "a")
+        fid.write(json.dumps(record, sort_keys=True) + "\n")
         fid.close()
+    except (IOError, OSError), e:
+        warning("could not write " + log + " (" + str(e) + ")")
+    return status
+# fed run_timed(command, log, step, output)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def read_timing_log(log):
+    # the records of a timing log (broken lines are skipped)
+    records = []
+    if not os.path.isfile(log):
+        return records
+    fid = open(log, "r")
+    for line in fid:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+    fid.close()
+    return records
+# fed read_timing_log(log)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def timing_report(records, top=10, builds=10):
+    # summarises a timing log: the slowest steps, the time per kind of step,
+    # and the time and number of TeX passes of the last builds
+    output = "Slowest steps\n"
+    for record in sorted(records, key=lambda r: -r["seconds"])[:top]:
+        output += "  %8.2fs  %-16s %s\n" % (record["seconds"], \
+            record["step"], record["command"][:50])
+
+    steps = {}
+    for record in records:
+        steps.setdefault(record["step"], []).append(record["seconds"])
+    output += "\nSteps\n"
+    output += "  %-16s %6s %9s %9s\n" % ("step", "runs", "mean", "total")
+    for (step, seconds) in sorted(steps.items(), key=lambda i: -sum(i[1])):
+        output += "  %-16s %6d %8.2fs %8.2fs\n" % (step, len(seconds), \
+            sum(seconds) / len(seconds), sum(seconds))
+
+    order = []
+    runs = {}
+    for record in records:
+        build = record["build"] or "-"
+        if build not in runs:
+            order.append(build)
+            runs[build] = []
+        runs[build].append(record)
+    output += "\nBuilds\n"
+    output += "  %-24s %9s %7s %7s\n" % ("build", "time", "passes", "failed")
+    for build in order[-builds:]:
+        passes = len([r for r in runs[build] if r["step"].find("tex") >= 0 \
+            and r["step"].find("bib") < 0])
+        failed = len([r for r in runs[build] if r["status"] != 0])
+        output += "  %-24s %8.2fs %7d %7d\n" % (build, \
+            sum([r["seconds"] for r in runs[build]]), passes, failed)
+    return output
+# fed timing_report(records, top, builds)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Scan daemon
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+def refresh_shared(shared):
+    # drops the cached scan results that changed on disk since they were
+    # made: the project index if a directory changed (files were added or
+    # removed), and the parse results of changed files
+    dirs = shared.get("project_dirs", {})
+    if [pth for pth in dirs if not os.path.isdir(pth) or \
+        os.path.getmtime(pth) != dirs[pth]]:
+        shared["project_index"] = None
+        shared["project_dirs"] = {}
+    cache = shared.get("parse_cache", {})
+    for key in cache.keys():
+        (filename, mtime, size, _) = key
+        try:
+            info = os.stat(filename)
+        except OSError:
+            del cache[key]
+            continue
+        if info.st_mtime != mtime or info.st_size != size:
+            del cache[key]
+    return shared
+# fed refresh_shared(shared)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def serve_environment():
+    # what a scan depends on besides the files: the working directory and the
+    # variables of latexmake_serve_environment
+    output = {"cwd": os.path.realpath(os.getcwd())}
+    for key in latexmake_serve_environment:
+        output[key] = os.environ.get(key)
+    return output
+# fed serve_environment()
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def serve_request(request, shared):
+    # answers a request to the daemon: {"command": "generate" (write the
+    # Makefile) or "deps" (the dependency graphs), "args": [...],
+    # "environment": {...}}. The output of the scan is returned with the exit
+    # status. Clients whose environment differs from the daemon's are
+    # refused (they would get other results than a scan of their own)
+    if request.get("environment") != serve_environment():
+        return {"status": 0, "refused": True, "output": "", "graphs": []}
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    response = {"status": 0, "graphs": []}
+    try:
+        try:
+            shared = refresh_shared(shared)
+            args = request.get("args", [])
+            if request.get("command") == "generate":
+                latexmake_generate(args, shared)
+            elif request.get("command") == "deps":
+                options = [arg for arg in args if arg.find("--") == 0]
+                for root in [arg for arg in args if arg.find("--") != 0]:
+                    response["graphs"].append(dependency_graph( \
+                        latexmake_scan(options + [root], shared)))
+            else:
+                raise latexmake_invalidArgument("Unknown request " + \
+                    str(request.get("command")))
+        except SystemExit, e:
+            if e.code:
+                print e.code
+                response["status"] = 1
+        except Exception, e:
+            print traceback.format_exc()
+            response["status"] = 1
+    finally:
+        response["output"] = sys.stdout.getvalue()
+        sys.stdout = stdout
+    return response
+# fed serve_request(request, shared)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+class latexmake_serveHandler(SocketServer.StreamRequestHandler):
+    # a connection to the daemon: one JSON request line, one JSON response
+    # line
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        if request.get("command") in ["ping", "stop"]:
+            response = {"status": 0, "output": "", "graphs": []}
+            self.server.stopped = request.get("command") == "stop"
+        else:
+            response = serve_request(request, self.server.shared)
+        self.wfile.write(json.dumps(response) + "\n")
+    # fed handle(self)
+# class latexmake_serveHandler(SocketServer.StreamRequestHandler)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def serve_client(request):
+    # sends request to the daemon of the project in the current directory.
+    # Returns its response, or None if no daemon is running or it refused the
+    # request (see serve_request)
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(latexmake_socket):
+        return None
+    request["environment"] = serve_environment()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(latexmake_socket)
+            client.sendall(json.dumps(request) + "\n")
+            fid = client.makefile("r")
+            response = json.loads(fid.readline())
+            fid.close()
+        except (socket.error, ValueError):
+            return None
+    finally:
+        client.close()
+    if response.get("refused"):
+        return None
+    response["output"] = response["output"].encode("utf-8")
+    return response
+# fed serve_client(request)
+#-------------------------------------------------------------------------------
+
+
+#================================================================================
+#
+#        Helper commands (called from the generated Makefile)
+#
+#================================================================================
+
+
+#-------------------------------------------------------------------------------
+def parse_command_args(args):
+    # splits helper command arguments into a dictionary of --key=value
+    # options and a list of positional arguments. Everything after "--" is
+    # positional. A bare --key is stored as True.
+    options = {}
+    positional = []
+    idx = 0
+    while idx < len(args):
+        arg = args[idx]
+        idx += 1
+        if arg == "--":
+            positional += args[idx:]
+            break
+        elif arg.find("--") == 0:
+            if arg.find("=") < 0:
+                options[arg[2:]] = True
+            else:
+                (key, value) = parse_equals(arg[2:])
+                options[key] = value
+        else:
+            positional.append(arg)
+    return (options, positional)
+# fed parse_command_args(args)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def command_convertfig(args):
+    # latexmake convertfig [--cache-dir=DIR] [--cache-size=MB]
+    #     [--epstopdf=CMD] [--ps2eps=CMD] source target
+    (options, positional) = parse_command_args(args)
+    if len(positional) != 2:
+        raise latexmake_invalidArgument("convertfig needs a source and target")
+
+    cache_size = int(options.get("cache-size", "0") or "0") * 1024 * 1024
+    return convert_figure(positional[0], positional[1], \
+        options.get("epstopdf", "epstopdf"), options.get("ps2eps", "ps2eps"), \
+        options.get("cache-dir", ""), cache_size)
+# fed command_convertfig(args)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def command_buildcache(args):
+    # latexmake buildcache fetch|store --cache-dir=DIR [--cache-size=MB]
+    #     --source=NAME --engine=ENGINE [--flags=FLAGS] --outputs=EXT,...
+    #     [--output-directory=DIR] -- input files
+    # fetch exits with 1 on a cache miss
+    (options, positional) = parse_command_args(args)
+    if not positional or positional[0] not in ["fetch", "store"]:
+        raise latexmake_invalidArgument("buildcache needs fetch or store")
+    for key in ["cache-dir", "source", "engine", "outputs"]:
+        if key not in options:
+            raise latexmake_invalidArgument("buildcache needs --" + key)
+
+    key = build_digest(positional[1:], options["engine"], \
+        options.get("flags", ""))
+    outdir = options.get("output-directory", "")
+    files = [(os.path.join(outdir, options["source"] + "." + ext), \
+        options["source"] + "." + ext) \
+        for ext in parse_comma_separated_data(options["outputs"])]
+
+    if positional[0] == "fetch":
+        if cache_fetch(options["cache-dir"], key, files):
+            print "Reusing cached build " + key
+            return 0
+        return 1
+
+    cache_size = int(options.get("cache-size", "0") or "0") * 1024 * 1024
+    cache_store(options["cache-dir"], key, files, cache_size)
+    return 0
+# fed command_buildcache(args)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def command_archive(args):
+    # latexmake archive --output=NAME.zip|NAME.tar.gz [--format=zip|gzip]
+    #     [--texmf-paths="PATHS"] [--texmf="PACKAGE PATHS"] -- files
+    (options, positional) = parse_command_args(args)
+    if "output" not in options:
+        raise latexmake_invalidArgument("archive needs --output")
+
+    output = options["output"]
+    fmt = options.get("format", "")
+    if not fmt:
+        if output.endswith(".zip"):
+            fmt = "zip"
+        else:
+            fmt = "gzip"
+    if fmt not in ["zip", "gzip"]:
+        raise latexmake_invalidArgument("Unknown archive format " + fmt)
+
+    texmf_paths = options.get("texmf-paths", "").split()
+    texmf_pkgs = options.get("texmf", "").split()
+    readme = ""
+    if texmf_pkgs:
+        readme = archive_texmf_readme(texmf_paths)
+
+    # do not archive the archive
+    files = [f for f in positional if os.path.abspath(f) != \
+        os.path.abspath(output)]
+    write_archive(output, fmt, archive_members(files, texmf_pkgs, \
+        texmf_paths), readme)
+    return 0
+# fed command_archive(args)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def command_texpass(args):
+    # latexmake texpass --engine=ENGINE --source=NAME [--flags=FLAGS]
+    #     [--passes=N] [--keep=EXT,...] [--output-directory=DIR]
+    #     [--subdirs=DIR,...] [--depfile=FILE --target=TARGET]
+    (options, positional) = parse_command_args(args)
+    for key in ["engine", "source"]:
+        if key not in options:
+            raise latexmake_invalidArgument("texpass needs --" + key)
+    keep = parse_comma_separated_data(options.get("keep", "aux"))
+    subdirs = [d for d in parse_comma_separated_data(options.get("subdirs", \
+        "")) if d]
+    return run_tex_passes(options["engine"], options.get("flags", ""), \
+        options["source"], options.get("output-directory", ""), \
+        int(options.get("passes", "1")), keep, options.get("depfile", ""), \
+        options.get("target", ""), subdirs)
+# fed command_texpass(args)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def command_unchanged(args):
+    # latexmake unchanged --outputs=FILE,... [--directory=DIR] -- command
+    # runs command (in DIR); outputs it did not change keep their mtime
+    (options, positional) = parse_command_args(args)
+    if not positional:
+        raise latexmake_invalidArgument("unchanged needs a command")
+    outputs = parse_comma_separated_data(options.get("outputs", ""))
+    return run_preserving_mtimes(positional, [f for f in outputs if f], \
+        options.get("directory", None))
+# fed command_unchanged(args)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def command_includeonly(args):
+    # latexmake includeonly --state=FILE --record -- files
+    #   remembers the digests of files (after a full build)
+    # latexmake includeonly --state=FILE --wrapper=FILE --source=NAME
+    #     --chapters="FILES" -- files
+    #   writes a wrapper that \\includeonly's the changed chapters. Returns 0
+    #   if the wrapper should be compiled, 1 if nothing changed and 2 if a
+    #   full build is needed (no state, or a file outside the chapters changed)
+    (options, positional) = parse_command_args(args)
+    if "state" not in options:
+        raise latexmake_invalidArgument("includeonly needs --state=FILE")
+
+    if "record" in options:
+        write_build_state(options["state"], dict([(f, file_digest(f)) \
+            for f in positional if os.path.isfile(f)]))
+        return 0
+
+    state = read_build_state(options["state"])
+    if not state:
+        return 2
+    chapters = options.get("chapters", "").split()
+    changed = [f for f in positional if not os.path.isfile(f) or \
+        state.get(f, None) != file_digest(f)]
+    if not changed:
+        print "Nothing changed since the last full build"
+        return 1
+    if [f for f in changed if f not in chapters]:
+        return 2
+
+    if "wrapper" not in options or "source" not in options:
+        raise latexmake_invalidArgument("includeonly needs --wrapper=FILE " + \
+            "and --source=NAME")
+    pth = os.path.dirname(options["wrapper"])
+    if pth and not os.path.isdir(pth):
+        os.makedirs(pth)
+    fid = open(options["wrapper"], "w")
+    fid.write("\\includeonly{" + ",".join([os.path.splitext(f)[0] \
+        for f in changed]) + "}\n")
+    fid.write("\\input{" + options["source"] + "}\n")
+    fid.close()
+    print "Compiling " + " ".join(changed)
+    return 0
+# fed command_includeonly(args)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def command_preview(args):
+    # latexmake preview --source=FILE --output=FILE -- file
+    # writes a document with the preamble of source that \\input's file,
+    # followed by the bibliography commands of the body of source
+    (options, positional) = parse_command_args(args)
+    if "source" not in options or "output" not in options or \
+        len(positional) != 1:
+        raise latexmake_invalidArgument("preview needs --source=FILE " + \
+            "--output=FILE -- file")
+
+    fid = open(options["source"], "r")
+    source = fid.read()
+    fid.close()
+    idx = source.find("\\begin{document}")
+    if idx < 0:
+        raise latexmake_invalidArgument(options["source"] + \
+            " has no \\begin{document}")
+
+    body = latexmake_comment_regex.sub("", source[idx:])
+    bibliography = "".join([command + "\n" for command in \
+        latexmake_bibliography_regex.findall(body)])
+    output = source[:idx] + "\\begin{document}\n\\input{" + \
+        os.path.splitext(positional[0])[0] + "}\n" + bibliography + \
+        "\\end{document}\n"
+
+    # only write changes, so the preview is not compiled needlessly
+    if os.path.isfile(options["output"]):
+        fid = open(options["output"], "r")
+        unchanged = fid.read() == output
+        fid.close()
+        if unchanged:
+            return 0
+    fid = open(options["output"], "w")
+    fid.write(output)
+    fid.close()
+    return 0
+# fed command_preview(args)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def command_timing(args):
+    # latexmake timing --log=FILE [--step=NAME] [--output=FILE] -- command
+    # runs command and logs how long it took
+    (options, positional) = parse_command_args(args)
+    if not positional or "log" not in options:
+        raise latexmake_invalidArgument("timing needs --log=FILE -- command")
+    return run_timed(positional, options["log"], options.get("step", ""), \
+        options.get("output", ""))
+# fed command_timing(args)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def command_report(args):
+    # latexmake report [--log=FILE] [--top=N] [--builds=N]
+    # summarises the timing log of the generated Makefile
+    (options, positional) = parse_command_args(args)
+    log = options.get("log", os.path.join(".latexmake", "timing.jsonl"))
+    records = read_timing_log(log)
+    if not records:
+        print "No timings in " + log
+        return 1
+    print timing_report(records, int(options.get("top", "10")), \
+        int(options.get("builds", "10")))
+    return 0
+# fed command_report(args)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def command_stamps(args):
+    # latexmake stamps --dir=DIR -- files
+    # updates the content stamps of files; prints how many changed
+    (options, positional) = parse_command_args(args)
+    if "dir" not in options:
+        raise latexmake_invalidArgument("stamps needs --dir=DIR")
+    changed = 0
+    for f in positional:
+        if os.path.isfile(f) and update_stamp(stamp_name(options["dir"], f), f):
+            changed += 1
+    print changed
+    return 0
+# fed command_stamps(args)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def command_tikzstamps(args):
+    # latexmake tikzstamps --dir=DIR -- [options] filename.tex
+    # updates the digests of the code of each externalized tikz picture and
+    # of the preamble (what the .md5 files of the tikz external library
+    # hold); prints how many changed
+    (options, positional) = parse_command_args(args)
+    if "dir" not in options or not positional:
+        raise latexmake_invalidArgument("tikzstamps needs --dir=DIR -- " + \
+            "filename.tex")
+
+    # the warnings are for the Makefile generation
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        params = latexmake_scan(positional)
+    finally:
+        sys.stdout = stdout
+
+    # the whole preamble (\\tikzset, colors, ... are not scanned for)
+    source = params["basename"] + ".tex"
+    fid = open(source, "r")
+    preamble = prepare_tex_file(fid.read(), params, source)
+    fid.close()
+    idx = preamble.find("\\begin{document}")
+    if idx >= 0:
+        preamble = preamble[:idx]
+    digests = [(params["basename"] + ".preamble", \
+        hashlib.sha1(preamble).hexdigest())]
+    digests += [(name, digest) for (name, _, digest) in params["tikz_figures"]]
+
+    changed = 0
+    for (name, digest) in digests:
+        if update_digest_stamp(os.path.join(options["dir"], name + ".stamp"), \
+            digest):
+            changed += 1
+    print changed
+    return 0
+# fed command_tikzstamps(args)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def command_fingerprint(args):
+    # latexmake fingerprint --output=FILE [--checked=FILE] -- files
+    # writes the structural fingerprint of files to FILE if it changed
+    (options, positional) = parse_command_args(args)
+    if "output" not in options:
+        raise latexmake_invalidArgument("fingerprint needs --output=FILE")
+
+    # the warnings about missing tools are for the Makefile generation
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        params = latexmake_default_params()
+    finally:
+        sys.stdout = stdout
+
+    update_fingerprint(options["output"], options.get("checked", ""), \
+        positional, params)
+    return 0
+# fed command_fingerprint(args)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def command_bibsubset(args):
+    # latexmake bibsubset --aux=FILE --output-dir=DIR [--index-dir=DIR]
+    # writes the entries cited in the aux file to DIR/name.bib for each
+    # \\bibdata name
+    (options, positional) = parse_command_args(args)
+    if "aux" not in options or "output-dir" not in options:
+        raise latexmake_invalidArgument("bibsubset needs --aux=FILE " + \
+            "--output-dir=DIR")
+    write_bib_subsets(options["aux"], options["output-dir"], \
+        options.get("index-dir", "~/.latexmake/bibindex"))
+    return 0
+# fed command_bibsubset(args)
+#-------------------------------------------------------------------------------
+
+
+#-------------------------------------------------------------------------------
+def command_build(args):
+    # latexmake build [--jobs=N] [--force] [options] filename.tex
+    # compiles the project directly, without make
+    build_args = [arg for arg in args if arg.find("--jobs=") == 0 or \
+        arg == "--force"]
+    (options, positional) = parse_command_args(build_args)
+    args = [arg for arg in args if arg not in build_args]
+    if not args:
+        raise latexmake_noInput("build needs a TeX file")
+
+    params = latexmake_scan(args)
+    statefile = os.path.join(params["latexmake_dir"], \
+        params["basename"] + ".build.json")
+    state = read_build_state(statefile)
+    try:
+        status = run_build_steps(build_steps(params), state, \
+            int(options.get("jobs", "1")), "force" in options)
+    finally:
+        write_build_state(statefile, state)
+    return status
+# fed command_build(args)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def command_serve(args):
+    # latexmake serve [--stop]
+    # keeps the scan results of the project in the current directory warm
+    # and answers the requests of the latexmake command line (and editors)
+    # on .latexmake/serve.sock until it is stopped. It does not watch the
+    # files: each request checks the mtimes of the cached files and
+    # directories first. Clients with another environment (PATH, TEXMF, ...)
+    # scan on their own
+    (options, positional) = parse_command_args(args)
+    if "stop" in options:
+        if serve_client({"command": "stop"}) is None:
+            print "latexmake serve is not running"
+            return 1
+        return 0
+    if serve_client({"command": "ping"}) is not None:
+        print "latexmake serve is already running"
+        return 1
+
+    # a socket left behind by a daemon that died
+    if os.path.exists(latexmake_socket):
+        os.remove(latexmake_socket)
+    if not os.path.isdir(os.path.dirname(latexmake_socket)):
+        os.makedirs(os.path.dirname(latexmake_socket))
+    server = SocketServer.UnixStreamServer(latexmake_socket, \
+        latexmake_serveHandler)
+    server.shared = {}
+    server.stopped = False
+    print "latexmake serve: listening on " + latexmake_socket + \
+        " (changes are found by checking mtimes on each request)"
+    try:
+        while not server.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(latexmake_socket)
+    return 0
+# fed command_serve(args)
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+def command_deps(args):
+    # latexmake deps [options] filename.tex [filename.tex ...]
+    # prints the dependency graphs (see --emit-json), from the daemon if it
+    # is running
+    response = serve_client({"command": "deps", "args": args})
+    if response is None:
+        shared = {}
+        options = [arg for arg in args if arg.find("--") == 0]
+        graphs = [dependency_graph(latexmake_scan(options + [root], shared)) \
+            for root in [arg for arg in args if arg.find("--") != 0]]
+    else:
+        if response["status"]:
+            sys.stdout.write(response["output"])
+            return response["status"]
+        graphs = response["graphs"]
+    print json.dumps(graphs, indent=2, sort_keys=True)
+    return 0
+# fed command_deps(args)
+#-------------------------------------------------------------------------------
+
+
+# helper commands, by name
+latexmake_commands = {
+    "archive": command_archive,
+    "bibsubset": command_bibsubset,
+    "build": command_build,
+    "buildcache": command_buildcache,
+    "convertfig": command_convertfig,
+    "deps": command_deps,
+    "fingerprint": command_fingerprint,
+    "includeonly": command_includeonly,
+    "preview": command_preview,
+    "report": command_report,
+    "serve": command_serve,
+    "stamps": command_stamps,
+    "texpass": command_texpass,
+    "tikzstamps": command_tikzstamps,
+    "timing": command_timing,
+    "unchanged": command_unchanged,
+}
+
+
+#-------------------------------------------------------------------------------
+if __name__ == "__main__":
+    try:
+        args = sys.argv
+        if not args:
+            sys.exit("Usage:\nlatexmake.py [options] filename.tex")
+
+        # run a helper command
+        if len(args) > 1 and args[1] in latexmake_commands:
+            sys.exit(latexmake_commands[args[1]](args[2:]))
+
+        # let a running scan daemon (latexmake serve) do the work
+        response = serve_client({"command": "generate", "args": args[1:]})
+        if response is not None:
+            sys.stdout.write(response["output"])
+            sys.exit(response["status"])
+
+        # scan the project and write the Makefile
+        latexmake_generate(args[1:])
     except Exception, e:
         print traceback.format_exc()
         sys.exit(e.message)